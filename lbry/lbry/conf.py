@@ -560,6 +560,13 @@ class Config(CLIConfig):
         ('spv8.lbry.com', 50001),
         ('spv9.lbry.com', 50001),
     ])
+    lbryum_binary_protocol = Toggle(
+        "Talk to SPV wallet servers in the binary protocol, falling back to JSON for servers without it", False
+    )
+    lbryum_filter_sync = Toggle(
+        "Sync the wallet by scanning block filters instead of subscribing to every address, "
+        "falling back to subscriptions for servers without filters", False
+    )
     known_dht_nodes = Servers("Known nodes for bootstrapping connection to the DHT", [
         ('lbrynet1.lbry.com', 4444),  # US EAST
         ('lbrynet2.lbry.com', 4444),  # US WEST
@@ -148,7 +148,7 @@ class JSONResponseEncoder(JSONEncoder):
             'amount': dewies_to_lbc(txo.amount),
             'address': txo.get_address(self.ledger),
             'confirmations': (best_height+1) - tx_height if tx_height > 0 else tx_height,
-            'timestamp': self.ledger.headers[tx_height]['timestamp'] if 0 < tx_height <= best_height else None
+            'timestamp': self.ledger.headers.get_timestamp(tx_height) if 0 < tx_height <= best_height else None
         }
         if txo.is_change is not None:
             output['is_change'] = txo.is_change
@@ -203,7 +203,7 @@ class JSONResponseEncoder(JSONEncoder):
                 if isinstance(value, int):
                     meta[key] = dewies_to_lbc(value)
         if 0 < meta.get('creation_height', 0) <= self.ledger.headers.height:
-            meta['creation_timestamp'] = self.ledger.headers[meta['creation_height']]['timestamp']
+            meta['creation_timestamp'] = self.ledger.headers.get_timestamp(meta['creation_height'])
         return meta
 
     def encode_input(self, txi):
@@ -256,7 +256,7 @@ class JSONResponseEncoder(JSONEncoder):
             'content_fee': managed_stream.content_fee,
             'height': tx_height,
             'confirmations': (best_height + 1) - tx_height if tx_height > 0 else tx_height,
-            'timestamp': self.ledger.headers[tx_height]['timestamp'] if 0 < tx_height <= best_height else None
+            'timestamp': self.ledger.headers.get_timestamp(tx_height) if 0 < tx_height <= best_height else None
         }
 
     def encode_claim(self, claim):
@@ -493,7 +493,7 @@ class SQLiteStorage(SQLiteMixin):
 
     def change_file_status(self, stream_hash: str, new_status: str):
         log.debug("update file status %s -> %s", stream_hash, new_status)
-        return self.db.execute_fetchall("update file set status=? where stream_hash=?", (new_status, stream_hash))
+        return self.db.execute("update file set status=? where stream_hash=?", (new_status, stream_hash))
 
     async def change_file_download_dir_and_file_name(self, stream_hash: str, download_dir: typing.Optional[str],
                                                      file_name: typing.Optional[str]):
@@ -502,22 +502,22 @@ class SQLiteStorage(SQLiteMixin):
         else:
             encoded_file_name = binascii.hexlify(file_name.encode()).decode()
             encoded_download_dir = binascii.hexlify(download_dir.encode()).decode()
-        return await self.db.execute_fetchall("update file set download_directory=?, file_name=? where stream_hash=?", (
+        return await self.db.execute("update file set download_directory=?, file_name=? where stream_hash=?", (
             encoded_download_dir, encoded_file_name, stream_hash,
         ))
 
     async def save_content_fee(self, stream_hash: str, content_fee: Transaction):
-        return await self.db.execute_fetchall("update file set content_fee=? where stream_hash=?", (
+        return await self.db.execute("update file set content_fee=? where stream_hash=?", (
             binascii.hexlify(content_fee.raw), stream_hash,
         ))
 
     async def set_saved_file(self, stream_hash: str):
-        return await self.db.execute_fetchall("update file set saved_file=1 where stream_hash=?", (
+        return await self.db.execute("update file set saved_file=1 where stream_hash=?", (
             stream_hash,
         ))
 
     async def clear_saved_file(self, stream_hash: str):
-        return await self.db.execute_fetchall("update file set saved_file=0 where stream_hash=?", (
+        return await self.db.execute("update file set saved_file=0 where stream_hash=?", (
             stream_hash,
         ))
 
@@ -727,11 +727,11 @@ class SQLiteStorage(SQLiteMixin):
 
     def update_reflected_stream(self, sd_hash, reflector_address, success=True):
         if success:
-            return self.db.execute_fetchall(
+            return self.db.execute(
                 "insert or replace into reflected_stream values (?, ?, ?)",
                 (sd_hash, reflector_address, self.time_getter())
             )
-        return self.db.execute_fetchall(
+        return self.db.execute(
             "delete from reflected_stream where sd_hash=? and reflector_address=?",
             (sd_hash, reflector_address)
         )
@@ -321,7 +321,7 @@ class StreamManager:
                     'claim_sequence': -1,
                     'address': txo.get_address(self.wallet.ledger),
                     'valid_at_height': txo.meta.get('activation_height', None),
-                    'timestamp': self.wallet.ledger.headers[tx_height]['timestamp'],
+                    'timestamp': self.wallet.ledger.headers.get_timestamp(tx_height),
                     'supports': []
                 }
             else:
@@ -33,7 +33,9 @@ class WalletDatabase(BaseDatabase):
             CREATE_TXO_TABLE +
             BaseDatabase.CREATE_TXO_INDEX +
             BaseDatabase.CREATE_TXI_TABLE +
-            BaseDatabase.CREATE_TXI_INDEX
+            BaseDatabase.CREATE_TXI_INDEX +
+            BaseDatabase.CREATE_UTXO_TABLE +
+            BaseDatabase.CREATE_BALANCE_TABLE
     )
 
     def txo_to_row(self, tx, address, txo):
@@ -133,14 +135,6 @@ class WalletDatabase(BaseDatabase):
         self.constrain_supports(constraints)
         return self.get_utxo_count(**constraints)
 
-    async def release_all_outputs(self, account):
-        await self.db.execute_fetchall(
-            "UPDATE txo SET is_reserved = 0 WHERE"
-            "  is_reserved = 1 AND txo.address IN ("
-            "    SELECT address from pubkey_address WHERE account = ?"
-            "  )", (account.public_key.address, )
-        )
-
     def get_supports_summary(self, account_id):
         return self.db.execute_fetchall(f"""
             select txo.amount, exists(select * from txi where txi.txoid=txo.txoid) as spent,
@@ -11,6 +11,9 @@ class Headers(BaseHeaders):
 
     header_size = 112
     chunk_size = 10**16
+    claim_trie_root_offset = 68
+    timestamp_offset = 100
+    bits_offset = 104
 
     max_target = 0x0000ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
     genesis_hash = b'9c89283ba0f3227f6c03b70216b9f665f0118d5e0fa729cedf4fb34d6a34f463'
@@ -18,7 +21,7 @@ class Headers(BaseHeaders):
 
     @property
     def claim_trie_root(self):
-        return self[self.height]['claim_trie_root']
+        return self._read_hash(self.height, self.claim_trie_root_offset)
 
     @staticmethod
     def serialize(header):
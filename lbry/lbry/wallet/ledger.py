@@ -53,7 +53,9 @@ class MainNetLedger(BaseLedger):
         self.fee_per_name_char = self.config.get('fee_per_name_char', self.default_fee_per_name_char)
 
     async def _inflate_outputs(self, query):
-        outputs = Outputs.from_base64(await query)
+        result = await query
+        # raw over the binary protocol, base64 encoded in JSON
+        outputs = Outputs.from_bytes(result) if isinstance(result, bytes) else Outputs.from_base64(result)
         txs = []
         if len(outputs.txs) > 0:
             txs = await asyncio.gather(*(self.cache_transaction(*tx) for tx in outputs.txs))
@@ -120,6 +122,10 @@ class MainNetLedger(BaseLedger):
         self.constraint_spending_utxos(constraints)
         return super().get_utxo_count(**constraints)
 
+    def get_utxo_amounts(self, **constraints):
+        self.constraint_spending_utxos(constraints)
+        return super().get_utxo_amounts(**constraints)
+
     def get_claims(self, **constraints):
         self.constraint_account_or_all(constraints)
         return self.db.get_claims(**constraints)
@@ -158,7 +164,7 @@ class MainNetLedger(BaseLedger):
         headers = self.headers
         history = []
         for tx in txs:
-            ts = headers[tx.height]['timestamp'] if tx.height > 0 else None
+            ts = headers.get_timestamp(tx.height) if tx.height > 0 else None
             item = {
                 'txid': tx.id,
                 'timestamp': ts,
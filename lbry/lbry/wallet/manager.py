@@ -131,6 +131,8 @@ class LbryWalletManager(BaseWalletManager):
         ledger_config = {
             'auto_connect': True,
             'default_servers': settings.lbryum_servers,
+            'binary_protocol': settings.lbryum_binary_protocol,
+            'filter_sync': settings.lbryum_filter_sync,
             'data_path': settings.wallet_dir,
         }
 
@@ -41,6 +41,13 @@ class Timer:
         self._last_start = None
         return self
 
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'count': self.count,
+            'sub_timers': {name: timer.to_dict() for name, timer in self.sub_timers.items()}
+        }
+
     def show(self, depth=0, height=None):
         if depth == 0:
             print('='*100)
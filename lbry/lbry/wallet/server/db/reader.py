@@ -16,6 +16,8 @@ from lbry.schema.tags import clean_tags
 from lbry.schema.result import Outputs
 from lbry.wallet.ledger import BaseLedger, MainNetLedger, RegTestLedger
 
+from lbry.wallet.server.metrics import Sketch
+
 from .common import CLAIM_TYPES, STREAM_TYPES, COMMON_TAGS
 
 
@@ -68,8 +70,12 @@ PRAGMAS = """
 @dataclass
 class ReaderState:
     db: sqlite3.Connection
-    stack: List[List]
-    metrics: Dict
+    # Timings of the measured functions since the last report: a Sketch
+    # of each call and the total of all of them per function
+    metrics: Dict[str, Sketch]
+    totals: Dict[str, int]
+    # The last query which failed
+    failed_sql: Optional[str]
     is_tracking_metrics: bool
     ledger: Type[BaseLedger]
     query_timeout: float
@@ -79,8 +85,17 @@ class ReaderState:
         self.db.close()
 
     def reset_metrics(self):
-        self.stack = []
         self.metrics = {}
+        self.totals = {}
+        self.failed_sql = None
+
+    def report_metrics(self) -> Dict:
+        """The timings since reset_metrics(), as sketch deltas."""
+        return {
+            'sketches': {name: sketch.to_dict() for name, sketch in self.metrics.items()},
+            'totals': self.totals,
+            'sql': self.failed_sql,
+        }
 
     def set_query_timeout(self):
         stop_at = time.perf_counter() + self.query_timeout
@@ -101,7 +116,7 @@ def initializer(log, _path, _ledger_name, query_timeout, _measure=False):
     db.row_factory = sqlite3.Row
     ctx.set(
         ReaderState(
-            db=db, stack=[], metrics={}, is_tracking_metrics=_measure,
+            db=db, metrics={}, totals={}, failed_sql=None, is_tracking_metrics=_measure,
             ledger=MainNetLedger if _ledger_name == 'mainnet' else RegTestLedger,
             query_timeout=query_timeout, log=log
         )
@@ -119,18 +134,17 @@ def measure(func):
         state = ctx.get()
         if not state.is_tracking_metrics:
             return func(*args, **kwargs)
-        metric = {}
-        state.metrics.setdefault(func.__name__, []).append(metric)
-        state.stack.append([])
         start = time.perf_counter()
         try:
             return func(*args, **kwargs)
         finally:
             elapsed = int((time.perf_counter()-start)*1000)
-            metric['total'] = elapsed
-            metric['isolated'] = (elapsed-sum(state.stack.pop()))
-            if state.stack:
-                state.stack[-1].append(elapsed)
+            name = func.__name__
+            sketch = state.metrics.get(name)
+            if sketch is None:
+                sketch = state.metrics[name] = Sketch()
+            sketch.add(elapsed)
+            state.totals[name] = state.totals.get(name, 0) + elapsed
     return wrapper
 
 
@@ -141,8 +155,12 @@ def reports_metrics(func):
         if not state.is_tracking_metrics:
             return func(*args, **kwargs)
         state.reset_metrics()
-        r = func(*args, **kwargs)
-        return r, state.metrics
+        try:
+            r = func(*args, **kwargs)
+        except (SQLiteInterruptedError, SQLiteOperationalError) as error:
+            error.metrics = state.report_metrics()
+            raise
+        return r, state.report_metrics()
     return wrapper
 
 
@@ -169,12 +187,13 @@ def execute_query(sql, values) -> List:
     except sqlite3.OperationalError as err:
         plain_sql = interpolate(sql, values)
         if context.is_tracking_metrics:
-            context.metrics['execute_query'][-1]['sql'] = plain_sql
+            context.failed_sql = plain_sql
+        # The metrics are reported once all timings are in, by reports_metrics()
         if str(err) == "interrupted":
             context.log.warning("interrupted slow sqlite query:\n%s", plain_sql)
-            raise SQLiteInterruptedError(context.metrics)
+            raise SQLiteInterruptedError({})
         context.log.exception('failed running query', exc_info=err)
-        raise SQLiteOperationalError(context.metrics)
+        raise SQLiteOperationalError({})
 
 
 def _get_claims(cols, for_count=False, **constraints) -> Tuple[str, Dict]:
@@ -1,5 +1,6 @@
 import os
 import sqlite3
+from urllib.request import pathname2url
 from typing import Union, Tuple, Set, List
 from itertools import chain
 from decimal import Decimal
@@ -169,6 +170,15 @@ class SQLDB:
         register_canonical_functions(self.db)
         register_trending_functions(self.db)
 
+    def open_for_reading(self):
+        """ Open the database the block processor of another process writes, to query claims from. """
+        self.db = sqlite3.connect(
+            f'file:{pathname2url(self._db_path)}?mode=ro', isolation_level=None, check_same_thread=False, uri=True
+        )
+        self.db.row_factory = sqlite3.Row
+        register_canonical_functions(self.db)
+        register_trending_functions(self.db)
+
     def close(self):
         self.db.close()
 
@@ -716,3 +726,7 @@ class LBRYDB(DB):
     async def _open_dbs(self, *args, **kwargs):
         await super()._open_dbs(*args, **kwargs)
         self.sql.open()
+
+    async def open_for_reading(self):
+        await super().open_for_reading()
+        self.sql.open_for_reading()
@@ -1,6 +1,6 @@
 import time
 import math
-from typing import Tuple
+from typing import Tuple, Dict
 
 
 def calculate_elapsed(start) -> int:
@@ -24,12 +24,118 @@ def calculate_avg_percentiles(data) -> Tuple[int, int, int, int, int, int, int,
     )
 
 
+class Sketch:
+    """A mergeable histogram of millisecond timings of a fixed size.
+
+    Timings under 64ms are counted exactly, longer ones in log buckets
+    of 32 per doubling, within about 3% of the timing.  Count, sum, min
+    and max are exact.  Percentiles are reported as by
+    calculate_avg_percentiles() from the buckets.
+    """
+
+    __slots__ = ('count', 'sum', 'min', 'max', 'buckets')
+
+    EXACT_BITS = 6
+    EXACT = 1 << EXACT_BITS
+    HALF = EXACT >> 1
+    # Timings are capped at ~18 hours
+    MAX_SHIFT = 20
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = 0
+        self.max = 0
+        # bucket index -> count, only buckets with a count
+        self.buckets: Dict[int, int] = {}
+
+    @classmethod
+    def bucket(cls, value: int) -> int:
+        if value < cls.EXACT:
+            return max(value, 0)
+        shift = min(value.bit_length() - cls.EXACT_BITS, cls.MAX_SHIFT)
+        mantissa = min(value >> shift, cls.EXACT - 1)
+        return cls.EXACT + (shift - 1) * cls.HALF + mantissa - cls.HALF
+
+    @classmethod
+    def bucket_value(cls, index: int) -> int:
+        """The timing a bucket reports, the middle of its range."""
+        if index < cls.EXACT:
+            return index
+        shift, mantissa = divmod(index - cls.EXACT, cls.HALF)
+        shift += 1
+        return ((mantissa + cls.HALF) << shift) + (1 << (shift - 1))
+
+    def add(self, value: int):
+        if not self.count or value < self.min:
+            self.min = value
+        if not self.count or value > self.max:
+            self.max = value
+        self.count += 1
+        self.sum += value
+        index = self.bucket(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other: 'Sketch'):
+        if not other.count:
+            return
+        if not self.count or other.min < self.min:
+            self.min = other.min
+        if not self.count or other.max > self.max:
+            self.max = other.max
+        self.count += other.count
+        self.sum += other.sum
+        buckets = self.buckets
+        for index, count in other.buckets.items():
+            buckets[index] = buckets.get(index, 0) + count
+
+    def to_dict(self) -> Dict:
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'buckets': self.buckets}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Sketch':
+        sketch = cls()
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        sketch.min = data['min']
+        sketch.max = data['max']
+        sketch.buckets = dict(data['buckets'])
+        return sketch
+
+    def percentile(self, fraction: float) -> int:
+        rank = math.ceil(self.count * fraction)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(max(self.bucket_value(index), self.min), self.max)
+        return self.max
+
+    def avg_percentiles(self) -> Tuple[int, int, int, int, int, int, int, int]:
+        if not self.count:
+            return 0, 0, 0, 0, 0, 0, 0, 0
+        return (
+            int(self.sum / self.count),
+            self.min,
+            self.percentile(.05),
+            self.percentile(.25),
+            self.percentile(.50),
+            self.percentile(.75),
+            self.percentile(.95),
+            self.max
+        )
+
+
 def remove_select_list(sql) -> str:
     return sql[sql.index('FROM'):]
 
 
 class APICallMetrics:
 
+    # Distinct failed queries kept between reports
+    MAX_QUERIES = 100
+
     def __init__(self, name):
         self.name = name
 
@@ -38,15 +144,15 @@ class APICallMetrics:
         self.cache_response_count = 0
 
         # millisecond timings for query based responses
-        self.query_response_times = []
-        self.query_intrp_times = []
-        self.query_error_times = []
+        self.query_response_times = Sketch()
+        self.query_intrp_times = Sketch()
+        self.query_error_times = Sketch()
 
-        self.query_python_times = []
-        self.query_wait_times = []
-        self.query_sql_times = []  # aggregate total of multiple SQL calls made per request
+        self.query_python_times = Sketch()
+        self.query_wait_times = Sketch()
+        self.query_sql_times = Sketch()  # aggregate total of multiple SQL calls made per request
 
-        self.individual_sql_times = []  # every SQL query run on server
+        self.individual_sql_times = Sketch()  # every SQL query run on server
 
         # actual queries
         self.errored_queries = set()
@@ -58,20 +164,20 @@ class APICallMetrics:
             "receive_count": self.receive_count,
             # sum of these is total responses made
             "cache_response_count": self.cache_response_count,
-            "query_response_count": len(self.query_response_times),
-            "intrp_response_count": len(self.query_intrp_times),
-            "error_response_count": len(self.query_error_times),
+            "query_response_count": self.query_response_times.count,
+            "intrp_response_count": self.query_intrp_times.count,
+            "error_response_count": self.query_error_times.count,
             # millisecond timings for non-cache responses
-            "response": calculate_avg_percentiles(self.query_response_times),
-            "interrupt": calculate_avg_percentiles(self.query_intrp_times),
-            "error": calculate_avg_percentiles(self.query_error_times),
+            "response": self.query_response_times.avg_percentiles(),
+            "interrupt": self.query_intrp_times.avg_percentiles(),
+            "error": self.query_error_times.avg_percentiles(),
             # response, interrupt and error each also report the python, wait and sql stats:
-            "python": calculate_avg_percentiles(self.query_python_times),
-            "wait": calculate_avg_percentiles(self.query_wait_times),
-            "sql": calculate_avg_percentiles(self.query_sql_times),
+            "python": self.query_python_times.avg_percentiles(),
+            "wait": self.query_wait_times.avg_percentiles(),
+            "sql": self.query_sql_times.avg_percentiles(),
             # extended timings for individual sql executions
-            "individual_sql": calculate_avg_percentiles(self.individual_sql_times),
-            "individual_sql_count": len(self.individual_sql_times),
+            "individual_sql": self.individual_sql_times.avg_percentiles(),
+            "individual_sql_count": self.individual_sql_times.count,
             # actual queries
             "errored_queries": list(self.errored_queries),
             "interrupted_queries": list(self.interrupted_queries),
@@ -84,35 +190,35 @@ class APICallMetrics:
         self.cache_response_count += 1
 
     def _add_query_timings(self, request_total_time, metrics):
-        if metrics and 'execute_query' in metrics:
-            sub_process_total = metrics[self.name][0]['total']
-            individual_query_times = [f['total'] for f in metrics['execute_query']]
-            aggregated_query_time = sum(individual_query_times)
-            self.individual_sql_times.extend(individual_query_times)
-            self.query_sql_times.append(aggregated_query_time)
-            self.query_python_times.append(sub_process_total - aggregated_query_time)
-            self.query_wait_times.append(request_total_time - sub_process_total)
-
-    @staticmethod
-    def _add_queries(query_set, metrics):
-        if metrics and 'execute_query' in metrics:
-            for execute_query in metrics['execute_query']:
-                if 'sql' in execute_query:
-                    query_set.add(remove_select_list(execute_query['sql']))
+        """Add the timings reported by the reader, see reader.reports_metrics()."""
+        if metrics and 'execute_query' in metrics.get('sketches', {}):
+            sub_process_total = metrics['totals'][self.name]
+            aggregated_query_time = metrics['totals']['execute_query']
+            self.individual_sql_times.merge(Sketch.from_dict(metrics['sketches']['execute_query']))
+            self.query_sql_times.add(aggregated_query_time)
+            self.query_python_times.add(sub_process_total - aggregated_query_time)
+            self.query_wait_times.add(request_total_time - sub_process_total)
+
+    def _add_queries(self, query_set, metrics):
+        if metrics and metrics.get('sql') and len(query_set) < self.MAX_QUERIES:
+            query_set.add(remove_select_list(metrics['sql']))
 
     def query_response(self, start, metrics):
-        self.query_response_times.append(calculate_elapsed(start))
-        self._add_query_timings(self.query_response_times[-1], metrics)
+        elapsed = calculate_elapsed(start)
+        self.query_response_times.add(elapsed)
+        self._add_query_timings(elapsed, metrics)
 
     def query_interrupt(self, start, metrics):
-        self.query_intrp_times.append(calculate_elapsed(start))
+        elapsed = calculate_elapsed(start)
+        self.query_intrp_times.add(elapsed)
         self._add_queries(self.interrupted_queries, metrics)
-        self._add_query_timings(self.query_intrp_times[-1], metrics)
+        self._add_query_timings(elapsed, metrics)
 
     def query_error(self, start, metrics):
-        self.query_error_times.append(calculate_elapsed(start))
+        elapsed = calculate_elapsed(start)
+        self.query_error_times.add(elapsed)
         self._add_queries(self.errored_queries, metrics)
-        self._add_query_timings(self.query_error_times[-1], metrics)
+        self._add_query_timings(elapsed, metrics)
 
 
 class ServerLoadData:
@@ -1,15 +1,16 @@
 import os
 import math
 import time
-import base64
 import asyncio
 from binascii import hexlify
+from functools import partial
 from pylru import lrucache
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from torba.rpc.jsonrpc import RPCError, JSONRPC
+from torba.rpc.jsonrpc import RPCError, JSONRPC, EncodedResult
 from torba.server.session import ElectrumX, SessionManager
-from torba.server import util
+from torba.server import scheduler, util
+from torba.server.instrumentation import INSTRUMENTS, executor_queue_depth
 
 from lbry.wallet.server.block_processor import LBRYBlockProcessor
 from lbry.wallet.server.db.writer import LBRYDB
@@ -27,11 +28,11 @@ class ResultCacheItem:
         self._result = None
 
     @property
-    def result(self) -> str:
+    def result(self) -> EncodedResult:
         return self._result
 
     @result.setter
-    def result(self, result: str):
+    def result(self, result: EncodedResult):
         self._result = result
         if result is not None:
             self.has_result.set()
@@ -46,11 +47,15 @@ class LBRYSessionManager(SessionManager):
         self.metrics = ServerLoadData()
         self.metrics_loop = None
         self.running = False
-        if self.env.websocket_host is not None and self.env.websocket_port is not None:
+        # Only the block processor process has the admin websocket
+        if self.bp is not None and self.env.websocket_host is not None \
+                and self.env.websocket_port is not None:
             self.websocket = AdminWebSocket(self)
-        self.search_cache = self.bp.search_cache
+        # Session workers have no block processor to clear the caches
+        self.search_cache = self.bp.search_cache if self.bp is not None else {}
         self.search_cache['search'] = lrucache(10000)
         self.search_cache['resolve'] = lrucache(10000)
+        self.search_cache_stats = {name: INSTRUMENTS.cache(name) for name in self.search_cache}
 
     async def process_metrics(self):
         while self.running:
@@ -62,8 +67,23 @@ class LBRYSessionManager(SessionManager):
                 self.websocket.send_message(data)
             await asyncio.sleep(1)
 
+    async def _notify_sessions(self, height, touched):
+        if self.bp is None and height != self.notified_height:
+            for cache in self.search_cache.values():
+                cache.clear()
+        await super()._notify_sessions(height, touched)
+
     async def start_other(self):
         self.running = True
+        # With session workers, queries are only run by the workers
+        if self.bp is None or not self.env.session_workers:
+            self.start_query_executor()
+        if self.websocket is not None:
+            await self.websocket.start()
+        if self.env.track_metrics:
+            self.metrics_loop = asyncio.create_task(self.process_metrics())
+
+    def start_query_executor(self):
         path = os.path.join(self.env.db_dir, 'claims.db')
         args = dict(
             initializer=reader.initializer,
@@ -73,13 +93,13 @@ class LBRYSessionManager(SessionManager):
         if self.env.max_query_workers is not None and self.env.max_query_workers == 0:
             self.query_executor = ThreadPoolExecutor(max_workers=1, **args)
         else:
-            self.query_executor = ProcessPoolExecutor(
-                max_workers=self.env.max_query_workers or max(os.cpu_count(), 4), **args
-            )
-        if self.websocket is not None:
-            await self.websocket.start()
-        if self.env.track_metrics:
-            self.metrics_loop = asyncio.create_task(self.process_metrics())
+            max_workers = self.env.max_query_workers or max(os.cpu_count(), 4)
+            if self.env.session_workers:
+                # Share the cores between the session workers
+                max_workers = max(max_workers // self.env.session_workers, 1)
+            self.query_executor = ProcessPoolExecutor(max_workers=max_workers, **args)
+        INSTRUMENTS.gauge('executor_queue_depth', 'Work items waiting for an executor worker',
+                          partial(executor_queue_depth, self.query_executor), executor='query')
 
     async def stop_other(self):
         self.running = False
@@ -87,20 +107,28 @@ class LBRYSessionManager(SessionManager):
             self.metrics_loop.cancel()
         if self.websocket is not None:
             await self.websocket.stop()
-        self.query_executor.shutdown()
+        if self.query_executor is not None:
+            self.query_executor.shutdown()
 
 
 class LBRYElectrumX(ElectrumX):
     PROTOCOL_MIN = (0, 0)  # temporary, for supporting 0.10 protocol
     max_errors = math.inf  # don't disconnect people for errors! let them happen...
     session_mgr: LBRYSessionManager
+    request_classes = dict(ElectrumX.request_classes, **{
+        'blockchain.transaction.get_height': scheduler.DAEMON,
+        'blockchain.claimtrie.search': scheduler.QUERY,
+        'blockchain.claimtrie.resolve': scheduler.QUERY,
+        'blockchain.claimtrie.getclaimsbyids': scheduler.DAEMON,
+        'blockchain.block.get_server_height': scheduler.CHEAP,
+    })
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # fixme: this is a rebase hack, we need to go through ChainState instead later
         self.daemon = self.session_mgr.daemon
         self.bp: LBRYBlockProcessor = self.session_mgr.bp
-        self.db: LBRYDB = self.bp.db
+        self.db: LBRYDB = self.session_mgr.db
 
     def set_request_handlers(self, ptuple):
         super().set_request_handlers(ptuple)
@@ -147,7 +175,7 @@ class LBRYElectrumX(ElectrumX):
             (result, metrics_data) = result
             metrics.query_response(start, metrics_data)
 
-        return base64.b64encode(result).decode()
+        return result
 
     async def run_and_cache_query(self, query_name, function, kwargs):
         metrics = self.get_metrics_or_placeholder_for_api(query_name)
@@ -159,12 +187,16 @@ class LBRYElectrumX(ElectrumX):
             cache_item = cache[cache_key] = ResultCacheItem()
         elif cache_item.result is not None:
             metrics.cache_response()
+            self.session_mgr.search_cache_stats[query_name].hit()
             return cache_item.result
         async with cache_item.lock:
+            # Waiting for the same query run by another request is a hit
+            self.session_mgr.search_cache_stats[query_name].record(cache_item.result is not None)
             if cache_item.result is None:
-                cache_item.result = await self.run_in_executor(
+                # Encoded once, a cache hit only wraps it in a response
+                cache_item.result = EncodedResult(await self.run_in_executor(
                     query_name, function, kwargs
-                )
+                ))
             else:
                 metrics = self.get_metrics_or_placeholder_for_api(query_name)
                 metrics.cache_response()
@@ -179,6 +211,8 @@ class LBRYElectrumX(ElectrumX):
             return await self.run_and_cache_query('resolve', reader.resolve_to_bytes, urls)
 
     async def get_server_height(self):
+        if self.bp is None:
+            return self.db.db_height
         return self.bp.height
 
     async def transaction_get_height(self, tx_hash):
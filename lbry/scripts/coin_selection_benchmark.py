@@ -0,0 +1,69 @@
+import time
+import random
+from argparse import ArgumentParser
+
+from torba.client.coinselection import CoinSelector, Coin
+from lbry.wallet.dewies import dewies_to_lbc
+
+# fees of spending a pay pubkey hash output and of adding the change output at 50 dewies/byte
+INPUT_FEE = 148 * 50
+CHANGE_FEE = 34 * 50
+
+
+def uniform(rnd):
+    return rnd.randint(10**6, 10**9)
+
+
+def small(rnd):
+    # tips and supports of a publishing wallet, mostly 0.01 to 1 LBC with a long tail
+    return int(rnd.lognormvariate(16, 1.5)) + INPUT_FEE
+
+
+def equal(rnd):
+    return 10**7
+
+
+DISTRIBUTIONS = {'uniform': uniform, 'small': small, 'equal': equal}
+
+
+def make_coins(distribution, count, seed):
+    rnd = random.Random(seed)
+    return [
+        Coin(str(n), amount - INPUT_FEE, INPUT_FEE, rnd.randint(0, 500000))
+        for n, amount in enumerate(distribution(rnd) for _ in range(count))
+    ]
+
+
+def select(coins, target, strategy, time_limit):
+    selector = CoinSelector(target, CHANGE_FEE, seed='benchmark', time_limit=time_limit)
+    start = time.perf_counter()
+    selection = selector.select(list(coins), strategy)
+    return time.perf_counter() - start, selector, selection
+
+
+def main():
+    parser = ArgumentParser(description='Time coin selection of UTXO sets of different sizes and amounts.')
+    parser.add_argument('--utxos', default='100,1000,10000,50000')
+    parser.add_argument('--distributions', default=','.join(DISTRIBUTIONS))
+    parser.add_argument('--strategy', default='standard')
+    parser.add_argument('--time-limit', default=0.5, type=float)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    for name in args.distributions.split(','):
+        for count in map(int, args.utxos.split(',')):
+            coins = make_coins(DISTRIBUTIONS[name], count, args.seed)
+            total = sum(coin.effective_amount for coin in coins)
+            amounts = sorted(coin.effective_amount for coin in coins)
+            # a payment of a typical UTXO, of ten of them and of most of the wallet
+            for target in (amounts[len(amounts) // 2], amounts[len(amounts) // 2] * 10, total * 3 // 4):
+                elapsed, selector, selection = select(coins, target, args.strategy, args.time_limit)
+                change = sum(coin.effective_amount for coin in selection) - target
+                print(f"{name:>8} {count:>7,d} UTXOs, target {dewies_to_lbc(target):>14} LBC: "
+                      f"{elapsed*1000:9.1f}ms {selector.tries:>7,d} tries, "
+                      f"{len(selection):>6,d} inputs, change {dewies_to_lbc(max(change, 0)):>12} LBC"
+                      f"{' (exact)' if selector.exact_match else ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import time
+import asyncio
+from argparse import ArgumentParser
+
+from torba.client.wallet import Wallet
+from lbry.wallet.ledger import MainNetLedger
+from lbry.wallet.transaction import Transaction, Input, Output
+
+
+def make_transaction(pubkey_hashes, inputs):
+    funding = [
+        Transaction().add_outputs([Output.pay_pubkey_hash(10**8 + n, pubkey_hashes[n % len(pubkey_hashes)])])
+        for n in range(inputs)
+    ]
+    return Transaction() \
+        .add_inputs([Input.spend(tx.outputs[0]) for tx in funding]) \
+        .add_outputs([Output.pay_pubkey_hash(10**8 * inputs, pubkey_hashes[0])])
+
+
+async def sign_sequentially(ledger, tx):
+    """ Signing the way it was done before, serializing every preimage on the event loop. """
+    for i, txi in enumerate(tx.inputs):
+        address = ledger.hash160_to_address(txi.txo_ref.txo.script.values['pubkey_hash'])
+        private_key = await ledger.get_private_key_for_address(address)
+        private_key.sign(tx._serialize_for_signature(i))
+
+
+async def timed(coro):
+    """ Run coro and return its duration and the longest the event loop was stalled meanwhile. """
+    stalls = []
+
+    async def ticker():
+        while True:
+            tick = time.perf_counter()
+            await asyncio.sleep(0)
+            stalls.append(time.perf_counter() - tick)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await coro
+    elapsed = time.perf_counter() - start
+    task.cancel()
+    return elapsed, max(stalls)
+
+
+async def run(args):
+    ledger = MainNetLedger({
+        'db': MainNetLedger.database_class(':memory:'),
+        'headers': MainNetLedger.headers_class(':memory:'),
+    })
+    await ledger.db.open()
+    account = ledger.account_class.generate(ledger, Wallet(), "benchmark")
+    await account.ensure_address_gap()
+    addresses = await account.receiving.get_addresses(limit=args.addresses)
+    pubkey_hashes = [ledger.address_to_hash160(address) for address in addresses]
+    try:
+        for inputs in map(int, args.inputs.split(',')):
+            tx = make_transaction(pubkey_hashes, inputs)
+            before, before_stall = await timed(sign_sequentially(ledger, tx))
+            after, after_stall = await timed(tx.sign([account]))
+            print(f"{inputs:>6,d} inputs: sequential {before*1000:9.1f}ms (loop stalled {before_stall*1000:8.1f}ms), "
+                  f"sign {after*1000:9.1f}ms (loop stalled {after_stall*1000:6.1f}ms), "
+                  f"{before/after:5.1f}x")
+    finally:
+        await ledger.db.close()
+
+
+def main():
+    parser = ArgumentParser(description='Time signing transactions with many inputs.')
+    parser.add_argument('--inputs', default='1,10,100,500,1000')
+    parser.add_argument('--addresses', default=20, type=int)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
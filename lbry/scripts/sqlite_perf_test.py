@@ -28,7 +28,7 @@ async def run_times(executor, iterations, show=True):
             ]
         }
     ) for _ in range(iterations)))
-    timings = [r[1]['execute_query'][0]['total'] for r in timings]
+    timings = [r[1]['totals']['execute_query'] for r in timings]
     total = int((time.perf_counter() - start) * 100)
     if show:
         avg = sum(timings)/len(timings)
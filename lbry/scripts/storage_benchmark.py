@@ -0,0 +1,93 @@
+import time
+import random
+import shutil
+import tempfile
+from hashlib import sha256
+from struct import pack, unpack
+from argparse import ArgumentParser
+
+from torba.server.storage import db_class
+
+
+def synthetic_chain(utxo_count, seed):
+    """Yield (tx_hash, tx_idx, tx_num, hashX, value) for a deterministic chain."""
+    rnd = random.Random(seed)
+    hashXs = [sha256(pack('<I', n)).digest()[:11] for n in range(max(utxo_count // 20, 1))]
+    tx_num = 0
+    count = 0
+    while count < utxo_count:
+        tx_hash = sha256(pack('<QI', seed, tx_num)).digest()
+        for tx_idx in range(min(rnd.randint(1, 4), utxo_count - count)):
+            yield tx_hash, tx_idx, tx_num, rnd.choice(hashXs), rnd.randint(1, 10**10)
+            count += 1
+        tx_num += 1
+
+
+def flush(db, chain, batch_size):
+    """Write the chain in batches using the UTXO DB key layout, return UTXOs/sec."""
+    start = time.perf_counter()
+    utxos = iter(chain)
+    written = 0
+    while True:
+        with db.write_batch() as batch:
+            n = 0
+            for tx_hash, tx_idx, tx_num, hashX, value in utxos:
+                suffix = pack('<HI', tx_idx, tx_num)
+                batch.put(b'h' + tx_hash[:4] + suffix, hashX)
+                batch.put(b'u' + hashX + suffix, pack('<Q', value))
+                n += 1
+                if n == batch_size:
+                    break
+        written += n
+        if n < batch_size:
+            break
+    return written / (time.perf_counter() - start)
+
+
+def lookup(db, prevouts):
+    """Look up prevouts the way DB.lookup_utxos does, return lookups/sec and hits."""
+    start = time.perf_counter()
+    found = 0
+    with db.snapshot() as snapshot:
+        for tx_hash, tx_idx in prevouts:
+            idx_packed = pack('<H', tx_idx)
+            for db_key, hashX in snapshot.iterator(prefix=b'h' + tx_hash[:4] + idx_packed):
+                value = snapshot.get(b'u' + hashX + db_key[-6:])
+                if value:
+                    unpack('<Q', value)
+                    found += 1
+                break
+    return len(prevouts) / (time.perf_counter() - start), found
+
+
+def main():
+    parser = ArgumentParser(description='Compare UTXO DB throughput of storage engines.')
+    parser.add_argument('--engines', default='leveldb,lmdb')
+    parser.add_argument('--utxos', default=500000, type=int)
+    parser.add_argument('--batch', default=50000, type=int)
+    parser.add_argument('--lookups', default=100000, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    existing = [(tx_hash, tx_idx) for tx_hash, tx_idx, *_ in synthetic_chain(args.utxos, args.seed)]
+    prevouts = [rnd.choice(existing) for _ in range(args.lookups // 2)]
+    # half of the lookups are for prevouts that are not in the DB
+    prevouts += [(sha256(pack('<I', n)).digest(), 0) for n in range(args.lookups - len(prevouts))]
+    rnd.shuffle(prevouts)
+
+    for engine in args.engines.split(','):
+        db_dir = tempfile.mkdtemp()
+        try:
+            db = db_class(db_dir, engine)('utxo', True)
+            flush_rate = flush(db, synthetic_chain(args.utxos, args.seed), args.batch)
+            lookup_rate, found = lookup(db, prevouts)
+            db.close()
+        finally:
+            shutil.rmtree(db_dir)
+        print(f"{engine:>8}: flushed {flush_rate:,.0f} UTXOs/sec, "
+              f"looked up {lookup_rate:,.0f} prevouts/sec ({found:,d} found)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import asyncio
+import threading
+from hashlib import sha256
+from struct import pack
+from concurrent.futures import ProcessPoolExecutor
+
+from torba.client.constants import COIN
+from torba.server.block_processor import BlockProcessor, ChainError, Prefetcher
+from torba.server.util import pack_varint
+from torba.testcase import AsyncioTestCase
+
+from lbry.wallet.server.coin import LBCRegTest
+from lbry.wallet.transaction import Transaction, Input, Output
+
+
+class FakeEnv:
+    coin = LBCRegTest
+    prefetch_workers = 0
+    block_filters = False
+    cache_MB = 1200
+
+
+class FakeHistory:
+
+    def __init__(self):
+        self.unflushed = []
+
+    def freeze_unflushed(self):
+        unflushed, self.unflushed = self.unflushed, []
+        return unflushed
+
+
+class FakeDB:
+    """Records flushes, each one held until it is released."""
+
+    def __init__(self):
+        self.history = FakeHistory()
+        self.flushes = []
+        self.events = []
+        self.release = threading.Event()
+        self.flushing = threading.Event()
+        self.first_sync = False
+        self.db_height = 0
+        self.db_tip = b'\x00' * 32
+        self.db_tx_count = 0
+
+    def flush_dbs(self, flush_data, flush_utxos, estimate_txs_remaining):
+        self.flushing.set()
+        self.release.wait()
+        self.flushes.append((flush_data, flush_utxos))
+        self.events.append('flush')
+
+    def may_have_utxo(self, key):
+        return False
+
+    def close(self):
+        self.events.append('close')
+
+    async def open_for_sync(self):
+        pass
+
+    def read_filter_header(self, height):
+        return None
+
+
+def utxo(n):
+    tx_hash = sha256(pack('<I', n)).digest()
+    key = tx_hash + pack('<H', 0)
+    value = sha256(b'hashX' + key).digest()[:11] + pack('<I', n) + pack('<Q', n * 1000)
+    return tx_hash, key, value
+
+
+class TestBackgroundFlush(AsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = FakeDB()
+        self.bp = BlockProcessor(FakeEnv(), self.db, None, None)
+        self.bp.height = 0
+        self.bp.tx_count = 0
+        self.bp.tip = b'\x00' * 32
+        self.addCleanup(self.db.release.set)
+
+    async def wait_until_flushing(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.db.flushing.wait)
+
+    async def test_spend_utxo_being_flushed(self):
+        tx_hash, key, value = utxo(1)
+        self.bp.utxo_cache[key] = value
+        flush = await self.bp.flush_in_background(True)
+        await self.wait_until_flushing()
+
+        # the next block spends it while the generation holding it is written out
+        self.assertEqual(self.bp.utxo_cache, {})
+        self.assertEqual(self.bp.spend_utxo(tx_hash, 0), value)
+        hashX, suffix = value[:-12], pack('<H', 0) + value[-12:-8]
+        self.assertEqual(self.bp.db_deletes, [b'h' + tx_hash[:4] + suffix, b'u' + hashX + suffix])
+
+        self.db.release.set()
+        await flush
+        self.assertEqual(self.bp.flushing_utxos, {})
+        first, flush_utxos = self.db.flushes[0]
+        self.assertTrue(flush_utxos)
+        self.assertEqual(first.adds, {key: value})
+        self.assertEqual(first.deletes, [])
+
+        # and the deletes for it go out with the next flush, after its adds
+        await self.bp.flush(True)
+        second, _ = self.db.flushes[1]
+        self.assertEqual(second.deletes, [b'h' + tx_hash[:4] + suffix, b'u' + hashX + suffix])
+        self.assertEqual(self.bp.db_deletes, [])
+
+        # once flushed it is only on disk, which no longer has it either
+        with self.assertRaises(ChainError):
+            self.bp.spend_utxo(tx_hash, 0)
+
+    async def test_flush_in_order_on_shutdown(self):
+        started = asyncio.Event()
+
+        async def run_forever(*args):
+            started.set()
+            await asyncio.Future()
+
+        self.bp.prefetcher.main_loop = run_forever
+        self.bp._process_prefetched_blocks = run_forever
+        task = asyncio.ensure_future(self.bp.fetch_and_process_blocks(asyncio.Event()))
+        await started.wait()
+
+        _, key1, value1 = utxo(1)
+        self.bp.utxo_cache[key1] = value1
+        await self.bp.flush_in_background(True)
+        await self.wait_until_flushing()
+        # advanced while the first flush is in progress
+        _, key2, value2 = utxo(2)
+        self.bp.utxo_cache[key2] = value2
+
+        task.cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(self.db.events, [])
+        self.db.release.set()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        self.assertEqual(self.db.events, ['flush', 'flush', 'close'])
+        self.assertEqual([flush_data.adds for flush_data, _ in self.db.flushes], [{key1: value1}, {key2: value2}])
+        self.assertEqual(self.bp.flushing_utxos, {})
+        self.assertTrue(self.bp.flush_executor._shutdown)
+
+
+class FakeBlockDaemon:
+
+    def __init__(self, raw_blocks):
+        self.raw_blocks_by_hash = raw_blocks
+
+    async def raw_blocks(self, hex_hashes):
+        return [self.raw_blocks_by_hash[hex_hash] for hex_hash in hex_hashes]
+
+
+def make_raw_blocks(count, txs_per_block):
+    funding = Transaction().add_outputs([Output.pay_pubkey_hash(COIN, bytes(20))])
+    raw_blocks, tx_hashes = {}, {}
+    for height in range(count):
+        txs = []
+        for n in range(txs_per_block):
+            txs.append(
+                Transaction()
+                .add_inputs([Input.spend(funding.outputs[0])])
+                .add_outputs([Output.pay_pubkey_hash(COIN - height - n, pack('<II', height, n) + bytes(12))])
+            )
+            funding = txs[-1]
+        header = sha256(pack('<I', height)).digest() * 3 + bytes(LBCRegTest.BASIC_HEADER_SIZE - 96)
+        raw_blocks[f'{height:064x}'] = header + pack_varint(len(txs)) + b''.join(tx.raw for tx in txs)
+        tx_hashes[f'{height:064x}'] = [tx.hash for tx in txs]
+    return raw_blocks, tx_hashes
+
+
+class TestDeserializeBlocks(AsyncioTestCase):
+
+    async def test_deserialized_in_process_pool_same_as_in_process(self):
+        raw_blocks, tx_hashes = make_raw_blocks(5, 20)
+        hex_hashes = list(raw_blocks)
+        daemon = FakeBlockDaemon(raw_blocks)
+
+        in_process = Prefetcher(daemon, LBCRegTest, asyncio.Event())
+        expected, expected_size = await in_process._fetch_blocks(1, hex_hashes)
+
+        executor = ProcessPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        pooled = Prefetcher(daemon, LBCRegTest, asyncio.Event(), executor)
+        blocks, size = await pooled._fetch_blocks(1, hex_hashes)
+
+        self.assertEqual(size, expected_size)
+        self.assertEqual(size, sum(len(raw_block) for raw_block in raw_blocks.values()))
+        self.assertEqual(len(blocks), 5)
+        for block, expected_block, hex_hash in zip(blocks, expected, hex_hashes):
+            self.assertEqual(block.raw, raw_blocks[hex_hash])
+            self.assertEqual(block.header, expected_block.header)
+            self.assertEqual(block.transactions, expected_block.transactions)
+            self.assertEqual([tx_hash for tx, tx_hash in block.transactions], tx_hashes[hex_hash])
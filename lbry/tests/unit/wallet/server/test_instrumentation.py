@@ -0,0 +1,68 @@
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from torba.server.instrumentation import Histogram, Instruments, MetricsServer, executor_queue_depth
+from torba.testcase import AsyncioTestCase
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class TestInstruments(AsyncioTestCase):
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        self.assertEqual(0.0, histogram.percentile(0.5))
+        for _ in range(90):
+            histogram.observe(0.001)
+        for _ in range(10):
+            histogram.observe(1.0)
+        histogram.observe(1000)
+        self.assertEqual(101, histogram.count)
+        self.assertAlmostEqual(0.001, histogram.percentile(0.5), delta=0.0005)
+        self.assertAlmostEqual(1.0, histogram.percentile(0.95), delta=0.5)
+        self.assertLess(histogram.percentile(1.0), 1000)
+
+    def test_render(self):
+        instruments = Instruments()
+        instruments.histogram('request_seconds', 'Latency', method='server.ping').observe(0.01)
+        instruments.histogram('request_seconds', 'Latency', method='server.ping').observe(0.02)
+        cache = instruments.cache('history')
+        cache.record(True)
+        cache.record(False)
+        cache.hit()
+        instruments.gauge('queue', 'Queue depth', lambda: 3)
+        lines = instruments.render().splitlines()
+        self.assertIn('# TYPE request_seconds histogram', lines)
+        self.assertIn('request_seconds_bucket{method="server.ping",le="+Inf"} 2', lines)
+        self.assertIn('request_seconds_count{method="server.ping"} 2', lines)
+        self.assertIn('cache_lookups_total{cache="history",result="hit"} 2', lines)
+        self.assertIn('cache_lookups_total{cache="history",result="miss"} 1', lines)
+        self.assertIn('queue 3', lines)
+
+    def test_executor_queue_depth(self):
+        executor = ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        blocked = threading.Event()
+        executor.submit(blocked.wait)
+        for _ in range(3):
+            executor.submit(int)
+        self.assertEqual(3, executor_queue_depth(executor))
+        blocked.set()
+
+    async def test_metrics_served(self):
+        instruments = Instruments()
+        instruments.counter('flushes_total', 'Flushes').inc()
+        server = MetricsServer('localhost', unused_port(), instruments)
+        await server.start()
+        self.addCleanup(server.stop)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f'http://localhost:{server.port}/metrics') as response:
+                self.assertEqual(200, response.status)
+                self.assertIn('flushes_total 1', (await response.text()).splitlines())
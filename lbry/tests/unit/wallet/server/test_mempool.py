@@ -0,0 +1,206 @@
+import asyncio
+import unittest
+
+from torba.client.basetransaction import TXORef
+from torba.client.constants import COIN, NULL_HASH32
+from torba.client.hash import TXRefImmutable
+from torba.server.daemon import ZMQFeed
+from torba.server.mempool import MemPool, MemPoolAPI
+from torba.testcase import AsyncioTestCase
+
+from lbry.wallet.server.coin import LBCRegTest
+from lbry.wallet.transaction import Transaction, Input, Output
+
+try:
+    import zmq
+    import zmq.asyncio
+except ImportError:
+    zmq = None
+
+
+class FakeDaemon(MemPoolAPI):
+
+    def __init__(self):
+        self.mempool = {}
+        self.utxos = {}
+        self.touched = []
+        self.refreshes = 0
+        self.polling = None
+
+    async def height(self):
+        return 1
+
+    def cached_height(self):
+        return 1
+
+    async def mempool_hashes(self):
+        self.refreshes += 1
+        hashes = list(self.mempool)
+        if self.polling is not None:
+            await self.polling()
+        return hashes
+
+    async def raw_transactions(self, hex_hashes):
+        return [self.mempool.get(hex_hash) for hex_hash in hex_hashes]
+
+    async def lookup_utxos(self, prevouts):
+        return [self.utxos.get(prevout) for prevout in prevouts]
+
+    async def on_mempool(self, touched, height):
+        self.touched.append(touched)
+
+
+class FakeFeed:
+    """Publishes what it is given, like a daemon's ZMQ feed."""
+
+    connected = True
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def publish(self, *messages):
+        for message in messages:
+            self.queue.put_nowait(message)
+
+    async def messages(self):
+        while True:
+            yield await self.queue.get()
+
+
+def hashX(tx, position=0):
+    return LBCRegTest.hashX_from_script(tx.outputs[position].script.source)
+
+
+class TestMemPoolFeed(AsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.daemon = FakeDaemon()
+        self.feed = FakeFeed()
+        self.mempool = MemPool(LBCRegTest, self.daemon, refresh_secs=60, feed=self.feed)
+        self.task = asyncio.ensure_future(self.mempool.keep_synchronized(asyncio.Event()))
+        self.addCleanup(self.task.cancel)
+        await self.wait_for(lambda: self.daemon.touched)
+        # a confirmed output to spend
+        self.funding = Transaction().add_outputs([Output.pay_pubkey_hash(10*COIN, NULL_HASH32)])
+        self.daemon.utxos[(self.funding.hash, 0)] = (hashX(self.funding), 10*COIN)
+        self.parent = Transaction() \
+            .add_inputs([Input.spend(self.funding.outputs[0])]) \
+            .add_outputs([Output.pay_pubkey_hash(9*COIN, b'parent'.ljust(20, b'\0'))])
+        self.child = Transaction() \
+            .add_inputs([Input.spend(self.parent.outputs[0])]) \
+            .add_outputs([Output.pay_pubkey_hash(8*COIN, b'child'.ljust(20, b'\0'))])
+
+    async def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('timed out')
+
+    async def test_pushed_txs_accepted_in_dependency_order(self):
+        self.feed.publish((b'rawtx', self.child.raw), (b'rawtx', self.parent.raw))
+        await self.wait_for(lambda: len(self.mempool.txs) == 2)
+        self.assertEqual(1, self.daemon.refreshes)
+        self.assertEqual({hashX(self.funding), hashX(self.parent), hashX(self.child)},
+                         self.daemon.touched[-1])
+        self.assertEqual(8*COIN, await self.mempool.balance_delta(hashX(self.child)))
+        self.assertEqual(0, await self.mempool.balance_delta(hashX(self.parent)))
+        self.assertEqual(COIN, self.mempool.txs[self.child.hash].fee)
+
+    async def test_unknown_parent_left_for_refresh(self):
+        self.feed.publish((b'rawtx', self.child.raw))
+        await self.wait_for(lambda: len(self.daemon.touched) == 2)
+        self.assertEqual({}, self.mempool.txs)
+        self.daemon.mempool = {self.parent.id: self.parent.raw, self.child.id: self.child.raw}
+        # a new block refreshes the mempool without waiting for refresh_secs
+        self.feed.publish((b'hashblock', NULL_HASH32))
+        await self.wait_for(lambda: len(self.mempool.txs) == 2)
+        self.assertEqual(2, self.daemon.refreshes)
+
+    async def test_refresh_keeps_txs_pushed_while_polling(self):
+        async def push_parent():
+            self.feed.publish((b'rawtx', self.parent.raw))
+            await self.wait_for(lambda: self.mempool.txs)
+        self.daemon.polling = push_parent
+        self.feed.publish((ZMQFeed.MISSED, b'rawtx'))
+        await self.wait_for(lambda: self.daemon.refreshes == 2)
+        await self.wait_for(lambda: len(self.daemon.touched) == 3)
+        self.assertIn(self.parent.hash, self.mempool.txs)
+
+    async def test_block_txs_pushed_while_polling_dropped(self):
+        self.feed.publish((b'rawtx', self.parent.raw))
+        await self.wait_for(lambda: self.mempool.txs)
+        coinbase = Transaction() \
+            .add_inputs([Input(TXORef(TXRefImmutable.from_hash(NULL_HASH32, -1), 0xffffffff), b'\x01\x02')]) \
+            .add_outputs([Output.pay_pubkey_hash(COIN, b'miner'.ljust(20, b'\0'))])
+
+        # a block with the parent and the child, which the mempool never saw,
+        # comes in while the daemon is polled: the daemon pushes its txs then its hash
+        async def push_block():
+            self.daemon.polling = None
+            self.feed.publish((b'rawtx', coinbase.raw), (b'rawtx', self.parent.raw),
+                              (b'rawtx', self.child.raw), (b'hashblock', NULL_HASH32))
+            await self.wait_for(lambda: self.child.hash in self.mempool.txs)
+        self.daemon.polling = push_block
+        self.feed.publish((ZMQFeed.MISSED, b'rawtx'))
+        await self.wait_for(lambda: self.daemon.refreshes == 3)
+        await self.wait_for(lambda: not self.mempool.txs)
+        self.assertFalse(any(hashX(coinbase) in touched for touched in self.daemon.touched))
+        self.assertEqual({}, dict(self.mempool.hashXs))
+
+    async def test_summaries_and_histogram_follow_mempool(self):
+        self.feed.publish((b'rawtx', self.parent.raw), (b'rawtx', self.child.raw))
+        await self.wait_for(lambda: len(self.mempool.txs) == 2)
+        summary, = await self.mempool.transaction_summaries(hashX(self.child))
+        self.assertTrue(summary.has_unconfirmed_inputs)
+        utxo, = await self.mempool.unordered_UTXOs(hashX(self.child))
+        self.assertEqual(8*COIN, utxo.value)
+        size = len(self.child.raw)
+        self.assertEqual(size, len(self.parent.raw))
+        self.assertEqual({COIN // size: 2 * size}, dict(self.mempool.fee_histogram))
+        # the parent gets in a block
+        self.daemon.mempool = {self.child.id: self.child.raw}
+        self.feed.publish((b'hashblock', NULL_HASH32))
+        await self.wait_for(lambda: len(self.mempool.txs) == 1)
+        self.assertIn(hashX(self.child), self.daemon.touched[-1])
+        summary, = await self.mempool.transaction_summaries(hashX(self.child))
+        self.assertFalse(summary.has_unconfirmed_inputs)
+        # the child still spends the parent's output
+        self.assertEqual(-9*COIN, await self.mempool.balance_delta(hashX(self.parent)))
+        self.assertEqual({COIN // size: size}, dict(self.mempool.fee_histogram))
+        self.assertEqual({}, dict(self.mempool.spenders))
+        self.daemon.mempool = {}
+        self.feed.publish((b'hashblock', NULL_HASH32))
+        await self.wait_for(lambda: not self.mempool.txs)
+        self.assertEqual({}, dict(self.mempool.fee_histogram))
+        self.assertEqual([], await self.mempool.unordered_UTXOs(hashX(self.child)))
+        self.assertEqual({}, self.mempool.summaries)
+
+
+@unittest.skipIf(zmq is None, 'pyzmq is not installed')
+class TestZMQFeed(AsyncioTestCase):
+
+    async def test_messages_and_missed_sequences(self):
+        context = zmq.asyncio.Context()
+        self.addCleanup(context.term)
+        publisher = context.socket(zmq.PUB)
+        self.addCleanup(publisher.close, 0)
+        port = publisher.bind_to_random_port('tcp://127.0.0.1')
+        feed = ZMQFeed(f'tcp://127.0.0.1:{port}')
+        messages = feed.messages()
+        self.addCleanup(messages.aclose)
+        received = asyncio.ensure_future(messages.__anext__())
+        # subscriptions propagate asynchronously, publish until one arrives
+        while not received.done():
+            await publisher.send_multipart([b'rawtx', b'first', (0).to_bytes(4, 'little')])
+            await asyncio.sleep(0.05)
+        self.assertEqual((b'rawtx', b'first'), received.result())
+        self.assertTrue(feed.connected)
+        last = feed.sequences[b'rawtx']
+        await publisher.send_multipart([b'rawtx', b'next', (last + 1).to_bytes(4, 'little')])
+        self.assertEqual((b'rawtx', b'next'), await messages.__anext__())
+        await publisher.send_multipart([b'hashblock', b'block', (7).to_bytes(4, 'little')])
+        self.assertEqual((b'hashblock', b'block'), await messages.__anext__())
+        await publisher.send_multipart([b'rawtx', b'gap', (last + 5).to_bytes(4, 'little')])
+        self.assertEqual((ZMQFeed.MISSED, b'rawtx'), await messages.__anext__())
+        self.assertEqual((b'rawtx', b'gap'), await messages.__anext__())
@@ -1,6 +1,6 @@
 import time
 import unittest
-from lbry.wallet.server.metrics import ServerLoadData, calculate_avg_percentiles
+from lbry.wallet.server.metrics import ServerLoadData, Sketch, calculate_avg_percentiles
 
 
 class TestPercentileCalculation(unittest.TestCase):
@@ -16,6 +16,32 @@ class TestPercentileCalculation(unittest.TestCase):
             list(range(1, 101))), (50, 1, 5, 25, 50, 75, 95, 100))
 
 
+class TestSketch(unittest.TestCase):
+
+    def sketch(self, values):
+        sketch = Sketch()
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+    def test_exact_under_64ms(self):
+        for data in ([], [1], [1, 2], [4, 1, 2, 3], [1, 2, 3, 4, 5, 6], list(range(1, 64))):
+            self.assertEqual(calculate_avg_percentiles(list(data)), self.sketch(data).avg_percentiles())
+
+    def test_bounded_error_and_size(self):
+        data = [int(1.07 ** n) for n in range(200)]
+        sketch = self.sketch(data)
+        for got, exact in zip(sketch.avg_percentiles(), calculate_avg_percentiles(list(data))):
+            self.assertAlmostEqual(exact, got, delta=exact * 0.035)
+        self.assertLessEqual(len(sketch.buckets), 704)
+        self.assertEqual(Sketch.bucket(10**12), Sketch.bucket(10**15))
+
+    def test_merge(self):
+        merged = self.sketch([5, 500])
+        merged.merge(Sketch.from_dict(self.sketch([1, 100, 5000]).to_dict()))
+        self.assertEqual(self.sketch([1, 5, 100, 500, 5000]).to_dict(), merged.to_dict())
+
+
 class TestCollectingMetrics(unittest.TestCase):
 
     def test_happy_path(self):
@@ -26,17 +52,20 @@ class TestCollectingMetrics(unittest.TestCase):
         search.start()
         search.cache_response()
         search.cache_response()
-        metrics = {
-            'search': [{'total': 40}],
-            'execute_query': [
-                {'total': 20},
-                {'total': 10}
-            ]
-        }
+        def reported(sql_times, sql=None):
+            # as reported by reader.reports_metrics()
+            sketch = Sketch()
+            for sql_time in sql_times:
+                sketch.add(sql_time)
+            return {
+                'sketches': {'search': {'count': 1, 'sum': 40, 'min': 40, 'max': 40, 'buckets': {40: 1}},
+                             'execute_query': sketch.to_dict()},
+                'totals': {'search': 40, 'execute_query': sum(sql_times)},
+                'sql': sql
+            }
         for x in range(5):
-            search.query_response(time.perf_counter() - 0.055 + 0.001*x, metrics)
-        metrics['execute_query'][0]['total'] = 10
-        metrics['execute_query'][0]['sql'] = "select lots, of, stuff FROM claim where something=1"
+            search.query_response(time.perf_counter() - 0.055 + 0.001*x, reported([20, 10]))
+        metrics = reported([10, 10], "select lots, of, stuff FROM claim where something=1")
         search.query_interrupt(time.perf_counter() - 0.050, metrics)
         search.query_error(time.perf_counter() - 0.050, metrics)
         search.query_error(time.perf_counter() - 0.052, {})
@@ -0,0 +1,62 @@
+import asyncio
+
+from torba.server import scheduler
+from torba.server.scheduler import RequestScheduler
+from torba.testcase import AsyncioTestCase
+
+
+class Session:
+
+    def __init__(self, request_weight=1):
+        self.request_weight = request_weight
+
+
+class TestRequestScheduler(AsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.scheduler = RequestScheduler({scheduler.DISK: 1, scheduler.CHEAP: 1})
+        self.served = []
+        self.release = asyncio.Event()
+
+    async def request(self, session, name, cost_class=scheduler.DISK):
+        async with self.scheduler.slot(session, cost_class):
+            self.served.append(name)
+            await self.release.wait()
+
+    async def serve_all(self, tasks):
+        for _ in range(len(tasks)):
+            await asyncio.sleep(0)
+            self.release.set()
+            self.release.clear()
+            await asyncio.sleep(0)
+        await asyncio.wait(tasks)
+
+    async def test_round_robin_across_sessions(self):
+        flood = Session()
+        other = Session()
+        tasks = [asyncio.ensure_future(self.request(flood, f'f{n}')) for n in range(4)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.ensure_future(self.request(other, f'o{n}')) for n in range(2)]
+        await asyncio.sleep(0)
+        self.assertEqual({'active': 1, 'queued': 5, 'max': 1, 'served': 1, 'waited': 5},
+                         self.scheduler.info()[scheduler.DISK])
+        # a cheap request isn't held back by the flood
+        cheap = asyncio.ensure_future(self.request(flood, 'cheap', scheduler.CHEAP))
+        await asyncio.sleep(0)
+        self.assertEqual(['f0', 'cheap'], self.served)
+        await self.serve_all(tasks + [cheap])
+        self.assertEqual(['f0', 'cheap', 'f1', 'o0', 'f2', 'o1', 'f3'], self.served)
+        self.assertEqual(0, self.scheduler.info()[scheduler.DISK]['active'])
+
+    async def test_weights_and_cancelled_requests(self):
+        heavy = Session(request_weight=2)
+        light = Session()
+        tasks = [asyncio.ensure_future(self.request(light, f'l{n}')) for n in range(4)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.ensure_future(self.request(heavy, f'h{n}')) for n in range(4)]
+        await asyncio.sleep(0)
+        tasks[2].cancel()
+        await self.serve_all(tasks)
+        self.assertEqual(['l0', 'l1', 'h0', 'h1', 'l3', 'h2', 'h3'], self.served)
+        self.assertEqual(0, self.scheduler.info()[scheduler.DISK]['active'])
+        self.assertEqual(0, self.scheduler.info()[scheduler.DISK]['queued'])
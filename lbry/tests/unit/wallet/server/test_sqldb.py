@@ -424,6 +424,16 @@ class TestClaimtrie(TestSQLDB):
         f.step(other3, new_hash)
         self.assertEqual('#abcdef0123456789beef', f.finalize())
 
+    def test_search_reports_metrics(self):
+        self.advance(1, [self.get_stream('Claim A', COIN)])
+        reader.ctx.get().is_tracking_metrics = True
+        _, metrics = reader.search_to_bytes({'name': 'Claim A'})
+        self.assertTrue({'search', 'execute_query'}.issubset(metrics['sketches']))
+        queries = metrics['sketches']['execute_query']
+        self.assertEqual(metrics['totals']['execute_query'], queries['sum'])
+        self.assertGreaterEqual(metrics['totals']['search'], queries['sum'])
+        self.assertIsNone(metrics['sql'])
+
 
 class TestTrending(TestSQLDB):
 
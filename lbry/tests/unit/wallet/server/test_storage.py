@@ -0,0 +1,115 @@
+import shutil
+import tempfile
+import unittest
+
+from torba.server.storage import db_class
+
+
+class StorageTestMixin:
+
+    engine = None
+
+    def setUp(self):
+        try:
+            self.db_class = db_class(None, self.engine)
+        except ImportError:
+            raise unittest.SkipTest(f'{self.engine} is not installed')
+        self.db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.db_dir)
+        self.db = self.db_class.func(self.db_dir, 'db', False)
+        self.addCleanup(lambda: self.db.close())
+
+    def test_put_get(self):
+        self.db.put(b'abc', b'xyz')
+        self.assertEqual(self.db.get(b'abc'), b'xyz')
+        self.assertIsNone(self.db.get(b'abd'))
+
+    def test_batch(self):
+        self.db.put(b'a', b'1')
+        with self.db.write_batch() as batch:
+            batch.put(b'a', b'2')
+            batch.put(b'b', b'3')
+            batch.delete(b'a')
+        self.assertIsNone(self.db.get(b'a'))
+        self.assertEqual(self.db.get(b'b'), b'3')
+
+    def test_batch_aborted_by_exception(self):
+        with self.assertRaises(ValueError):
+            with self.db.write_batch() as batch:
+                batch.put(b'a', b'1')
+                raise ValueError
+        self.assertIsNone(self.db.get(b'a'))
+
+    def fill(self):
+        for key in (b'a', b'ab', b'abc', b'abd', b'ac', b'b', b'ba'):
+            self.db.put(key, key.upper())
+
+    def test_iterator(self):
+        self.fill()
+        self.assertEqual(list(self.db.iterator()), [
+            (b'a', b'A'), (b'ab', b'AB'), (b'abc', b'ABC'), (b'abd', b'ABD'),
+            (b'ac', b'AC'), (b'b', b'B'), (b'ba', b'BA')
+        ])
+        self.assertEqual(list(self.db.iterator(prefix=b'ab')), [
+            (b'ab', b'AB'), (b'abc', b'ABC'), (b'abd', b'ABD')
+        ])
+        self.assertEqual(list(self.db.iterator(prefix=b'c')), [])
+
+    def test_iterator_reverse(self):
+        self.fill()
+        self.assertEqual(list(self.db.iterator(reverse=True)), [
+            (b'ba', b'BA'), (b'b', b'B'), (b'ac', b'AC'), (b'abd', b'ABD'),
+            (b'abc', b'ABC'), (b'ab', b'AB'), (b'a', b'A')
+        ])
+        self.assertEqual(list(self.db.iterator(prefix=b'ab', reverse=True)), [
+            (b'abd', b'ABD'), (b'abc', b'ABC'), (b'ab', b'AB')
+        ])
+        # the prefix is the last of the keys
+        self.assertEqual(list(self.db.iterator(prefix=b'b', reverse=True)), [
+            (b'ba', b'BA'), (b'b', b'B')
+        ])
+        self.assertEqual(list(self.db.iterator(prefix=b'\xff', reverse=True)), [])
+
+    def test_iterator_reverse_prefix_of_ff(self):
+        self.db.put(b'\xff\xff', b'1')
+        self.db.put(b'\xff\xff\x01', b'2')
+        self.db.put(b'\xfe', b'3')
+        self.assertEqual(list(self.db.iterator(prefix=b'\xff', reverse=True)), [
+            (b'\xff\xff\x01', b'2'), (b'\xff\xff', b'1')
+        ])
+
+    def test_snapshot_isolated_from_later_writes(self):
+        self.fill()
+        with self.db.snapshot() as snapshot:
+            self.db.put(b'ab', b'changed')
+            self.db.put(b'abe', b'ABE')
+            with self.db.write_batch() as batch:
+                batch.delete(b'abc')
+            self.assertEqual(bytes(snapshot.get(b'ab')), b'AB')
+            self.assertIsNone(snapshot.get(b'abe'))
+            self.assertEqual(
+                [(bytes(key), bytes(value)) for key, value in snapshot.iterator(prefix=b'ab')],
+                [(b'ab', b'AB'), (b'abc', b'ABC'), (b'abd', b'ABD')]
+            )
+        self.assertEqual(list(self.db.iterator(prefix=b'ab')), [
+            (b'ab', b'changed'), (b'abd', b'ABD'), (b'abe', b'ABE')
+        ])
+
+    def test_reopen(self):
+        self.db.put(b'a', b'1')
+        self.db.close()
+        self.db = self.db_class.func(self.db_dir, 'db', False)
+        self.assertFalse(self.db.is_new)
+        self.assertEqual(self.db.get(b'a'), b'1')
+
+
+class TestLevelDB(StorageTestMixin, unittest.TestCase):
+    engine = 'leveldb'
+
+
+class TestRocksDB(StorageTestMixin, unittest.TestCase):
+    engine = 'rocksdb'
+
+
+class TestLMDB(StorageTestMixin, unittest.TestCase):
+    engine = 'lmdb'
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+
+from torba.server.bloom import BloomFilter
+from torba.server.db import DB, FlushData
+from torba.testcase import AsyncioTestCase
+
+from lbry.wallet.server.coin import LBCRegTest
+
+
+def utxo(n):
+    tx_hash = os.urandom(32)
+    # key: tx_hash + tx_idx, value: hashX + tx_num + value
+    return tx_hash + (n % 3).to_bytes(2, 'little'), os.urandom(11) + n.to_bytes(4, 'little') + bytes(8)
+
+
+class TestBloomFilter(AsyncioTestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter.for_capacity(1000)
+        keys = [os.urandom(6) for _ in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(os.urandom(6) in bloom for _ in range(10000))
+        self.assertLess(false_positives, 100)
+        self.assertFalse(bloom.is_full())
+
+
+class TestUTXOFilter(AsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.db_dir)
+        self.env = SimpleNamespace(
+            coin=LBCRegTest, db_dir=self.db_dir, db_engine='leveldb', reorg_limit=10, cache_MB=10, utxo_filter=True
+        )
+        self.db = await self.open_db()
+
+    async def open_db(self):
+        db = DB(self.env)
+        await db.open_for_sync()
+        return db
+
+    def flush_utxos(self, db, adds):
+        flush_data = FlushData(-1, 0, [], [], [], dict(adds), [], bytes(32))
+        with db.utxo_db.write_batch() as batch:
+            db.flush_utxo_db(batch, flush_data)
+            db.write_utxo_state(batch)
+
+    def assert_in_filter(self, db, adds):
+        self.assertTrue(all(db.may_have_utxo(key[:4] + key[-2:]) for key, _ in adds))
+
+    async def test_absent_utxos_rejected(self):
+        adds = [utxo(n) for n in range(100)]
+        self.flush_utxos(self.db, adds)
+        self.assert_in_filter(self.db, adds)
+        absent = [(os.urandom(32), 0) for _ in range(1000)]
+        self.assertEqual([None] * 1000, await self.db.lookup_utxos(absent))
+        info = self.db.utxo_filter_info()
+        self.assertEqual(1000, info['rejects'] + info['false_positives'])
+        self.assertLess(info['false_positive_rate'], 0.05)
+        self.assertEqual(100, info['keys'])
+
+    async def test_saved_on_close_and_rebuilt_after_crash(self):
+        adds = [utxo(n) for n in range(100)]
+        self.flush_utxos(self.db, adds[:50])
+        self.db.close()
+        db = await self.open_db()
+        self.assertEqual(50, db.utxo_filter.count)
+        self.assert_in_filter(db, adds[:50])
+        # flushed but not closed, the saved filter is out of date
+        db.history.flush_count += 1
+        with db.history.db.write_batch() as batch:
+            db.history.write_state(batch)
+        self.flush_utxos(db, adds[50:])
+        db.utxo_db.close()
+        db.history.close_db()
+        db = await self.open_db()
+        self.addCleanup(db.close)
+        self.assertEqual(100, db.utxo_filter.count)
+        self.assert_in_filter(db, adds)
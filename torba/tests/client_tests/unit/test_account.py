@@ -48,6 +48,18 @@ class TestHierarchicalDeterministicAccount(AsyncioTestCase):
             await self.account.receiving._generate_keys(0, 200)
         records = await self.account.receiving.get_address_records()
         self.assertEqual(201, len(records))
+        self.assertEqual(list(range(201)), sorted(record['position'] for record in records))
+
+    async def test_stored_public_key_is_not_derived_again(self):
+        async with self.account.change.address_generator_lock:
+            await self.account.change._generate_keys(0, 4)
+        record = await self.ledger.db.get_address(accounts=[self.account], chain=1, position=3)
+        derived = self.account.get_public_key(1, 3)
+        stored = self.account.get_stored_public_key(record)
+        self.assertEqual(stored.address, record['address'])
+        self.assertEqual(stored.extended_key_string(), derived.extended_key_string())
+        public_key = await self.ledger.get_public_key_for_address(record['address'])
+        self.assertEqual(public_key.extended_key_string(), derived.extended_key_string())
 
     async def test_ensure_address_gap(self):
         account = self.account
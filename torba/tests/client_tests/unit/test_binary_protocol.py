@@ -0,0 +1,135 @@
+import asyncio
+
+from torba.client.basenetwork import ClientSession
+from torba.rpc import RPCSession, RPCError, BinaryRPC, Request, Notification, Server
+from torba.rpc import EncodedResult, JSONRPCv2
+from torba.testcase import AsyncioTestCase
+
+
+class EchoSession(RPCSession):
+
+    allow_binary = True
+    sessions = []
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.sessions.append(self)
+
+    async def handle_request(self, request):
+        if request.method == 'echo':
+            return request.args
+        if request.method == 'raw':
+            return bytes(range(256))
+        if request.method == 'notify':
+            await self.send_notification('notified', request.args)
+            return None
+        raise RPCError(-1, f'no {request.method}')
+
+
+class JSONOnlySession(EchoSession):
+    allow_binary = False
+
+
+class FakeNetwork:
+
+    def __init__(self):
+        self.notifications = []
+        self.subscription_controllers = {'notified': self}
+
+    def add(self, args):
+        self.notifications.append(args)
+
+
+class TestBinaryRPC(AsyncioTestCase):
+
+    def test_method_names_sent_once(self):
+        sender, receiver = BinaryRPC(), BinaryRPC()
+        first = sender.request_message(Request('blockchain.block.headers', [0, 10]), 0)
+        second = sender.request_message(Request('blockchain.block.headers', [10, 10]), 1)
+        self.assertIn(b'blockchain.block.headers', first)
+        self.assertNotIn(b'blockchain.block.headers', second)
+        self.assertEqual((Request('blockchain.block.headers', [0, 10]), 0), receiver.message_to_item(first))
+        self.assertEqual((Request('blockchain.block.headers', [10, 10]), 1), receiver.message_to_item(second))
+        notification = sender.notification_message(Notification('server.ping', []))
+        self.assertEqual((Notification('server.ping', []), None), receiver.message_to_item(notification))
+
+    def test_responses(self):
+        protocol = BinaryRPC()
+        item, request_id = protocol.message_to_item(protocol.response_message(b'\x00\xff', 7))
+        self.assertEqual((b'\x00\xff', 7), (item.result, request_id))
+        item, request_id = protocol.message_to_item(protocol.response_message({'height': 5}, 8))
+        self.assertEqual(({'height': 5}, 8), (item.result, request_id))
+        item, request_id = protocol.message_to_item(protocol.response_message(RPCError(1, 'bad'), 9))
+        self.assertEqual((RPCError(1, 'bad'), 9), (item.result, request_id))
+
+
+class TestEncodedResult(AsyncioTestCase):
+
+    def test_spliced_like_encoded(self):
+        result = {'hex': 'ab' * 10, 'height': 5}
+        encoded = EncodedResult(result)
+        for request_id in (1, 'id', None):
+            self.assertEqual(JSONRPCv2.response_message(result, request_id),
+                             JSONRPCv2.response_message(encoded, request_id))
+        self.assertEqual(JSONRPCv2.notification_message(Notification('headers', [result])),
+                         JSONRPCv2.notification_message(Notification('headers', [encoded])))
+        # a string like the splice marker does not confuse splicing
+        request_id = '\0encoded result'
+        self.assertEqual(JSONRPCv2.response_message(result, request_id),
+                         JSONRPCv2.response_message(encoded, request_id))
+
+    def test_binary(self):
+        protocol = BinaryRPC()
+        item, _ = protocol.message_to_item(protocol.response_message(EncodedResult(b'\x00\xff'), 1))
+        self.assertEqual(b'\x00\xff', item.result)
+        item, _ = protocol.message_to_item(protocol.response_message(EncodedResult([1, 'a']), 2))
+        self.assertEqual([1, 'a'], item.result)
+        self.assertEqual(b'"AP8="', EncodedResult(b'\x00\xff').json)
+
+
+class TestBinaryNegotiation(AsyncioTestCase):
+
+    async def start_server(self, session_class):
+        session_class.sessions = []
+        server = Server(session_class, 'localhost', 0)
+        await server.listen()
+        self.addCleanup(server.close)
+        return server.server.sockets[0].getsockname()[:2]
+
+    async def connect(self, address, binary):
+        network = FakeNetwork()
+        client = ClientSession(network=network, server=address, binary=binary)
+        await client.create_connection()
+        self.addCleanup(client.close)
+        return client, network
+
+    async def test_binary_session(self):
+        address = await self.start_server(EchoSession)
+        client, network = await self.connect(address, binary=True)
+        self.assertTrue(client.binary)
+        results = await asyncio.gather(*(client.send_request('echo', [n, 'x' * n]) for n in range(50)))
+        self.assertEqual([[n, 'x' * n] for n in range(50)], results)
+        self.assertEqual(bytes(range(256)), await client.send_request('raw'))
+        with self.assertRaises(RPCError):
+            await RPCSession.send_request(client, 'missing')
+        await client.send_request('notify', [1, 2])
+        self.assertEqual([[1, 2]], network.notifications)
+        self.assertIsInstance(EchoSession.sessions[0].connection._protocol, BinaryRPC)
+
+    async def test_json_session_gets_bytes_as_base64(self):
+        address = await self.start_server(EchoSession)
+        client, _ = await self.connect(address, binary=False)
+        self.assertEqual(['AAE='], await client.send_request('echo', [b'\x00\x01']))
+        self.assertEqual([1], await client.send_request('echo', [1]))
+
+    async def test_falls_back_to_json(self):
+        address = await self.start_server(JSONOnlySession)
+        client, _ = await self.connect(address, binary=False)
+        await client.close()
+        client.binary = True
+        with self.assertRaises(ConnectionError):
+            await client.create_connection()
+        self.assertFalse(client.binary)
+        await client.close()
+        await client.create_connection()
+        self.assertEqual([1], await client.send_request('echo', [1]))
@@ -0,0 +1,54 @@
+import os
+import unittest
+from binascii import unhexlify
+
+from torba.blockfilter import siphash, build_filter, match_filter, match_filters, filter_header
+
+
+class TestSipHash(unittest.TestCase):
+
+    def test_reference_vectors(self):
+        key = bytes(range(16))
+        self.assertEqual(0x726fdb47dd0e0e31, siphash(key, b''))
+        self.assertEqual(0x93f5f5799a932462, siphash(key, bytes(range(8))))
+        self.assertEqual(0xa129ca6149be45e5, siphash(key, bytes(range(15))))
+
+
+class TestBlockFilter(unittest.TestCase):
+
+    def test_bip158_genesis_vector(self):
+        block_hash = unhexlify('000000000933ea01ad0ee984209779baaec3ced90fa3f408719526f8d77f4943')[::-1]
+        script = unhexlify(
+            '4104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51e'
+            'c112de5c384df7ba0b8d578a4c702b6bf11d5fac'
+        )
+        block_filter = build_filter(block_hash, [script])
+        self.assertEqual(unhexlify('019dfca8'), block_filter)
+        self.assertEqual(
+            '21584579b7eb08997773e5aeff3a7f932700042d0ed2a6129012b7d7ae81b750',
+            filter_header(block_filter, bytes(32))[::-1].hex()
+        )
+
+    def test_match(self):
+        block_hash = os.urandom(32)
+        elements = [os.urandom(11) for _ in range(1000)]
+        block_filter = build_filter(block_hash, elements + elements[:10])
+        others = [os.urandom(11) for _ in range(100)]
+        self.assertEqual(set(elements[5:15]), match_filter(block_hash, block_filter, elements[5:15] + others))
+        self.assertEqual(set(), match_filter(block_hash, build_filter(block_hash, []), elements))
+        self.assertEqual(b'\x00', build_filter(block_hash, []))
+
+    def test_filters_matched_together(self):
+        block_hashes = [os.urandom(32) for _ in range(3)]
+        elements = [os.urandom(11) for _ in range(100)]
+        block_filters = [
+            build_filter(block_hashes[0], elements[:50]),
+            build_filter(block_hashes[1], []),
+            build_filter(block_hashes[2], elements[40:]),
+        ]
+        for queried in (elements[:10], elements[45:55], elements[90:] + [os.urandom(11)]):
+            self.assertEqual(
+                set().union(*(match_filter(*args, queried) for args in zip(block_hashes, block_filters))),
+                match_filters(block_hashes, block_filters, queried)
+            )
+        self.assertEqual(set(elements[95:]), match_filters(block_hashes, block_filters, elements[95:]))
@@ -3,7 +3,7 @@ from types import GeneratorType
 from torba.testcase import AsyncioTestCase
 
 from torba.coin.bitcoinsegwit import MainNetLedger as ledger_class
-from torba.client.coinselection import CoinSelector, MAXIMUM_TRIES
+from torba.client.coinselection import CoinSelector, Coin, MAXIMUM_TRIES
 from torba.client.constants import CENT
 
 from client_tests.unit.test_transaction import get_output as utxo
@@ -85,6 +85,32 @@ class TestCoinSelectionTests(BaseSelectionTestCase):
         match = selector.select(utxo_pool)
         self.assertEqual([5*CENT], [c.txo.amount for c in match])
 
+    def test_largest_first(self):
+        utxo_pool = self.estimates(
+            utxo(1*CENT),
+            utxo(2*CENT),
+            utxo(5*CENT),
+            utxo(6*CENT),
+            utxo(10*CENT),
+        )
+        fee = utxo_pool[0].fee
+        # the largest, then the smallest one covering the rest
+        match = CoinSelector(14*CENT, 0).select(utxo_pool, "largest_first")
+        self.assertEqual([10*CENT, 5*CENT], [c.txo.amount for c in match])
+        match = CoinSelector(16*CENT - 2*fee, 0).select(utxo_pool, "largest_first")
+        self.assertEqual([10*CENT, 6*CENT], [c.txo.amount for c in match])
+        match = CoinSelector(24*CENT - 5*fee, 0).select(utxo_pool, "largest_first")
+        self.assertEqual(5, len(match))
+        self.assertEqual([], CoinSelector(24*CENT, 0).select(utxo_pool, "largest_first"))
+
+    def test_coins(self):
+        coins = [Coin(str(amount), amount - 10, 10, 1) for amount in (30, 40, 50, 60)]
+        match = CoinSelector(80, 0).select(coins)
+        self.assertEqual(['60', '40'], [coin.txoid for coin in match])
+        coins = [coin._replace(height=0) if coin.txoid == '60' else coin for coin in coins]
+        match = CoinSelector(80, 0).select(coins, "only_confirmed")
+        self.assertEqual(['50', '40', '30'], [coin.txoid for coin in match])
+
     def test_confirmed_strategies(self):
         utxo_pool = self.estimates(
             utxo(11*CENT, height=5),
@@ -167,9 +193,12 @@ class TestOfficialBitcoinCoinSelectionTests(BaseSelectionTestCase):
 
         # Iteration exhaustion test
         utxo_pool, target = self.make_hard_case(17)
-        selector = CoinSelector(target, 0)
+        selector = CoinSelector(target, 0, time_limit=None)
         self.assertEqual(selector.select(utxo_pool, 'branch_and_bound'), [])
         self.assertEqual(selector.tries, MAXIMUM_TRIES)  # Should exhaust
+        selector = CoinSelector(target, 0, time_limit=0)
+        self.assertEqual(selector.select(utxo_pool, 'branch_and_bound'), [])
+        self.assertEqual(selector.tries, 1000)  # Out of time
         utxo_pool, target = self.make_hard_case(14)
         self.assertIsNotNone(search(utxo_pool, target, 0))  # Should not exhaust
 
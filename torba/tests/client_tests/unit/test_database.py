@@ -4,6 +4,7 @@ import unittest
 import sqlite3
 import tempfile
 import asyncio
+import threading
 from concurrent.futures.thread import ThreadPoolExecutor
 
 from torba.client.wallet import Wallet
@@ -57,6 +58,41 @@ class TestAIOSQLite(AsyncioTestCase):
         self.assertListEqual([(1, 'test')], await self.db.execute_fetchall("select * from parent"))
 
 
+class TestAIOSQLiteReaders(AsyncioTestCase):
+    async def asyncSetUp(self):
+        self.path = tempfile.mktemp()
+        self.db = await AIOSQLite.connect(self.path, isolation_level=None)
+        self.addCleanup(os.remove, self.path)
+        self.addCleanup(self.db.close)
+        await self.db.executescript("create table item (id integer primary key);")
+        await self.db.execute("insert into item values (1)")
+
+    async def test_reads_dont_wait_for_writer(self):
+        inserted, finish = threading.Event(), threading.Event()
+
+        def long_write(conn):
+            conn.execute("insert into item values (2)")
+            inserted.set()
+            finish.wait()
+
+        write = asyncio.ensure_future(self.db.run(long_write))
+        await self.loop.run_in_executor(None, inserted.wait)
+        # the uncommitted insert isn't seen and the read isn't queued behind it
+        self.assertEqual([(1,)], await asyncio.wait_for(
+            self.db.execute_fetchall("select * from item"), timeout=5
+        ))
+        self.assertEqual((1,), await self.db.execute_fetchone("select count(*) from item"))
+        finish.set()
+        await write
+        self.assertEqual([(1,), (2,)], await self.db.execute_fetchall("select * from item"))
+        self.assertTrue(self.db.readers)
+
+    async def test_readers_are_read_only(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            await self.db.execute_fetchall("insert into item values (3)")
+        self.assertEqual([(1,)], await self.db.execute_fetchall("select * from item"))
+
+
 class TestQueryBuilder(unittest.TestCase):
 
     def test_dot(self):
@@ -359,6 +395,40 @@ class TestQueries(AsyncioTestCase):
         self.assertEqual([0, 3, 2, 1], [tx.height for tx in txs])
         self.assertEqual([tx4.id, tx3.id, tx2.id, tx1.id], [tx.id for tx in txs])
 
+    async def get_balances(self, account):
+        return await self.ledger.db.db.execute_fetchone(
+            "SELECT confirmed, unconfirmed, reserved FROM balance WHERE account = ?",
+            (account.public_key.address,)
+        )
+
+    async def test_balance_and_utxos_kept_with_transactions(self):
+        account = await self.create_account()
+        tx = await self.create_tx_from_nothing(account, 0)
+        self.assertEqual((0, COIN, 0), await self.get_balances(account))
+        self.assertEqual(COIN, await self.ledger.db.get_balance(accounts=[account]))
+
+        # confirmed when saved again at its height
+        tx.height = 5
+        address = self.ledger.hash160_to_address(tx.outputs[0].pubkey_hash)
+        await self.ledger.db.save_transaction_io(tx, address, tx.outputs[0].pubkey_hash, '')
+        self.assertEqual((COIN, 0, 0), await self.get_balances(account))
+        self.assertEqual(COIN, await self.ledger.db.get_balance(accounts=[account], height__gt=0))
+
+        await self.ledger.db.reserve_outputs(tx.outputs)
+        self.assertEqual((0, 0, COIN), await self.get_balances(account))
+        self.assertEqual(0, await self.ledger.db.get_balance(accounts=[account]))
+        self.assertEqual(0, await self.ledger.db.get_utxo_count(accounts=[account]))
+        await self.ledger.db.release_all_outputs(account)
+        self.assertEqual((COIN, 0, 0), await self.get_balances(account))
+        self.assertEqual([tx.outputs[0].id], [
+            txo.id for txo in await self.ledger.db.get_utxos(accounts=[account])
+        ])
+
+        await self.create_tx_to_nowhere(tx.outputs[0], 6)
+        self.assertEqual((0, 0, 0), await self.get_balances(account))
+        self.assertEqual(0, await self.ledger.db.get_balance(accounts=[account]))
+        self.assertEqual(0, await self.ledger.db.get_utxo_count(accounts=[account]))
+
 
 class TestUpgrade(AsyncioTestCase):
 
@@ -382,8 +452,8 @@ class TestUpgrade(AsyncioTestCase):
     def add_address(self, address):
         with sqlite3.connect(self.path) as conn:
             conn.execute("""
-            INSERT INTO pubkey_address (address, account, chain, position, pubkey)
-            VALUES (?, 'account1', 0, 0, 'pubkey blob')
+            INSERT INTO pubkey_address (address, account, chain, position, pubkey, chain_code)
+            VALUES (?, 'account1', 0, 0, 'pubkey blob', 'chain code blob')
             """, (address,))
 
     def get_addresses(self):
@@ -401,7 +471,7 @@ class TestUpgrade(AsyncioTestCase):
         self.ledger.db.SCHEMA_VERSION = None
         self.assertEqual(self.get_tables(), [])
         await self.ledger.db.open()
-        self.assertEqual(self.get_tables(), ['pubkey_address', 'tx', 'txi', 'txo'])
+        self.assertEqual(self.get_tables(), ['balance', 'pubkey_address', 'tx', 'txi', 'txo', 'utxo'])
         self.assertEqual(self.get_addresses(), [])
         self.add_address('address1')
         await self.ledger.db.close()
@@ -410,17 +480,17 @@ class TestUpgrade(AsyncioTestCase):
         self.ledger.db.SCHEMA_VERSION = '1.0'
         await self.ledger.db.open()
         self.assertEqual(self.get_version(), '1.0')
-        self.assertEqual(self.get_tables(), ['pubkey_address', 'tx', 'txi', 'txo', 'version'])
+        self.assertEqual(self.get_tables(), ['balance', 'pubkey_address', 'tx', 'txi', 'txo', 'utxo', 'version'])
         self.assertEqual(self.get_addresses(), [])  # address1 deleted during version upgrade
         self.add_address('address2')
         await self.ledger.db.close()
 
         # nothing changes
         self.assertEqual(self.get_version(), '1.0')
-        self.assertEqual(self.get_tables(), ['pubkey_address', 'tx', 'txi', 'txo', 'version'])
+        self.assertEqual(self.get_tables(), ['balance', 'pubkey_address', 'tx', 'txi', 'txo', 'utxo', 'version'])
         await self.ledger.db.open()
         self.assertEqual(self.get_version(), '1.0')
-        self.assertEqual(self.get_tables(), ['pubkey_address', 'tx', 'txi', 'txo', 'version'])
+        self.assertEqual(self.get_tables(), ['balance', 'pubkey_address', 'tx', 'txi', 'txo', 'utxo', 'version'])
         self.assertEqual(self.get_addresses(), ['address2'])
         await self.ledger.db.close()
 
@@ -431,7 +501,7 @@ class TestUpgrade(AsyncioTestCase):
         """
         await self.ledger.db.open()
         self.assertEqual(self.get_version(), '1.1')
-        self.assertEqual(self.get_tables(), ['foo', 'pubkey_address', 'tx', 'txi', 'txo', 'version'])
+        self.assertEqual(self.get_tables(), ['balance', 'foo', 'pubkey_address', 'tx', 'txi', 'txo', 'utxo', 'version'])
         self.assertEqual(self.get_addresses(), [])  # all tables got reset
         await self.ledger.db.close()
 
@@ -1,11 +1,12 @@
 import asyncio
 import os
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from urllib.request import Request, urlopen
 
 from torba.testcase import AsyncioTestCase
 
-from torba.coin.bitcoinsegwit import MainHeaders
+from torba.coin.bitcoinsegwit import MainHeaders, UnverifiedHeaders
 
 
 def block_bytes(blocks):
@@ -136,9 +137,92 @@ class BasicHeadersTests(BitcoinHeadersTestCase):
                 await headers.connect(block_index, self.get_bytes(block_bytes(block_index + 1), block_bytes(block_index)))
         async def reader():
             for block_index in range(BLOCKS):
-                while len(headers) < block_index:
+                while len(headers) <= block_index:
                     await asyncio.sleep(0.000001)
                 assert headers[block_index]['block_height'] == block_index
         reader_task = asyncio.create_task(reader())
         await writer()
-        await reader_task
\ No newline at end of file
+        await reader_task
+
+
+class CountingHeaders(MainHeaders):
+    proofs_of_work = 0
+
+    @classmethod
+    def get_proof_of_work(cls, header_hash):
+        cls.proofs_of_work += 1
+        return super().get_proof_of_work(header_hash)
+
+
+class BadCheckpointHeaders(MainHeaders):
+    checkpoints = dict(MainHeaders.checkpoints)
+    checkpoints[4031] = b'0' * 64
+
+
+class HeaderValidationTests(BitcoinHeadersTestCase):
+
+    async def test_no_proof_of_work_checked_up_to_checkpoint(self):
+        headers = CountingHeaders(':memory:')
+        await headers.connect(0, self.get_bytes(block_bytes(3001)))
+        self.assertEqual(headers.height, 3000)
+        # the first chunk has a checkpoint at 2015, the second none
+        self.assertEqual(3001 - 2016, CountingHeaders.proofs_of_work)
+
+    async def test_checkpoint_mismatch(self):
+        headers = BadCheckpointHeaders(':memory:')
+        self.assertEqual(2016, await headers.connect(0, self.get_bytes(block_bytes(4032))))
+        self.assertEqual(headers.height, 2015)
+
+    async def test_validated_in_process_pool(self):
+        headers = MainHeaders(':memory:')
+        headers.executor = ProcessPoolExecutor(max_workers=2)
+        self.addCleanup(headers.executor.shutdown)
+        data = bytearray(self.get_bytes(block_bytes(6000)))
+        # breaks the link to the previous header in the third chunk
+        data[block_bytes(4500)+4] ^= 1
+        self.assertEqual(4032, await headers.connect(0, bytes(data)))
+        self.assertEqual(headers.height, 4031)
+
+
+
+class HeaderFieldTests(BitcoinHeadersTestCase):
+
+    async def test_fields_read_from_mapped_file(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.remove, path)
+        headers = UnverifiedHeaders(path)
+        await headers.open()
+        self.addCleanup(headers.io.close)
+        await headers.connect(0, self.get_bytes(block_bytes(3001)))
+        for height in (0, 2015, 3000):
+            header = headers[height]
+            self.assertEqual(header['merkle_root'], headers.get_merkle_root(height))
+            self.assertEqual(header['timestamp'], headers.get_timestamp(height))
+            self.assertEqual(header['bits'], headers.get_bits(height))
+        with self.assertRaises(IndexError):
+            headers.get_timestamp(3001)
+        # the file grows past the mapping
+        await headers.connect(3001, self.get_bytes(block_bytes(10), block_bytes(3001)))
+        self.assertEqual(self.get_bytes(block_bytes(1), block_bytes(3010)), headers.get_raw_header(3010))
+        # and shrinks, headers at 2000 of another chain replacing the rest
+        other = bytearray(self.get_bytes(block_bytes(1), block_bytes(2000)))
+        other[-4:] = bytes(4)  # nonce
+        self.assertEqual(1, await headers.connect(2000, bytes(other)))
+        self.assertEqual(2000, headers.height)
+        self.assertEqual(bytes(other), headers.get_raw_header(2000))
+
+    async def test_heights_for_timestamps(self):
+        headers = UnverifiedHeaders(':memory:')
+        headers.io.write(self.get_bytes(block_bytes(3001)))
+        first, last = headers.get_timestamp(0), headers.get_timestamp(3000)
+        self.assertEqual(
+            [0, 0, 1, 1000, 3000, 3001],
+            headers.get_heights_for_timestamps([
+                0, first, first + 1, headers.get_timestamp(1000), last, last + 1
+            ])
+        )
+        # the index follows the headers replaced after a reorganization
+        replacement = bytearray(self.get_bytes(block_bytes(1), block_bytes(1000)))
+        replacement[68:72] = (last + 100).to_bytes(4, 'little')
+        await headers.connect(1000, bytes(replacement))
+        self.assertEqual([1000, 1001], headers.get_heights_for_timestamps([last + 1, last + 101]))
@@ -1,8 +1,12 @@
 import os
-from binascii import hexlify
+import zlib
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from binascii import hexlify, unhexlify
 
 from torba.coin.bitcoinsegwit import MainNetLedger
 from torba.client.wallet import Wallet
+from torba.blockfilter import build_filter, filter_header, script_element
 
 from client_tests.unit.test_transaction import get_transaction, get_output
 from client_tests.unit.test_headers import BitcoinHeadersTestCase, block_bytes
@@ -16,7 +20,10 @@ class MockNetwork:
         self.address = None
         self.get_history_called = []
         self.get_transaction_called = []
+        self.get_histories_called = []
+        self.statuses = {}
         self.is_connected = False
+        self.remote_height = 0
 
     def retriable_call(self, function, *args, **kwargs):
         return function(*args, **kwargs)
@@ -26,6 +33,13 @@ class MockNetwork:
         self.address = address
         return self.history
 
+    async def get_histories(self, addresses):
+        self.get_histories_called.append(addresses)
+        return [self.history for _ in addresses]
+
+    async def subscribe_addresses(self, addresses):
+        return [self.statuses.get(address) for address in addresses]
+
     async def get_merkle(self, txid, height):
         return {'merkle': ['abcd01'], 'pos': 1}
 
@@ -123,6 +137,27 @@ class TestSynchronization(LedgerTestCase):
             '047cf1d53ef68f0fd586d46f90c09ff8e57a4180f67e7f4b8dd0135c3741e828:3:'
         )
 
+    async def test_subscribe_addresses_fetches_histories_in_batch(self):
+        account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        await account.receiving.ensure_address_gap()
+        addresses = await account.receiving.get_addresses()
+        self.add_header(block_height=0, merkle_root=b'abcd04')
+        self.ledger.network = MockNetwork([{'tx_hash': 'abcd01', 'height': 0}], {
+            'abcd01': hexlify(get_transaction(get_output(1)).raw),
+        })
+        self.ledger.network.is_connected = True
+        history = '252bda9b22cc902ca2aa2de3548ee8baf06b8501ff7bfb3b0b7d980dbd1bf792:0:'
+        # only the first two addresses have a history, the others are in sync
+        for address in addresses[:2]:
+            self.ledger.network.statuses[address] = self.ledger.get_status(history)
+        await self.ledger.subscribe_addresses(account.receiving, addresses)
+        await self.ledger._update_tasks.done.wait()
+        self.assertEqual([addresses[:2]], self.ledger.network.get_histories_called)
+        self.assertEqual([], self.ledger.network.get_history_called)
+        for address in addresses[:2]:
+            self.assertEqual(history, (await self.ledger.db.get_address(address=address))['history'])
+        self.assertIsNone((await self.ledger.db.get_address(address=addresses[2]))['history'])
+
 
 class MocHeaderNetwork(MockNetwork):
     def __init__(self, responses):
@@ -133,6 +168,35 @@ class MocHeaderNetwork(MockNetwork):
         return self.responses[height]
 
 
+class MockHeadersDownloadNetwork(MockNetwork):
+    def __init__(self, headers):
+        super().__init__(None, None)
+        self.headers = headers
+        self.remote_height = len(headers) // block_bytes(1) - 1
+        self.get_headers_called = []
+        self.downloading = self.max_downloading = 0
+
+    async def get_headers(self, height, count):
+        self.get_headers_called.append(height)
+        self.downloading += 1
+        self.max_downloading = max(self.downloading, self.max_downloading)
+        await asyncio.sleep(0)
+        self.downloading -= 1
+        headers = self.headers[block_bytes(height):block_bytes(height + count)]
+        return {'count': len(headers) // block_bytes(1), 'hex': hexlify(headers)}
+
+
+class HeadersDownloadTests(LedgerTestCase):
+
+    async def test_ranges_downloaded_concurrently(self):
+        self.ledger.network = MockHeadersDownloadNetwork(self.get_bytes(block_bytes(6001)))
+        self.ledger.concurrent_chunk_downloads = 3
+        await self.ledger.update_headers()
+        self.assertEqual(6000, self.ledger.headers.height)
+        self.assertEqual([0, 2001, 4002, 6001], self.ledger.network.get_headers_called)
+        self.assertEqual(3, self.ledger.network.max_downloading)
+
+
 class BlockchainReorganizationTests(LedgerTestCase):
 
     async def test_1_block_reorganization(self):
@@ -168,3 +232,158 @@ class BlockchainReorganizationTests(LedgerTestCase):
         await self.ledger.receive_header(({
             'height': 23, 'hex': hexlify(self.make_header(block_height=23))
         },))
+
+
+class MockChunkNetwork(MockNetwork):
+    def __init__(self, chunks, size):
+        super().__init__(None, None)
+        self.chunks = chunks
+        self.size = size
+        self.get_compressed_chunk_called = []
+
+    async def get_compressed_chunk_hashes(self):
+        return {'size': self.size, 'hashes': [
+            MainNetLedger.headers_class.hash_header(chunk[-block_bytes(1):]).decode()
+            for chunk in self.chunks
+        ]}
+
+    async def get_compressed_chunk(self, index):
+        self.get_compressed_chunk_called.append(index)
+        return zlib.compress(self.chunks[index])
+
+
+class CompressedChunkSyncTests(LedgerTestCase):
+
+    def get_chunks(self, count, size=100):
+        return [self.get_bytes(after=block_bytes(n * size), upto=block_bytes(size)) for n in range(count)]
+
+    async def test_sync_and_skip_known_chunks(self):
+        self.ledger.network = MockChunkNetwork(self.get_chunks(3), 100)
+        await self.ledger.headers.connect(0, self.get_bytes(upto=block_bytes(150)))
+        await self.ledger.sync_compressed_chunks()
+        self.assertEqual([1, 2], self.ledger.network.get_compressed_chunk_called)
+        self.assertEqual(self.get_bytes(upto=block_bytes(300)), self.ledger.headers.io.getvalue())
+        self.ledger.network.get_compressed_chunk_called = []
+        await self.ledger.sync_compressed_chunks()
+        self.assertEqual([], self.ledger.network.get_compressed_chunk_called)
+
+    async def test_invalid_chunk_stops_sync(self):
+        chunks = self.get_chunks(4)
+        chunks[2] = chunks[1]
+        self.ledger.network = MockChunkNetwork(chunks, 100)
+        await self.ledger.sync_compressed_chunks()
+        self.assertEqual(200, len(self.ledger.headers))
+
+
+class MockFilterNetwork(MockNetwork):
+    def __init__(self, history, transaction, filters):
+        super().__init__(history, transaction)
+        self.filters = filters
+        self.get_filters_called = []
+        # requests for filters answered by servers without them
+        self.servers_without_filters = 0
+        self.headers = []
+        header = bytes(32)
+        for block_filter in filters:
+            header = filter_header(block_filter, header)
+            self.headers.append(header)
+
+    async def get_history(self, address):
+        self.get_history_called.append(address)
+        return self.history.get(address, [])
+
+    async def get_filter_headers(self, height, count):
+        headers = self.headers[height:height+count]
+        return {'hex': hexlify(b''.join(headers)).decode(), 'count': len(headers)}
+
+    async def get_filters(self, height, count):
+        self.get_filters_called.append((height, count))
+        if self.servers_without_filters:
+            self.servers_without_filters -= 1
+            return None
+        return [hexlify(block_filter).decode() for block_filter in self.filters[height:height+count]]
+
+
+class FilterSyncTests(LedgerTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        await self.ledger.headers.connect(0, self.get_bytes(upto=block_bytes(5)))
+        self.ledger.filter_sync = True
+        self.account = self.ledger.account_class.generate(self.ledger, Wallet(), "torba")
+        self.address = await self.account.receiving.get_or_create_usable_address()
+
+    def get_filters(self, elements_by_height):
+        return [
+            build_filter(unhexlify(self.ledger.headers.hash(height))[::-1], elements_by_height.get(height, []))
+            for height in range(len(self.ledger.headers))
+        ]
+
+    def address_element(self, address):
+        return script_element(self.ledger.transaction_class.output_class.script_class.pay_pubkey_hash(
+            self.ledger.address_to_hash160(address)).source)
+
+    async def test_only_matching_address_history_fetched(self):
+        self.ledger.network = MockFilterNetwork(
+            {self.address: [{'tx_hash': 'abcd01', 'height': 2}]},
+            {'abcd01': hexlify(get_transaction(get_output(1)).raw)},
+            self.get_filters({2: [self.address_element(self.address), b'other']})
+        )
+        await self.ledger.subscribe_account(self.account)
+        self.assertTrue(self.ledger.filter_sync)
+        self.assertEqual([self.address], self.ledger.network.get_history_called)
+        address_details = await self.ledger.db.get_address(address=self.address)
+        self.assertEqual(
+            '252bda9b22cc902ca2aa2de3548ee8baf06b8501ff7bfb3b0b7d980dbd1bf792:2:', address_details['history']
+        )
+        self.assertEqual(4, self.ledger._filter_state['height'])
+        # addresses generated for the gap were scanned and nothing is left to scan
+        self.assertEqual(set(), self.ledger._unscanned_addresses)
+        self.ledger.network.get_history_called = []
+        await self.ledger.sync_filters()
+        self.assertEqual([], self.ledger.network.get_history_called)
+
+    async def test_filters_downloaded_once_for_the_gap(self):
+        self.ledger.network = MockFilterNetwork(
+            {self.address: [{'tx_hash': 'abcd01', 'height': 2}]},
+            {'abcd01': hexlify(get_transaction(get_output(1)).raw)},
+            self.get_filters({2: [self.address_element(self.address)]})
+        )
+        await self.ledger.subscribe_account(self.account)
+        self.assertTrue(self.ledger.filter_sync)
+        # the addresses generated for the gap were scanned for in the same filters
+        self.assertEqual(set(), self.ledger._unscanned_addresses)
+        self.assertEqual([(0, 5)], self.ledger.network.get_filters_called)
+
+    async def test_filters_matched_in_process_pool(self):
+        self.ledger.network = MockFilterNetwork(
+            {self.address: [{'tx_hash': 'abcd01', 'height': 2}]},
+            {'abcd01': hexlify(get_transaction(get_output(1)).raw)},
+            self.get_filters({2: [self.address_element(self.address)]})
+        )
+        self.ledger.headers.executor = ProcessPoolExecutor(1)
+        self.addCleanup(self.ledger.headers.executor.shutdown)
+        self.ledger.filter_batch_size = 2
+        self.ledger.filter_cache_batches = 1
+        await self.ledger.subscribe_account(self.account)
+        self.assertTrue(self.ledger.filter_sync)
+        self.assertEqual([self.address], self.ledger.network.get_history_called)
+        # only the last batch is kept for the gap, the others are downloaded again
+        self.assertEqual([(0, 2), (2, 2), (4, 1)] * 2, self.ledger.network.get_filters_called)
+
+    async def test_filters_asked_of_another_server(self):
+        self.ledger.network = MockFilterNetwork(
+            {self.address: [{'tx_hash': 'abcd01', 'height': 2}]},
+            {'abcd01': hexlify(get_transaction(get_output(1)).raw)},
+            self.get_filters({2: [self.address_element(self.address)]})
+        )
+        self.ledger.network.servers_without_filters = 2
+        await self.ledger.subscribe_account(self.account)
+        self.assertTrue(self.ledger.filter_sync)
+        self.assertEqual([self.address], self.ledger.network.get_history_called)
+        self.assertEqual([(0, 5)] * 3, self.ledger.network.get_filters_called)
+
+    async def test_falls_back_to_subscriptions(self):
+        self.ledger.network = MockFilterNetwork({}, {}, [])
+        await self.ledger.subscribe_account(self.account)
+        self.assertFalse(self.ledger.filter_sync)
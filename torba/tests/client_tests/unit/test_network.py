@@ -0,0 +1,148 @@
+import asyncio
+
+from torba.client.basenetwork import ClientSession, SessionPool
+from torba.rpc import Server
+from torba.testcase import AsyncioTestCase
+
+from client_tests.unit.test_binary_protocol import EchoSession, FakeNetwork
+
+
+class TestBatchedRequests(AsyncioTestCase):
+
+    @property
+    def messages_received(self):
+        return EchoSession.sessions[0].recv_count
+
+    async def connect(self, binary):
+        EchoSession.sessions = []
+        server = Server(EchoSession, 'localhost', 0)
+        await server.listen()
+        self.addCleanup(server.close)
+        client = ClientSession(
+            network=FakeNetwork(), server=server.server.sockets[0].getsockname()[:2], binary=binary
+        )
+        client.max_batch_size = 10
+        await client.create_connection()
+        self.addCleanup(client.close)
+        return client
+
+    async def test_batches(self):
+        client = await self.connect(binary=False)
+        results = await client.send_request([('echo', [n]) for n in range(25)] + [('missing', [])])
+        self.assertEqual([[n] for n in range(25)] + [None], results)
+        # three batches of at most ten requests
+        self.assertEqual(3, self.messages_received)
+        self.assertEqual([], await client.send_request([]))
+        self.assertEqual(0, client.pending_amount)
+
+    async def test_pipelined_with_binary_protocol(self):
+        client = await self.connect(binary=True)
+        results = await client.send_request([('echo', [n]) for n in range(25)] + [('missing', [])])
+        self.assertEqual([[n] for n in range(25)] + [None], results)
+        self.assertEqual(0, client.pending_amount)
+
+    async def test_queued_requests_are_batched(self):
+        client = await self.connect(binary=False)
+        results = await asyncio.gather(*(client.send_batched_request('echo', [n]) for n in range(5)))
+        self.assertEqual([[n] for n in range(5)], results)
+        self.assertEqual(1, self.messages_received)
+        self.assertEqual([5], await client.send_batched_request('echo', [5]))
+        self.assertEqual(2, self.messages_received)
+
+    async def test_queued_requests_fail_when_disconnected(self):
+        client = await self.connect(binary=False)
+        future = client.send_batched_request('echo', [1])
+        client.synchronous_close()
+        with self.assertRaises(asyncio.TimeoutError):
+            await future
+
+
+class SlowEchoSession(EchoSession):
+
+    delay = 0
+
+    async def handle_request(self, request):
+        await asyncio.sleep(self.delay)
+        return await super().handle_request(request)
+
+
+class TestSessionPool(AsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.pool = SessionPool(network=FakeNetwork(), timeout=6)
+        self.server_sessions = {}
+
+    async def add_session(self, delay):
+        session_class = type('EchoSession', (SlowEchoSession,), {'delay': delay, 'sessions': []})
+        server = Server(session_class, 'localhost', 0)
+        await server.listen()
+        self.addCleanup(server.close)
+        client = ClientSession(network=FakeNetwork(), server=server.server.sockets[0].getsockname()[:2])
+        await client.create_connection()
+        self.addCleanup(client.close)
+        client.response_time = 0.01
+        self.pool.sessions[client] = None
+        self.server_sessions[client] = session_class.sessions
+        return client
+
+    def requests_received(self, client):
+        return self.server_sessions[client][0].recv_count
+
+    async def test_requests_spread_over_sessions(self):
+        first, second = await self.add_session(0), await self.add_session(0)
+        self.pool.min_hedge_samples = 1000
+        for n in range(50):
+            session = self.pool.pick_session()
+            self.assertEqual([n], await self.pool.hedged_request(session, lambda s: s.send_request('echo', [n])))
+        self.assertEqual(50, self.requests_received(first) + self.requests_received(second))
+        self.assertGreater(self.requests_received(first), 0)
+        self.assertGreater(self.requests_received(second), 0)
+        self.assertIs(second, self.pool.pick_session(exclude=first))
+        # a session with many requests in flight gets picked less
+        first.pending_amount = 1000
+        picked = [self.pool.pick_session() for _ in range(100)]
+        self.assertGreater(picked.count(second), 90)
+
+    async def test_slow_request_hedged(self):
+        slow, fast = await self.add_session(5), await self.add_session(0)
+        # without enough samples there is no hedging
+        self.assertIsNone(self.pool.hedge_delay)
+        self.pool.response_times.extend([0.01] * 20)
+        self.assertEqual(0.01, self.pool.hedge_delay)
+        start = asyncio.get_event_loop().time()
+        self.assertEqual([1], await self.pool.hedged_request(slow, lambda s: s.send_request('echo', [1])))
+        self.assertLess(asyncio.get_event_loop().time() - start, 1)
+        self.assertEqual(1, self.requests_received(slow))
+        self.assertEqual(1, self.requests_received(fast))
+
+    async def test_none_answer_hedged(self):
+        slow, fast = await self.add_session(0.2), await self.add_session(0)
+        self.pool.response_times.extend([0.01] * 20)
+        # the hedge answers first, with an error, so the slower answer is waited for
+        def send(session):
+            return session.send_request('missing' if session is fast else 'echo', [1])
+        self.assertEqual([1], await self.pool.hedged_request(slow, send))
+        self.assertEqual(1, self.requests_received(fast))
+        self.assertIsNone(await self.pool.hedged_request(fast, lambda s: s.send_request('missing', [])))
+
+    async def test_slower_request_left_to_finish(self):
+        slow, fast = await self.add_session(0.2), await self.add_session(0)
+        self.pool.response_times.extend([0.01] * 20)
+        self.assertEqual([1], await self.pool.hedged_request(slow, lambda s: s.send_request('echo', [1])))
+        samples = len(self.pool.response_times)
+        # cancelling the slower request would have closed its connection
+        await asyncio.sleep(0.3)
+        self.assertFalse(slow.is_closing())
+        self.assertEqual(samples + 1, len(self.pool.response_times))
+
+    async def test_batch_sent_to_one_session(self):
+        first, second = await self.add_session(0), await self.add_session(0)
+        for _ in range(30):
+            results = await asyncio.gather(*(
+                self.pool.pick_batch_session().send_batched_request('echo', [n]) for n in range(5)
+            ))
+            self.assertEqual([[n] for n in range(5)], results)
+        # one batch per event loop iteration, striped over the sessions
+        self.assertEqual(30, self.requests_received(first) + self.requests_received(second))
+        self.assertGreater(self.requests_received(first), 0)
+        self.assertGreater(self.requests_received(second), 0)
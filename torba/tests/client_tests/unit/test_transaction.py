@@ -7,6 +7,7 @@ from torba.testcase import AsyncioTestCase
 from torba.coin.bitcoinsegwit import MainNetLedger as ledger_class
 from torba.client.wallet import Wallet
 from torba.client.constants import CENT, COIN
+from torba.client.basetransaction import DECODED_TRANSACTIONS
 
 
 NULL_HASH = b'\x00'*32
@@ -181,6 +182,29 @@ class TestTransactionSerialization(unittest.TestCase):
         tx._reset()
         self.assertEqual(tx.raw, raw)
 
+    def test_lazily_decoded_and_shared_by_txid(self):
+        tx = get_transaction()
+        tx.add_outputs([ledger_class.transaction_class.output_class.pay_pubkey_hash(COIN, NULL_HASH)])
+        raw = tx.raw
+        DECODED_TRANSACTIONS.clear()
+
+        first = ledger_class.transaction_class(raw)
+        self.assertEqual([None, None], first._outputs.ios)
+        self.assertEqual(COIN, first.outputs[-1].amount)
+        self.assertEqual(1, first.outputs[-1].position)
+        self.assertIsNone(first._outputs.ios[0])
+        self.assertEqual([CENT, COIN], [txo.amount for txo in first.outputs])
+
+        second = ledger_class.transaction_class(raw)
+        self.assertIs(DECODED_TRANSACTIONS[tx.id], DECODED_TRANSACTIONS[second.id])
+        # copies of the same output, sharing the parsed script
+        self.assertIsNot(first.outputs[0], second.outputs[0])
+        self.assertIs(first.outputs[0].script, second.outputs[0].script)
+        second.outputs[0].is_my_account = True
+        self.assertIsNone(first.outputs[0].is_my_account)
+        self.assertIs(second.ref, second.outputs[0].tx_ref)
+        self.assertEqual(raw, second._serialize())
+
 
 class TestTransactionSigning(AsyncioTestCase):
 
@@ -222,6 +246,37 @@ class TestTransactionSigning(AsyncioTestCase):
             b'226aaa202200098ac8675827aea2b0d6f0e49566143a95d523e311d342172cd99e2021e47cb01'
         )
 
+    async def test_sign_many_inputs(self):
+        account = self.ledger.account_class.from_dict(
+            self.ledger, Wallet(), {
+                "seed": "carbon smart garage balance margin twelve chest sword "
+                        "toast envelope bottom stomach absent"
+
+            }
+        )
+
+        await account.ensure_address_gap()
+        addresses = await account.receiving.get_addresses(limit=3)
+        pubkey_hashes = [self.ledger.address_to_hash160(address) for address in addresses]
+
+        tx_class = ledger_class.transaction_class
+
+        tx = tx_class() \
+            .add_inputs([
+                tx_class.input_class.spend(get_output(COIN + i, pubkey_hashes[i % 3])) for i in range(60)
+            ]) \
+            .add_outputs([tx_class.output_class.pay_pubkey_hash(59*COIN, pubkey_hashes[0])])
+
+        expected = []
+        for i, txi in enumerate(tx.inputs):
+            address = self.ledger.hash160_to_address(txi.txo_ref.txo.script.values['pubkey_hash'])
+            private_key = await self.ledger.get_private_key_for_address(address)
+            expected.append(private_key.sign(tx._serialize_for_signature(i)) + b'\x01')
+
+        await tx.sign([account])
+
+        self.assertEqual([txi.script.values['signature'] for txi in tx.inputs], expected)
+
 
 class TransactionIOBalancing(AsyncioTestCase):
 
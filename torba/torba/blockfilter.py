@@ -0,0 +1,168 @@
+"""Golomb-coded set block filters, as in BIP 158.
+
+The wallet server builds a filter per block and wallets test their
+addresses against it, so they only fetch the history of addresses
+that may have been used in a block.  The elements of a filter are the
+hashXs of the block's outputs and of the outputs its inputs spend,
+which the server indexes addresses by: claim and name scripts match
+the address they pay to, and spends are matched without knowing the
+outpoint.
+
+The encoding is that of the BIP 158 basic filter: elements are hashed
+with SipHash-2-4 keyed by the first 16 bytes of the block hash, mapped
+to [0, N * M) and the sorted differences Golomb-Rice coded with P bits
+of remainder, preceded by the element count as a CompactSize.
+"""
+
+from hashlib import sha256
+from struct import pack, unpack_from
+
+P = 19
+M = 784931
+# The length of the hashXs of the wallet server
+HASHX_LEN = 11
+
+_MASK = 0xffffffffffffffff
+
+
+def double_sha256(data):
+    return sha256(sha256(data).digest()).digest()
+
+
+def script_element(script):
+    """Return the filter element of outputs paying to an address
+    script."""
+    return sha256(script).digest()[:HASHX_LEN]
+
+
+def _sip_round(v0, v1, v2, v3):  # pylint: disable=C0103
+    v0 = (v0 + v1) & _MASK
+    v1 = ((v1 << 13) | (v1 >> 51)) & _MASK ^ v0
+    v0 = ((v0 << 32) | (v0 >> 32)) & _MASK
+    v2 = (v2 + v3) & _MASK
+    v3 = ((v3 << 16) | (v3 >> 48)) & _MASK ^ v2
+    v0 = (v0 + v3) & _MASK
+    v3 = ((v3 << 21) | (v3 >> 43)) & _MASK ^ v0
+    v2 = (v2 + v1) & _MASK
+    v1 = ((v1 << 17) | (v1 >> 47)) & _MASK ^ v2
+    v2 = ((v2 << 32) | (v2 >> 32)) & _MASK
+    return v0, v1, v2, v3
+
+
+def siphash(key, data):
+    """SipHash-2-4 of data with a 16 byte key, as an integer."""
+    # pylint: disable=C0103
+    k0, k1 = unpack_from('<QQ', key)
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+    size = len(data)
+    tail = size - size % 8
+    words = [int.from_bytes(data[n:n + 8], 'little') for n in range(0, tail, 8)]
+    words.append(int.from_bytes(data[tail:], 'little') | (size & 0xff) << 56)
+    for word in words:
+        v3 ^= word
+        v0, v1, v2, v3 = _sip_round(v0, v1, v2, v3)
+        v0, v1, v2, v3 = _sip_round(v0, v1, v2, v3)
+        v0 ^= word
+    v2 ^= 0xff
+    for _ in range(4):
+        v0, v1, v2, v3 = _sip_round(v0, v1, v2, v3)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+def _pack_count(count):
+    if count < 0xfd:
+        return bytes((count,))
+    if count <= 0xffff:
+        return b'\xfd' + pack('<H', count)
+    return b'\xfe' + pack('<I', count)
+
+
+def _unpack_count(block_filter):
+    first = block_filter[0]
+    if first < 0xfd:
+        return first, 1
+    if first == 0xfd:
+        return unpack_from('<H', block_filter, 1)[0], 3
+    return unpack_from('<I', block_filter, 1)[0], 5
+
+
+def _hashed(key, element, count):
+    """Map an element to [0, count * M)."""
+    return (siphash(key[:16], element) * count * M) >> 64
+
+
+def build_filter(key, elements):
+    """Return the filter of a set of byte string elements.  key is the
+    block hash, in internal byte order."""
+    elements = set(elements)
+    count = len(elements)
+    bits = []
+    last = 0
+    remainder_format = '0{}b'.format(P)
+    for value in sorted(_hashed(key, element, count) for element in elements):
+        delta = value - last
+        last = value
+        bits.append('1' * (delta >> P))
+        bits.append('0')
+        bits.append(format(delta & ((1 << P) - 1), remainder_format))
+    bits = ''.join(bits)
+    size = (len(bits) + 7) // 8
+    bits = bits.ljust(size * 8, '0')
+    return _pack_count(count) + (int(bits, 2).to_bytes(size, 'big') if size else b'')
+
+
+def _decoded(block_filter):
+    """Yield the sorted hashed values of a filter."""
+    count, offset = _unpack_count(block_filter)
+    data = block_filter[offset:]
+    bits = bin(int.from_bytes(data, 'big'))[2:].zfill(len(data) * 8) if data else ''
+    position = 0
+    value = 0
+    for _ in range(count):
+        end = bits.index('0', position)
+        remainder = end + 1
+        value += (end - position) << P | int(bits[remainder:remainder + P], 2)
+        position = remainder + P
+        yield value
+
+
+def _match(key, count, values, elements):
+    queries = sorted((_hashed(key, element, count), element) for element in set(elements))
+    matches = set()
+    value = next(values, None)
+    for query, element in queries:
+        while value is not None and value < query:
+            value = next(values, None)
+        if value is None:
+            break
+        if value == query:
+            matches.add(element)
+    return matches
+
+
+def match_filter(key, block_filter, elements):
+    """Return the elements which may be in the filter.  False positives
+    occur at a rate of about 1 / M per element."""
+    count, _ = _unpack_count(block_filter)
+    if not count:
+        return set()
+    return _match(key, count, _decoded(block_filter), elements)
+
+
+def match_filters(keys, block_filters, elements):
+    """Return the elements which may be in any of the filters, keys being
+    the hashes of their blocks.  Matching many filters is CPU bound, so
+    this is run by executors, which may be process pools."""
+    matches = set()
+    for key, block_filter in zip(keys, block_filters):
+        matches.update(match_filter(key, block_filter, elements))
+    return matches
+
+
+def filter_header(block_filter, prev_header):
+    """Return the header committing to a filter and all filters before
+    it.  The header before the first filter is 32 zero bytes."""
+    return double_sha256(double_sha256(block_filter) + prev_header)
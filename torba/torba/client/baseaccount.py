@@ -10,6 +10,9 @@ from torba.client.bip32 import PrivateKey, PubKey, from_extended_key_string
 from torba.client.hash import aes_encrypt, aes_decrypt, sha256
 from torba.client.constants import COIN
 
+# keys derived by one executor job while filling an address gap
+KEY_BATCH_SIZE = 100
+
 if typing.TYPE_CHECKING:
     from torba.client import baseledger, wallet as basewallet
 
@@ -61,6 +64,9 @@ class AddressManager:
     def get_public_key(self, index: int) -> PubKey:
         raise NotImplementedError
 
+    def get_stored_public_key(self, record: dict) -> PubKey:
+        raise NotImplementedError
+
     async def get_max_gap(self):
         raise NotImplementedError
 
@@ -114,6 +120,12 @@ class HierarchicalDeterministic(AddressManager):
     def get_public_key(self, index: int) -> PubKey:
         return self.account.public_key.child(self.chain_number).child(index)
 
+    def get_stored_public_key(self, record: dict) -> PubKey:
+        return PubKey(
+            self.account.ledger, record['pubkey'], record['chain_code'],
+            record['position'], self.public_key.depth + 1, self.public_key
+        )
+
     async def get_max_gap(self) -> int:
         addresses = await self._query_addresses(order_by="position ASC")
         max_gap = 0
@@ -149,10 +161,22 @@ class HierarchicalDeterministic(AddressManager):
     async def _generate_keys(self, start: int, end: int) -> List[str]:
         if not self.address_generator_lock.locked():
             raise RuntimeError('Should not be called outside of address_generator_lock.')
-        keys = [(index, self.public_key.child(index)) for index in range(start, end+1)]
+        loop = asyncio.get_running_loop()
+        batches = await asyncio.gather(*(
+            loop.run_in_executor(None, self._derive_keys, batch, min(batch+KEY_BATCH_SIZE, end+1))
+            for batch in range(start, end+1, KEY_BATCH_SIZE)
+        ))
+        keys = [key for batch in batches for key in batch]
         await self.account.ledger.db.add_keys(self.account, self.chain_number, keys)
         return [key[1].address for key in keys]
 
+    def _derive_keys(self, start: int, end: int) -> List[Tuple[int, PubKey]]:
+        keys = [(index, self.public_key.child(index)) for index in range(start, end)]
+        for _, key in keys:
+            # cached property, hashing it here keeps that off the event loop as well
+            key.address  # pylint: disable=pointless-statement
+        return keys
+
     def get_address_records(self, only_usable: bool = False, **constraints):
         if only_usable:
             constraints['used_times__lt'] = self.maximum_uses_per_address
@@ -183,6 +207,9 @@ class SingleKey(AddressManager):
     def get_public_key(self, index: int) -> PubKey:
         return self.account.public_key
 
+    def get_stored_public_key(self, record: dict) -> PubKey:
+        return self.account.public_key
+
     async def get_max_gap(self) -> int:
         return 0
 
@@ -402,6 +429,9 @@ class BaseAccount:
     def get_public_key(self, chain: int, index: int) -> PubKey:
         return self.address_managers[chain].get_public_key(index)
 
+    def get_stored_public_key(self, record: dict) -> PubKey:
+        return self.address_managers[record['chain']].get_stored_public_key(record)
+
     def get_balance(self, confirmations: int = 0, **constraints):
         if confirmations > 0:
             height = self.ledger.headers.height - (confirmations-1)
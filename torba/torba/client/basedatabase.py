@@ -1,7 +1,10 @@
+import os
 import logging
 import asyncio
+import threading
 from binascii import hexlify
 from concurrent.futures.thread import ThreadPoolExecutor
+from urllib.request import pathname2url
 
 from typing import Tuple, List, Union, Callable, Any, Awaitable, Iterable, Dict, Optional
 
@@ -15,24 +18,51 @@ log = logging.getLogger(__name__)
 
 class AIOSQLite:
 
+    # read-only connections used by execute_fetchall and execute_fetchone
+    reader_count = 4
+
     def __init__(self):
         # has to be single threaded as there is no mapping of thread:connection
         self.executor = ThreadPoolExecutor(max_workers=1)
         self.connection: sqlite3.Connection = None
+        self.reader_executor: Optional[ThreadPoolExecutor] = None
+        self.readers: List[sqlite3.Connection] = []
+        self._reader_local = threading.local()
         self._closing = False
 
     @classmethod
     async def connect(cls, path: Union[bytes, str], *args, **kwargs):
         def _connect():
-            return sqlite3.connect(path, *args, **kwargs)
+            connection = sqlite3.connect(path, *args, **kwargs)
+            if is_file:
+                # readers don't block the writer, nor the writer the readers
+                connection.execute('pragma journal_mode=WAL')
+            return connection
+        path = os.fsdecode(path)
+        is_file = path != ':memory:' and not path.startswith('file:')
         db = cls()
         db.connection = await asyncio.get_event_loop().run_in_executor(db.executor, _connect)
+        if is_file and cls.reader_count:
+            db.reader_executor = ThreadPoolExecutor(
+                max_workers=cls.reader_count, initializer=db._connect_reader,
+                initargs=(f'file:{pathname2url(path)}?mode=ro', kwargs)
+            )
         return db
 
+    def _connect_reader(self, uri, kwargs):
+        kwargs = dict(kwargs, uri=True, isolation_level=None, check_same_thread=False)
+        self._reader_local.connection = sqlite3.connect(uri, **kwargs)
+        self.readers.append(self._reader_local.connection)
+
     async def close(self):
         if self._closing:
             return
         self._closing = True
+        if self.reader_executor is not None:
+            self.reader_executor.shutdown(wait=True)
+            for reader in self.readers:
+                reader.close()
+            self.readers.clear()
         await asyncio.get_event_loop().run_in_executor(self.executor, self.connection.close)
         self.executor.shutdown(wait=True)
         self.connection = None
@@ -47,16 +77,26 @@ class AIOSQLite:
 
     def execute_fetchall(self, sql: str, parameters: Iterable = None) -> Awaitable[Iterable[sqlite3.Row]]:
         parameters = parameters if parameters is not None else []
-        return self.run(lambda conn: conn.execute(sql, parameters).fetchall())
+        return self.read(lambda conn: conn.execute(sql, parameters).fetchall())
 
     def execute_fetchone(self, sql: str, parameters: Iterable = None) -> Awaitable[Iterable[sqlite3.Row]]:
         parameters = parameters if parameters is not None else []
-        return self.run(lambda conn: conn.execute(sql, parameters).fetchone())
+        return self.read(lambda conn: conn.execute(sql, parameters).fetchone())
 
     def execute(self, sql: str, parameters: Iterable = None) -> Awaitable[sqlite3.Cursor]:
         parameters = parameters if parameters is not None else []
         return self.run(lambda conn: conn.execute(sql, parameters))
 
+    def read(self, fun, *args, **kwargs) -> Awaitable:
+        """ Run a read-only function on one of the reader connections, outside of a
+            transaction, so it doesn't wait for the writer. In memory databases
+            can't be shared between connections and are read by the writer. """
+        if self.reader_executor is None:
+            return self.run(fun, *args, **kwargs)
+        return asyncio.get_event_loop().run_in_executor(
+            self.reader_executor, lambda: fun(self._reader_local.connection, *args, **kwargs)
+        )
+
     def run(self, fun, *args, **kwargs) -> Awaitable:
         return asyncio.get_event_loop().run_in_executor(
             self.executor, lambda: self.__run_transaction(fun, *args, **kwargs)
@@ -285,7 +325,7 @@ class SQLiteMixin:
 
 class BaseDatabase(SQLiteMixin):
 
-    SCHEMA_VERSION = "1.0"
+    SCHEMA_VERSION = "1.2"
 
     PRAGMAS = """
         pragma journal_mode=WAL;
@@ -298,6 +338,7 @@ class BaseDatabase(SQLiteMixin):
             chain integer not null,
             position integer not null,
             pubkey blob not null,
+            chain_code blob not null,
             history text,
             used_times integer not null default 0
         );
@@ -343,6 +384,32 @@ class BaseDatabase(SQLiteMixin):
         create index if not exists txi_txoid_idx on txi (txoid);
     """
 
+    # unspent outputs, kept in step with txo and txi by _transaction_io,
+    # txo_type is set by subclasses which classify their outputs
+    CREATE_UTXO_TABLE = """
+        create table if not exists utxo (
+            txoid text primary key,
+            account text not null,
+            txo_type integer not null default 0,
+            amount integer not null,
+            height integer not null,
+            is_reserved boolean not null default 0
+        ) without rowid;
+        create index if not exists utxo_account_idx on utxo (account, is_reserved);
+    """
+
+    # sums of the utxo amounts of each account and txo_type
+    CREATE_BALANCE_TABLE = """
+        create table if not exists balance (
+            account text not null,
+            txo_type integer not null default 0,
+            confirmed integer not null default 0,
+            unconfirmed integer not null default 0,
+            reserved integer not null default 0,
+            primary key (account, txo_type)
+        ) without rowid;
+    """
+
     CREATE_TABLES_QUERY = (
         PRAGMAS +
         CREATE_TX_TABLE +
@@ -351,7 +418,9 @@ class BaseDatabase(SQLiteMixin):
         CREATE_TXO_TABLE +
         CREATE_TXO_INDEX +
         CREATE_TXI_TABLE +
-        CREATE_TXI_INDEX
+        CREATE_TXI_INDEX +
+        CREATE_UTXO_TABLE +
+        CREATE_BALANCE_TABLE
     )
 
     @staticmethod
@@ -376,21 +445,80 @@ class BaseDatabase(SQLiteMixin):
         }
 
     async def insert_transaction(self, tx):
-        await self.db.execute_fetchall(*self._insert_sql('tx', self.tx_to_row(tx)))
+        await self.db.execute(*self._insert_sql('tx', self.tx_to_row(tx)))
 
     async def update_transaction(self, tx):
-        await self.db.execute_fetchall(*self._update_sql("tx", {
+        await self.db.execute(*self._update_sql("tx", {
             'height': tx.height, 'position': tx.position, 'is_verified': tx.is_verified
         }, 'txid = ?', (tx.id,)))
 
+    @staticmethod
+    def _add_to_balance(conn: sqlite3.Connection, utxo: Tuple, sign: int = 1):
+        account, txo_type, amount, height, is_reserved = utxo
+        column = 'reserved' if is_reserved else 'confirmed' if height > 0 else 'unconfirmed'
+        conn.execute(
+            "INSERT OR IGNORE INTO balance (account, txo_type) VALUES (?, ?)", (account, txo_type)
+        )
+        conn.execute(
+            f"UPDATE balance SET {column} = {column} + ? WHERE account = ? AND txo_type = ?",
+            (sign * amount, account, txo_type)
+        )
+
+    def _insert_utxo(self, conn: sqlite3.Connection, txoid, utxo: Tuple):
+        conn.execute(
+            "INSERT INTO utxo (txoid, account, txo_type, amount, height, is_reserved) "
+            "VALUES (?, ?, ?, ?, ?, ?)", (txoid, *utxo)
+        )
+        self._add_to_balance(conn, utxo)
+
+    @staticmethod
+    def _select_utxo(conn: sqlite3.Connection, txoid) -> Optional[Tuple]:
+        return conn.execute(
+            "SELECT account, txo_type, amount, height, is_reserved FROM utxo WHERE txoid = ?", (txoid,)
+        ).fetchone()
+
+    def _update_utxo(self, conn: sqlite3.Connection, txoid, height=None, is_reserved=None):
+        utxo = self._select_utxo(conn, txoid)
+        if utxo is None:
+            return
+        account, txo_type, amount, old_height, old_is_reserved = utxo
+        updated = (
+            account, txo_type, amount,
+            old_height if height is None else height,
+            old_is_reserved if is_reserved is None else is_reserved
+        )
+        if updated != utxo:
+            conn.execute(
+                "UPDATE utxo SET height = ?, is_reserved = ? WHERE txoid = ?", (*updated[3:], txoid)
+            )
+            self._add_to_balance(conn, utxo, -1)
+            self._add_to_balance(conn, updated)
+
+    def _delete_utxo(self, conn: sqlite3.Connection, txoid):
+        utxo = self._select_utxo(conn, txoid)
+        if utxo is not None:
+            conn.execute("DELETE FROM utxo WHERE txoid = ?", (txoid,))
+            self._add_to_balance(conn, utxo, -1)
+
     def _transaction_io(self, conn: sqlite3.Connection, tx: BaseTransaction, address, txhash, history):
         conn.execute(*self._insert_sql('tx', self.tx_to_row(tx), replace=True))
+        account = None
 
         for txo in tx.outputs:
             if txo.script.is_pay_pubkey_hash and txo.script.values['pubkey_hash'] == txhash:
-                conn.execute(*self._insert_sql(
-                    "txo", self.txo_to_row(tx, address, txo), ignore_duplicate=True
-                )).fetchall()
+                row = self.txo_to_row(tx, address, txo)
+                cursor = conn.execute(*self._insert_sql("txo", row, ignore_duplicate=True))
+                cursor.fetchall()
+                if not cursor.rowcount:
+                    self._update_utxo(conn, txo.id, height=tx.height)
+                elif not conn.execute("SELECT 1 FROM txi WHERE txoid = ?", (txo.id,)).fetchone():
+                    if account is None:
+                        account, = conn.execute(
+                            "SELECT account FROM pubkey_address WHERE address = ?", (address,)
+                        ).fetchone()
+                    self._insert_utxo(
+                        conn, txo.id, (account, row.get('txo_type', 0), txo.amount, tx.height, False)
+                    )
             elif txo.script.is_pay_script_hash:
                 # TODO: implement script hash payments
                 log.warning('Database.save_transaction_io: pay script hash is not implemented!')
@@ -404,6 +532,7 @@ class BaseDatabase(SQLiteMixin):
                         'txoid': txo.id,
                         'address': address,
                     }, ignore_duplicate=True)).fetchall()
+                    self._delete_utxo(conn, txo.id)
 
         conn.execute(
             "UPDATE pubkey_address SET history = ?, used_times = ? WHERE address = ?",
@@ -419,13 +548,28 @@ class BaseDatabase(SQLiteMixin):
                 self._transaction_io(conn, tx, address, txhash, history)
         return self.db.run(__many)
 
+    def _reserve_outputs(self, conn: sqlite3.Connection, txoids, is_reserved):
+        for txoid in txoids:
+            conn.execute("UPDATE txo SET is_reserved = ? WHERE txoid = ?", (is_reserved, txoid))
+            self._update_utxo(conn, txoid, is_reserved=is_reserved)
+
     async def reserve_outputs(self, txos, is_reserved=True):
-        txoids = ((is_reserved, txo.id) for txo in txos)
-        await self.db.executemany("UPDATE txo SET is_reserved = ? WHERE txoid = ?", txoids)
+        await self.db.run(self._reserve_outputs, [txo.id for txo in txos], is_reserved)
 
     async def release_outputs(self, txos):
         await self.reserve_outputs(txos, is_reserved=False)
 
+    def _release_all_outputs(self, conn: sqlite3.Connection, account_address):
+        self._reserve_outputs(conn, [row[0] for row in conn.execute(
+            "SELECT txoid FROM txo WHERE"
+            "  is_reserved = 1 AND txo.address IN ("
+            "    SELECT address from pubkey_address WHERE account = ?"
+            "  )", (account_address,)
+        ).fetchall()], False)
+
+    async def release_all_outputs(self, account):
+        await self.db.run(self._release_all_outputs, account.public_key.address)
+
     async def rewind_blockchain(self, above_height):  # pylint: disable=no-self-use
         # TODO:
         # 1. delete transactions above_height
@@ -569,8 +713,15 @@ class BaseDatabase(SQLiteMixin):
 
     @staticmethod
     def constrain_utxo(constraints):
-        constraints['is_reserved'] = False
-        constraints['txoid__not_in'] = "SELECT txoid FROM txi"
+        utxos = "SELECT txoid FROM utxo WHERE is_reserved = 0"
+        accounts = constraints.get('accounts')
+        if accounts is not None:
+            constraints.update({
+                f'$utxo_account{i}': a.public_key.address for i, a in enumerate(accounts)
+            })
+            account_values = ', '.join([f':$utxo_account{i}' for i in range(len(accounts))])
+            utxos += f" AND account IN ({account_values})"
+        constraints['txoid__in#utxo'] = utxos
 
     def get_utxos(self, **constraints):
         self.constrain_utxo(constraints)
@@ -580,7 +731,21 @@ class BaseDatabase(SQLiteMixin):
         self.constrain_utxo(constraints)
         return self.get_txo_count(**constraints)
 
+    async def get_utxo_amounts(self, **constraints):
+        """ The txoid, amount and height of unreserved unspent outputs, largest first,
+            read from the utxo table alone. """
+        constraints['is_reserved'] = False
+        constraints.setdefault('order_by', 'amount DESC')
+        return await self.db.execute_fetchall(*query(
+            "SELECT txoid, amount, height FROM utxo", **constraints
+        ))
+
     async def get_balance(self, **constraints):
+        if all(key == 'accounts' or key.split('__')[0] == 'txo_type' for key in constraints):
+            balance = await self.db.execute_fetchall(*query(
+                "SELECT SUM(confirmed + unconfirmed) FROM balance", **constraints
+            ))
+            return balance[0][0] or 0
         self.constrain_utxo(constraints)
         balance = await self.select_txos('SUM(amount)', **constraints)
         return balance[0][0] or 0
@@ -601,7 +766,7 @@ class BaseDatabase(SQLiteMixin):
 
     async def get_address(self, **constraints):
         addresses = await self.get_addresses(
-            cols=('address', 'account', 'chain', 'position', 'pubkey', 'history', 'used_times'),
+            cols=('address', 'account', 'chain', 'position', 'pubkey', 'chain_code', 'history', 'used_times'),
             limit=1, **constraints
         )
         if addresses:
@@ -609,16 +774,17 @@ class BaseDatabase(SQLiteMixin):
 
     async def add_keys(self, account, chain, keys):
         await self.db.executemany(
-            "insert into pubkey_address (address, account, chain, position, pubkey) values (?, ?, ?, ?, ?)",
+            "insert into pubkey_address (address, account, chain, position, pubkey, chain_code) "
+            "values (?, ?, ?, ?, ?, ?)",
             (
                 (pubkey.address, account.public_key.address, chain, position,
-                 sqlite3.Binary(pubkey.pubkey_bytes))
+                 sqlite3.Binary(pubkey.pubkey_bytes), sqlite3.Binary(pubkey.chain_code))
                 for position, pubkey in keys
             )
         )
 
     async def _set_address_history(self, address, history):
-        await self.db.execute_fetchall(
+        await self.db.execute(
             "UPDATE pubkey_address SET history = ?, used_times = ? WHERE address = ?",
             (history, history.count(':')//2, address)
         )
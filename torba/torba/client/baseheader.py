@@ -1,7 +1,14 @@
 import os
+import mmap
+import struct
+import asyncio
 import logging
 from io import BytesIO
-from typing import Optional, Iterator, Tuple
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, chain
+from concurrent.futures import Executor
+from typing import Dict, Iterable, List, Optional, Iterator, Tuple
 from binascii import hexlify
 
 from torba.client.util import ArithUint256
@@ -17,23 +24,42 @@ class InvalidHeader(Exception):
         self.message = message
         self.height = height
 
+    def __reduce__(self):
+        # raised in worker processes
+        return InvalidHeader, (self.height, self.message)
+
 
 class BaseHeaders:
 
     header_size: int
     chunk_size: int
+    # where the fields read without deserializing the header are
+    merkle_root_offset = 36
+    timestamp_offset: int
+    bits_offset: int
 
     max_target: int
     genesis_hash: Optional[bytes]
     target_timespan: int
 
     validate_difficulty: bool = True
+    # Known block hashes by height.  Headers linked to a checkpoint in the
+    # same chunk are only checked for it, not for their proof of work, so
+    # checkpoints should be less than a chunk or download apart.
+    checkpoints: Dict[int, bytes] = {}
+    # headers validated at a time by the executor
+    validation_slice_size = 250
 
     def __init__(self, path) -> None:
         if path == ':memory:':
             self.io = BytesIO()
         self.path = path
         self._size: Optional[int] = None
+        # validates chunks off the event loop, the loop's default executor if None
+        self.executor: Optional[Executor] = None
+        self._mmap: Optional[mmap.mmap] = None
+        # the largest timestamp up to each height, they only roughly increase
+        self._timestamps = array('L')
 
     async def open(self):
         if self.path != ':memory:':
@@ -43,8 +69,30 @@ class BaseHeaders:
                 self.io = open(self.path, 'r+b')
 
     async def close(self):
+        self._unmap()
         self.io.close()
 
+    def _buffer(self):
+        """Return the headers as a buffer, mapping the file in memory."""
+        if isinstance(self.io, BytesIO):
+            return self.io.getbuffer()
+        if self._mmap is None or len(self._mmap) < self.bytes_size:
+            self._unmap()
+            if not self.bytes_size:
+                return b''
+            self._mmap = mmap.mmap(self.io.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _unmap(self):
+        # before the file is truncated, which can't be while it is mapped
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _truncated(self, height):
+        self._unmap()
+        del self._timestamps[height:]
+
     @staticmethod
     def serialize(header: dict) -> bytes:
         raise NotImplementedError
@@ -77,8 +125,41 @@ class BaseHeaders:
         return self.deserialize(height, self.get_raw_header(height))
 
     def get_raw_header(self, height) -> bytes:
-        self.io.seek(height * self.header_size, os.SEEK_SET)
-        return self.io.read(self.header_size)
+        start = height * self.header_size
+        return bytes(self._buffer()[start:start + self.header_size])
+
+    def _field_offset(self, height, offset):
+        if not 0 <= height <= self.height:
+            raise IndexError(f"{height} is out of bounds, current height: {self.height}")
+        return height * self.header_size + offset
+
+    def _read_hash(self, height, offset) -> bytes:
+        start = self._field_offset(height, offset)
+        return hexlify(bytes(self._buffer()[start:start + 32])[::-1])
+
+    def get_merkle_root(self, height) -> bytes:
+        return self._read_hash(height, self.merkle_root_offset)
+
+    def get_timestamp(self, height) -> int:
+        return struct.unpack_from('<I', self._buffer(), self._field_offset(height, self.timestamp_offset))[0]
+
+    def get_bits(self, height) -> int:
+        return struct.unpack_from('<I', self._buffer(), self._field_offset(height, self.bits_offset))[0]
+
+    def get_heights_for_timestamps(self, timestamps: Iterable[int]) -> List[int]:
+        """Return the height of the first block at or after each timestamp,
+        len(self) for those past the last block."""
+        indexed = len(self._timestamps)
+        if indexed < len(self):
+            timestamp = struct.Struct(
+                f'<{self.timestamp_offset}xI{self.header_size - self.timestamp_offset - 4}x'
+            )
+            buffer = self._buffer()
+            unindexed = buffer[indexed * self.header_size:self.bytes_size]
+            new = (value for value, in timestamp.iter_unpack(unindexed))
+            previous = [self._timestamps[-1]] if indexed else []
+            self._timestamps.extend(list(accumulate(chain(previous, new), max))[len(previous):])
+        return [bisect_left(self._timestamps, timestamp) for timestamp in timestamps]
 
     @property
     def height(self) -> int:
@@ -104,13 +185,13 @@ class BaseHeaders:
         bail = False
         for height, chunk in self._iterate_chunks(start, headers):
             try:
-                # validate_chunk() is CPU bound and reads previous chunks from file system
-                self.validate_chunk(height, chunk)
+                await self.validate_chunk_in_executor(height, chunk)
             except InvalidHeader as e:
                 bail = True
                 chunk = chunk[:(height-e.height)*self.header_size]
             written = 0
             if chunk:
+                self._truncated(height)
                 self.io.seek(height * self.header_size, os.SEEK_SET)
                 written = self.io.write(chunk) // self.header_size
                 self.io.truncate()
@@ -123,7 +204,7 @@ class BaseHeaders:
                 break
         return added
 
-    def validate_chunk(self, height, chunk):
+    def _validation_context(self, height, chunk):
         previous_hash, previous_header, previous_previous_header = None, None, None
         if height > 0:
             previous_header = self[height-1]
@@ -131,15 +212,54 @@ class BaseHeaders:
         if height > 1:
             previous_previous_header = self[height-2]
         chunk_target = self.get_next_chunk_target(height // 2016 - 1)
-        for current_hash, current_header in self._iterate_headers(height, chunk):
+        end = height + len(chunk) // self.header_size
+        checkpoint = max((h for h in self.checkpoints if height <= h < end), default=-1)
+        return previous_hash, previous_header, previous_previous_header, chunk_target, checkpoint
+
+    def validate_chunk(self, height, chunk):
+        self.validate_headers(height, height, chunk, *self._validation_context(height, chunk))
+
+    async def validate_chunk_in_executor(self, height, chunk):
+        """Validate the chunk in slices, at the same time in the executor.
+        The headers before a slice are in the chunk, or the file for the
+        first one, so only reading those stays on the event loop."""
+        previous_hash, previous_header, previous_previous_header, chunk_target, checkpoint = \
+            self._validation_context(height, chunk)
+        loop = asyncio.get_event_loop()
+        size = self.header_size
+        step = self.validation_slice_size * size
+        validations = []
+        for offset in range(0, len(chunk), step):
+            start = height + offset // size
+            if offset:
+                previous_hash = self.hash_header(chunk[offset-size:offset])
+                previous_header = self.deserialize(start-1, chunk[offset-size:offset])
+                previous_previous_header = self.deserialize(start-2, chunk[offset-2*size:offset-size])
+            validations.append(loop.run_in_executor(
+                self.executor, validate_headers, type(self), height, start, chunk[offset:offset+step],
+                previous_hash, previous_header, previous_previous_header, chunk_target, checkpoint
+            ))
+        await asyncio.gather(*validations)
+
+    def validate_headers(self, height, start, headers, previous_hash, previous_header,
+                         previous_previous_header, chunk_target, checkpoint=-1):
+        """Validate headers from height start of the chunk at height."""
+        iterator = enumerate(self._iterate_headers(start, headers), start)
+        for current_height, (current_hash, current_header) in iterator:
+            if current_height in self.checkpoints and self.checkpoints[current_height] != current_hash:
+                raise InvalidHeader(
+                    height, "checkpoint mismatch: {} vs expected {}".format(
+                        current_hash.decode(), self.checkpoints[current_height].decode())
+                )
             block_target = self.get_next_block_target(chunk_target, previous_previous_header, previous_header)
-            self.validate_header(height, current_hash, current_header, previous_hash, block_target)
+            self.validate_header(height, current_hash, current_header, previous_hash, block_target,
+                                 check_work=current_height > checkpoint)
             previous_previous_header = previous_header
             previous_header = current_header
             previous_hash = current_hash
 
     def validate_header(self, height: int, current_hash: bytes,
-                        header: dict, previous_hash: bytes, target: ArithUint256):
+                        header: dict, previous_hash: bytes, target: ArithUint256, check_work=True):
 
         if previous_hash is None:
             if self.genesis_hash is not None and self.genesis_hash != current_hash:
@@ -155,7 +275,7 @@ class BaseHeaders:
                     header['prev_block_hash'].decode(), previous_hash.decode())
             )
 
-        if self.validate_difficulty:
+        if self.validate_difficulty and check_work:
 
             if header['bits'] != target.compact:
                 raise InvalidHeader(
@@ -188,6 +308,7 @@ class BaseHeaders:
                         fail = True
                 if fail:
                     log.warning("Header file corrupted at height %s, truncating it.", height - 1)
+                    self._truncated(max(0, height - 1))
                     self.io.seek(max(0, (height - 1)) * self.header_size, os.SEEK_SET)
                     self.io.truncate()
                     self.io.flush()
@@ -214,3 +335,9 @@ class BaseHeaders:
             start, end = idx * self.header_size, (idx + 1) * self.header_size
             header = headers[start:end]
             yield self.hash_header(header), self.deserialize(height+idx, header)
+
+
+def validate_headers(headers_class, *args):
+    # run by executors, which may be process pools, on a new instance so
+    # validation is configured by class attributes
+    headers_class(':memory:').validate_headers(*args)
@@ -1,13 +1,18 @@
 import os
+import json
+import zlib
+import base64
 import asyncio
 import logging
 from functools import partial
 from binascii import hexlify, unhexlify
 from io import StringIO
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 
 from typing import Dict, Type, Iterable, List, Optional
 from operator import itemgetter
-from collections import namedtuple
+from collections import namedtuple, deque
 
 import pylru
 from torba.client.basetransaction import BaseTransaction
@@ -15,9 +20,10 @@ from torba.tasks import TaskGroup
 from torba.client import baseaccount, basenetwork, basetransaction
 from torba.client.basedatabase import BaseDatabase
 from torba.client.baseheader import BaseHeaders
-from torba.client.coinselection import CoinSelector
+from torba.client.coinselection import CoinSelector, Coin
 from torba.client.constants import COIN, NULL_HASH32
 from torba.stream import StreamController
+from torba.blockfilter import filter_header, script_element, match_filters
 from torba.client.hash import hash160, double_sha256, sha256, Base58
 from torba.client.bip32 import PubKey, PrivateKey
 
@@ -96,6 +102,20 @@ class BaseLedger(metaclass=LedgerRegistry):
     extended_private_key_prefix: bytes
 
     default_fee_per_byte = 10
+    # compressed header chunks, or ranges of headers, to download at a time
+    concurrent_chunk_downloads = 8
+    # processes validating headers, 0 to validate them in a thread instead
+    header_validation_workers = min(os.cpu_count() or 1, 4)
+    # block filters to download at a time when scanning them
+    filter_batch_size = 1000
+    # servers to ask for block filters the main server has the headers of,
+    # each request goes to a server picked at random
+    filter_attempts = 3
+    # batches of block filters kept by a filter sync to scan them for the
+    # addresses generated meanwhile
+    filter_cache_batches = 10
+    # blocks to scan again after a reorganization, as many as update_headers() rewinds
+    filter_reorg_depth = 100
 
     def __init__(self, config=None):
         self.config = config or {}
@@ -146,6 +166,14 @@ class BaseLedger(metaclass=LedgerRegistry):
         self.coin_selection_strategy = None
         self._known_addresses_out_of_sync = set()
 
+        # With filter_sync addresses aren't subscribed to, instead the
+        # block filters are scanned for them and only the history of
+        # matching addresses is fetched
+        self.filter_sync = self.config.get('filter_sync', False)
+        self._filter_sync_lock = asyncio.Lock()
+        self._filter_state = None
+        self._unscanned_addresses = set()
+
     @classmethod
     def get_id(cls):
         return '{}_{}'.format(cls.symbol.lower(), cls.network_name.lower())
@@ -197,7 +225,7 @@ class BaseLedger(metaclass=LedgerRegistry):
         match = await self._get_account_and_address_info_for_address(address)
         if match:
             account, address_info = match
-            return account.get_public_key(address_info['chain'], address_info['position'])
+            return account.get_stored_public_key(address_info)
         return None
 
     async def get_account_for_address(self, address):
@@ -215,10 +243,15 @@ class BaseLedger(metaclass=LedgerRegistry):
 
     async def get_addresses(self, **constraints):
         self.constraint_account_or_all(constraints)
-        addresses = await self.db.get_addresses(**constraints)
+        accounts = {account.public_key.address: account for account in constraints['accounts']}
+        addresses = await self.db.get_addresses(
+            cols=('address', 'account', 'chain', 'position', 'used_times', 'pubkey', 'chain_code'),
+            **constraints
+        )
         for address in addresses:
-            public_key = await self.get_public_key_for_address(address['address'])
+            public_key = accounts[address['account']].get_stored_public_key(address)
             address['public_key'] = public_key.extended_key_string()
+            del address['pubkey'], address['chain_code']
         return addresses
 
     def get_address_count(self, **constraints):
@@ -227,10 +260,26 @@ class BaseLedger(metaclass=LedgerRegistry):
 
     async def get_spendable_utxos(self, amount: int, funding_accounts):
         async with self._utxo_reservation_lock:
-            txos = await self.get_effective_amount_estimators(funding_accounts)
-            fee = self.transaction_class.output_class.pay_pubkey_hash(COIN, NULL_HASH32).get_fee(self)
+            output = self.transaction_class.output_class.pay_pubkey_hash(COIN, NULL_HASH32)
+            fee = output.get_fee(self)
+            # every spendable output is spent by the same kind of input
+            input_fee = self.transaction_class().add_outputs([output]).outputs[0].get_estimator(self).fee
+            coins = [
+                Coin(txoid, utxo_amount - input_fee, input_fee, height) for txoid, utxo_amount, height
+                in await self.get_utxo_amounts(accounts=funding_accounts)
+            ]
             selector = CoinSelector(amount, fee)
-            spendables = selector.select(txos, self.coin_selection_strategy)
+            selected = await asyncio.get_event_loop().run_in_executor(
+                None, selector.select, coins, self.coin_selection_strategy
+            )
+            # only the selected outputs are loaded
+            txoids = [coin.txoid for coin in selected]
+            txos = {}
+            for offset in range(0, len(txoids), self.db.MAX_QUERY_VARIABLES):
+                txos.update({txo.id: txo for txo in await self.get_utxos(
+                    accounts=funding_accounts, txoid__in=txoids[offset:offset+self.db.MAX_QUERY_VARIABLES]
+                )})
+            spendables = [txos[txoid].get_estimator(self) for txoid in txoids if txoid in txos]
             if spendables:
                 await self.reserve_outputs(s.txo for s in spendables)
             return spendables
@@ -261,6 +310,10 @@ class BaseLedger(metaclass=LedgerRegistry):
         self.constraint_account_or_all(constraints)
         return self.db.get_utxo_count(**constraints)
 
+    def get_utxo_amounts(self, **constraints):
+        self.constraint_account_or_all(constraints)
+        return self.db.get_utxo_amounts(**constraints)
+
     def get_transactions(self, **constraints):
         self.constraint_account_or_all(constraints)
         return self.db.get_transactions(**constraints)
@@ -269,13 +322,17 @@ class BaseLedger(metaclass=LedgerRegistry):
         self.constraint_account_or_all(constraints)
         return self.db.get_transaction_count(**constraints)
 
+    @staticmethod
+    def get_status(history: str) -> Optional[str]:
+        return hexlify(sha256(history.encode())).decode() if history else None
+
     async def get_local_status_and_history(self, address, history=None):
         if not history:
             address_details = await self.db.get_address(address=address)
             history = address_details['history'] or ''
         parts = history.split(':')[:-1]
         return (
-            hexlify(sha256(history.encode())).decode() if history else None,
+            self.get_status(history),
             list(zip(parts[0::2], map(int, parts[1::2])))
         )
 
@@ -298,6 +355,9 @@ class BaseLedger(metaclass=LedgerRegistry):
             self.db.open(),
             self.headers.open()
         ])
+        workers = self.config.get('header_validation_workers', self.header_validation_workers)
+        if workers and self.headers.executor is None:
+            self.headers.executor = ProcessPoolExecutor(max_workers=workers)
         first_connection = self.network.on_connected.first
         asyncio.ensure_future(self.network.start())
         await first_connection
@@ -307,6 +367,7 @@ class BaseLedger(metaclass=LedgerRegistry):
     async def join_network(self, *_):
         log.info("Subscribing and updating accounts.")
         async with self._header_processing_lock:
+            await self.sync_compressed_chunks()
             await self.update_headers()
         await self.subscribe_accounts()
         await self._update_tasks.done.wait()
@@ -317,77 +378,158 @@ class BaseLedger(metaclass=LedgerRegistry):
         await self.network.stop()
         await self.db.close()
         await self.headers.close()
+        if self.headers.executor is not None:
+            self.headers.executor.shutdown()
+            self.headers.executor = None
+
+    def _download_headers(self, downloads, height):
+        """Return the download of the headers from height, starting the
+        downloads of the ranges after it up to the server's height."""
+        for start in range(height, height + self.concurrent_chunk_downloads * 2001, 2001):
+            if start not in downloads and (start == height or start <= self.network.remote_height):
+                downloads[start] = asyncio.ensure_future(
+                    self.network.retriable_call(self.network.get_headers, start, 2001)
+                )
+        return downloads.pop(height)
 
     async def update_headers(self, height=None, headers=None, subscription_update=False):
         rewound = 0
-        while True:
-
-            if height is None or height > len(self.headers):
-                # sometimes header subscription updates are for a header in the future
-                # which can't be connected, so we do a normal header sync instead
-                height = len(self.headers)
-                headers = None
-                subscription_update = False
-
-            if not headers:
-                header_response = await self.network.retriable_call(self.network.get_headers, height, 2001)
-                headers = header_response['hex']
-
-            if not headers:
-                # Nothing to do, network thinks we're already at the latest height.
-                return
-
-            added = await self.headers.connect(height, unhexlify(headers))
-            if added > 0:
-                height += added
-                self._on_header_controller.add(
-                    BlockHeightEvent(self.headers.height, added))
-
-                if rewound > 0:
-                    # we started rewinding blocks and apparently found
-                    # a new chain
-                    rewound = 0
-                    await self.db.rewind_blockchain(height)
-
-                if subscription_update:
-                    # subscription updates are for latest header already
-                    # so we don't need to check if there are newer / more
-                    # on another loop of update_headers(), just return instead
+        downloads = {}
+        try:
+            while True:
+
+                if height is None or height > len(self.headers):
+                    # sometimes header subscription updates are for a header in the future
+                    # which can't be connected, so we do a normal header sync instead
+                    height = len(self.headers)
+                    headers = None
+                    subscription_update = False
+
+                if not headers:
+                    header_response = await self._download_headers(downloads, height)
+                    headers = header_response['hex']
+
+                if not headers:
+                    # Nothing to do, network thinks we're already at the latest height.
                     return
 
-            elif added == 0:
-                # we had headers to connect but none got connected, probably a reorganization
-                height -= 1
-                rewound += 1
-                log.warning(
-                    "Blockchain Reorganization: attempting rewind to height %s from starting height %s",
-                    height, height+rewound
-                )
-
-            else:
-                raise IndexError("headers.connect() returned negative number ({})".format(added))
+                added = await self.headers.connect(height, unhexlify(headers))
+                if added * self.headers.header_size * 2 != len(headers):
+                    # the downloads past headers that didn't all connect may be of another chain
+                    for pending in downloads.values():
+                        pending.cancel()
+                    downloads.clear()
+                if added > 0:
+                    height += added
+                    self._on_header_controller.add(
+                        BlockHeightEvent(self.headers.height, added))
+
+                    if rewound > 0:
+                        # we started rewinding blocks and apparently found
+                        # a new chain
+                        rewound = 0
+                        await self.db.rewind_blockchain(height)
+
+                    if subscription_update:
+                        # subscription updates are for latest header already
+                        # so we don't need to check if there are newer / more
+                        # on another loop of update_headers(), just return instead
+                        return
+
+                elif added == 0:
+                    # we had headers to connect but none got connected, probably a reorganization
+                    height -= 1
+                    rewound += 1
+                    log.warning(
+                        "Blockchain Reorganization: attempting rewind to height %s from starting height %s",
+                        height, height+rewound
+                    )
 
-            if height < 0:
-                raise IndexError(
-                    "Blockchain reorganization rewound all the way back to genesis hash. "
-                    "Something is very wrong. Maybe you are on the wrong blockchain?"
-                )
-
-            if rewound >= 100:
-                raise IndexError(
-                    "Blockchain reorganization dropped {} headers. This is highly unusual. "
-                    "Will not continue to attempt reorganizing. Please, delete the ledger "
-                    "synchronization directory inside your wallet directory (folder: '{}') and "
-                    "restart the program to synchronize from scratch."
-                    .format(rewound, self.get_id())
-                )
-
-            headers = None  # ready to download some more headers
-
-            # if we made it this far and this was a subscription_update
-            # it means something went wrong and now we're doing a more
-            # robust sync, turn off subscription update shortcut
-            subscription_update = False
+                else:
+                    raise IndexError("headers.connect() returned negative number ({})".format(added))
+
+                if height < 0:
+                    raise IndexError(
+                        "Blockchain reorganization rewound all the way back to genesis hash. "
+                        "Something is very wrong. Maybe you are on the wrong blockchain?"
+                    )
+
+                if rewound >= 100:
+                    raise IndexError(
+                        "Blockchain reorganization dropped {} headers. This is highly unusual. "
+                        "Will not continue to attempt reorganizing. Please, delete the ledger "
+                        "synchronization directory inside your wallet directory (folder: '{}') and "
+                        "restart the program to synchronize from scratch."
+                        .format(rewound, self.get_id())
+                    )
+
+                headers = None  # ready to download some more headers
+
+                # if we made it this far and this was a subscription_update
+                # it means something went wrong and now we're doing a more
+                # robust sync, turn off subscription update shortcut
+                subscription_update = False
+        finally:
+            for pending in downloads.values():
+                pending.cancel()
+
+    async def _download_compressed_chunk(self, index, size, chunk_hash):
+        data = await self.network.retriable_call(self.network.get_compressed_chunk, index)
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        try:
+            headers = zlib.decompress(data or b'')
+        except zlib.error:
+            return None
+        header_size = self.headers.header_size
+        if len(headers) != size * header_size or \
+                self.headers.hash_header(headers[-header_size:]) != chunk_hash:
+            return None
+        return headers
+
+    async def sync_compressed_chunks(self):
+        """Download the headers past the server's reorg limit as zlib
+        compressed chunks, several at a time.  A chunk is identified by
+        the hash of its last header, so chunks already in the headers
+        file are not downloaded again.  update_headers() then gets the
+        remaining headers."""
+        response = await self.network.retriable_call(self.network.get_compressed_chunk_hashes)
+        if not response:
+            # the server doesn't have compressed chunks
+            return
+        size = response['size']
+        hashes = [chunk_hash.encode() for chunk_hash in response['hashes']]
+        start = min(len(self.headers) // size, len(hashes))
+        while start and self.headers.hash(start * size - 1) != hashes[start - 1]:
+            start -= 1
+        if start == len(hashes):
+            return
+        overwriting = start * size < len(self.headers)
+
+        indexes = iter(range(start, len(hashes)))
+
+        def download(index):
+            return asyncio.ensure_future(self._download_compressed_chunk(index, size, hashes[index]))
+
+        downloads = deque(download(index) for index in islice(indexes, self.concurrent_chunk_downloads))
+        try:
+            while downloads:
+                headers = await downloads.popleft()
+                downloads.extend(download(index) for index in islice(indexes, 1))
+                height = len(self.headers) if not overwriting else start * size
+                added = await self.headers.connect(height, headers) if headers else 0
+                if added != size:
+                    log.warning(
+                        "Invalid compressed header chunk at height %s, syncing the rest uncompressed.", height
+                    )
+                    return
+                if overwriting:
+                    overwriting = False
+                    await self.db.rewind_blockchain(height)
+                self._on_header_controller.add(BlockHeightEvent(self.headers.height, added))
+        finally:
+            for pending in downloads:
+                pending.cancel()
 
     async def receive_header(self, response):
         async with self._header_processing_lock:
@@ -395,6 +537,170 @@ class BaseLedger(metaclass=LedgerRegistry):
             await self.update_headers(
                 height=header['height'], headers=header['hex'], subscription_update=True
             )
+        if self.filter_sync:
+            self._update_tasks.add(self.sync_filters())
+
+    @property
+    def filter_state_path(self):
+        if 'data_path' in self.config:
+            return os.path.join(self.path, 'filter_state')
+
+    def _load_filter_state(self):
+        state = {'height': -1, 'block_hash': None, 'header': None}
+        path = self.filter_state_path
+        if path is not None and os.path.exists(path):
+            with open(path) as state_file:
+                state.update(json.load(state_file))
+        return state
+
+    def _save_filter_state(self):
+        path = self.filter_state_path
+        if path is not None:
+            with open(path, 'w') as state_file:
+                json.dump(self._filter_state, state_file)
+
+    async def scan_filters(self, start, end, addresses, prev_header=None, downloaded=None):
+        """Scan the block filters from start to end for addresses.
+
+        Returns the addresses that may have been used in those blocks and
+        the filter header at end, or None if the servers don't have the
+        filters or they don't match the filter headers.  prev_header is
+        the filter header before start, if known.  downloaded, if given,
+        is a cache of the filters of each batch, to scan them for more
+        addresses without downloading them again.  Filters are matched by
+        the executor of the headers while the next batches download."""
+        elements = {
+            script_element(self.transaction_class.output_class.script_class.pay_pubkey_hash(
+                self.address_to_hash160(address)).source): address
+            for address in addresses
+        }
+        queried = frozenset(elements)
+        loop = asyncio.get_event_loop()
+        matched = set()
+        matches = []
+        try:
+            height = start
+            while height <= end:
+                # batches start at multiples of the batch size, so scans of
+                # different ranges share them
+                count = min((height // self.filter_batch_size + 1) * self.filter_batch_size, end + 1) - height
+                batch = downloaded.get((height, count)) if downloaded is not None else None
+                if batch is None:
+                    if prev_header is None:
+                        prev_header = await self._get_filter_header(height - 1)
+                        if prev_header is None:
+                            return None
+                    batch = await self._download_filters(height, count, prev_header)
+                    if batch is None:
+                        return None
+                    if downloaded is not None:
+                        downloaded[(height, count)] = batch
+                block_filters, prev_header = batch
+                keys = [unhexlify(self.headers.hash(height + position))[::-1] for position in range(count)]
+                matches.append(loop.run_in_executor(
+                    self.headers.executor, match_filters, keys, block_filters, queried
+                ))
+                # as many batches are matched at a time as header chunks are downloaded
+                if len(matches) >= self.concurrent_chunk_downloads:
+                    matched.update(await matches.pop(0))
+                height += count
+            for batch_matches in await asyncio.gather(*matches):
+                matched.update(batch_matches)
+        finally:
+            for pending in matches:
+                pending.cancel()
+        return {elements[element] for element in matched}, prev_header
+
+    async def _get_filter_header(self, height):
+        if height < 0:
+            return bytes(32)
+        response = await self.network.retriable_call(self.network.get_filter_headers, height, 1)
+        if not response or not response['count']:
+            return None
+        return unhexlify(response['hex'])
+
+    async def _download_filters(self, height, count, prev_header):
+        """Return the block filters from height matching the filter headers
+        of the main server, and the filter header of the last."""
+        headers = await self.network.retriable_call(self.network.get_filter_headers, height, count)
+        if not headers or headers['count'] < count:
+            log.warning("Server has no block filter headers from height %s.", height)
+            return None
+        headers = unhexlify(headers['hex'])
+        for _ in range(self.filter_attempts):
+            filters = await self.network.retriable_call(self.network.get_filters, height, count)
+            if not filters or len(filters) < count:
+                log.warning("Server has no block filters from height %s, asking another.", height)
+                continue
+            header = prev_header
+            block_filters = []
+            for position, block_filter in enumerate(filters):
+                block_filter = unhexlify(block_filter)
+                header = filter_header(block_filter, header)
+                if header != headers[position*32:(position+1)*32]:
+                    log.warning("Block filter at height %s doesn't match its header.", height + position)
+                    break
+                block_filters.append(block_filter)
+            else:
+                return block_filters, header
+        return None
+
+    async def sync_filters(self):
+        """Scan the block filters of the new blocks for all addresses, and
+        all block filters for the addresses generated since the last
+        scan, then update the history of the addresses that matched.
+        Repeats while that generates addresses.
+
+        Returns False, and turns off filter_sync, if the server can't
+        be synced with filters."""
+        async with self._filter_sync_lock:
+            if self._filter_state is None:
+                self._filter_state = self._load_filter_state()
+            state = self._filter_state
+            tip = self.headers.height
+            reorganized = state['height'] > tip or (
+                state['height'] >= 0 and self.headers.hash(state['height']).decode() != state['block_hash']
+            )
+            if reorganized:
+                state['height'] = max(-1, min(state['height'], tip) - self.filter_reorg_depth)
+                state['header'] = None
+            # addresses generated for the gap are scanned for in the same
+            # filters, the most recently downloaded of which are kept
+            downloaded = pylru.lrucache(self.filter_cache_batches)
+            while True:
+                matched = set()
+                rescan, self._unscanned_addresses = self._unscanned_addresses, set()
+                if rescan and state['height'] >= 0:
+                    scanned = await self.scan_filters(0, state['height'], rescan, downloaded=downloaded)
+                    if scanned is None:
+                        return self._stop_filter_sync(rescan)
+                    matched.update(scanned[0])
+                if state['height'] < tip:
+                    addresses = [row['address'] for row in await self.db.get_addresses(cols=('address',))]
+                    header = unhexlify(state['header']) if state['header'] else None
+                    scanned = await self.scan_filters(state['height'] + 1, tip, addresses, header, downloaded)
+                    if scanned is None:
+                        return self._stop_filter_sync(rescan)
+                    matched.update(scanned[0])
+                    state.update(height=tip, block_hash=self.headers.hash(tip).decode(),
+                                 header=hexlify(scanned[1]).decode())
+                if matched:
+                    await asyncio.wait([self.update_history_from_filters(address) for address in matched])
+                if not self._unscanned_addresses:
+                    break
+            self._save_filter_state()
+            return True
+
+    def _stop_filter_sync(self, unscanned):
+        self.filter_sync = False
+        self._unscanned_addresses.update(unscanned)
+        log.warning("Syncing by subscribing to addresses instead of with block filters.")
+        return False
+
+    async def update_history_from_filters(self, address):
+        remote_history = await self.network.retriable_call(self.network.get_history, address)
+        history = ''.join(f"{item['tx_hash']}:{item['height']}:" for item in remote_history)
+        await self.update_history(address, self.get_status(history), remote_history=remote_history)
 
     async def subscribe_accounts(self):
         if self.network.is_connected and self.accounts:
@@ -403,6 +709,12 @@ class BaseLedger(metaclass=LedgerRegistry):
             ])
 
     async def subscribe_account(self, account: baseaccount.BaseAccount):
+        if self.filter_sync:
+            # addresses are scanned for up to the last filter sync, new
+            # ones are announced by ensure_address_gap()
+            await account.ensure_address_gap()
+            if await self.sync_filters():
+                return
         for address_manager in account.address_managers.values():
             await self.subscribe_addresses(address_manager, await address_manager.get_addresses())
         await account.ensure_address_gap()
@@ -414,10 +726,28 @@ class BaseLedger(metaclass=LedgerRegistry):
         )
 
     async def subscribe_addresses(self, address_manager: baseaccount.AddressManager, addresses: List[str]):
-        if self.network.is_connected and addresses:
-            await asyncio.wait([
-                self.subscribe_address(address_manager, address) for address in addresses
-            ])
+        if self.filter_sync:
+            self._unscanned_addresses.update(addresses)
+        elif self.network.is_connected and addresses:
+            remote_statuses = await self.network.subscribe_addresses(addresses)
+            local_histories = {
+                record['address']: record['history'] or '' for record in
+                await self.db.get_addresses(cols=('address', 'history'), address__in=addresses)
+            }
+            # the histories of addresses out of sync are fetched in batches too
+            out_of_sync = [
+                address for address, remote_status in zip(addresses, remote_statuses)
+                if self.get_status(local_histories.get(address, '')) != remote_status
+            ]
+            remote_histories: Dict[str, List[dict]] = {}
+            if out_of_sync:
+                remote_histories = dict(zip(
+                    out_of_sync, await self.network.retriable_call(self.network.get_histories, out_of_sync)
+                ))
+            for address, remote_status in zip(addresses, remote_statuses):
+                self._update_tasks.add(self.update_history(
+                    address, remote_status, address_manager, remote_history=remote_histories.get(address)
+                ))
 
     async def subscribe_address(self, address_manager: baseaccount.AddressManager, address: str):
         remote_status = await self.network.subscribe_address(address)
@@ -428,7 +758,7 @@ class BaseLedger(metaclass=LedgerRegistry):
         self._update_tasks.add(self.update_history(address, remote_status))
 
     async def update_history(self, address, remote_status,
-                             address_manager: baseaccount.AddressManager = None):
+                             address_manager: baseaccount.AddressManager = None, remote_history=None):
 
         async with self._address_update_locks.setdefault(address, asyncio.Lock()):
             self._known_addresses_out_of_sync.discard(address)
@@ -438,7 +768,8 @@ class BaseLedger(metaclass=LedgerRegistry):
             if local_status == remote_status:
                 return True
 
-            remote_history = await self.network.retriable_call(self.network.get_history, address)
+            if remote_history is None:
+                remote_history = await self.network.retriable_call(self.network.get_history, address)
             remote_history = list(map(itemgetter('tx_hash', 'height'), remote_history))
             we_need = set(remote_history) - set(local_history)
             if not we_need:
@@ -551,9 +882,8 @@ class BaseLedger(metaclass=LedgerRegistry):
         if 0 < remote_height < len(self.headers):
             merkle = await self.network.retriable_call(self.network.get_merkle, tx.id, remote_height)
             merkle_root = self.get_root_of_merkle_tree(merkle['merkle'], merkle['pos'], tx.hash)
-            header = self.headers[remote_height]
             tx.position = merkle['pos']
-            tx.is_verified = merkle_root == header['merkle_root']
+            tx.is_verified = merkle_root == self.headers.get_merkle_root(remote_height)
 
     async def get_address_manager_for_address(self, address) -> Optional[baseaccount.AddressManager]:
         details = await self.db.get_address(address=address)
@@ -1,7 +1,10 @@
+import random
 import logging
 import asyncio
+from collections import deque
+from itertools import chain
 from operator import itemgetter
-from typing import Dict, Optional, Tuple
+from typing import Deque, Dict, Optional, Tuple
 from time import perf_counter
 
 from torba.rpc import RPCSession as BaseClientSession, Connector, RPCError, ProtocolError
@@ -13,9 +16,15 @@ log = logging.getLogger(__name__)
 
 
 class ClientSession(BaseClientSession):
-    def __init__(self, *args, network, server, timeout=30, on_connect_callback=None, **kwargs):
+    # requests sent in a single JSON-RPC batch, bounding the size of the response
+    max_batch_size = 100
+
+    def __init__(self, *args, network, server, timeout=30, on_connect_callback=None, binary=False, **kwargs):
         self.network = network
         self.server = server
+        # Ask for the binary protocol, until the server refuses it
+        self.binary = binary
+        self._binary_answered = asyncio.Event()
         super().__init__(*args, **kwargs)
         self._on_disconnect_controller = StreamController()
         self.on_disconnected = self._on_disconnect_controller.stream
@@ -31,6 +40,7 @@ class ClientSession(BaseClientSession):
         self.trigger_urgent_reconnect = asyncio.Event()
         # one request per second of timeout, conservative default
         self._semaphore = asyncio.Semaphore(self.timeout * 2)
+        self._queued_requests = []
 
     @property
     def available(self):
@@ -56,20 +66,90 @@ class ClientSession(BaseClientSession):
         return result
 
     async def send_request(self, method, args=()):
+        """Send a request, or given a list of (method, args) pairs send them
+        in batches and return the list of their results."""
+        if isinstance(method, list):
+            return await self._send_batches(method)
         self.pending_amount += 1
         async with self._semaphore:
             return await self._send_request(method, args)
 
+    def send_batched_request(self, method, args=()):
+        """Return a future of the result of a request, sent in a batch with
+        the others queued before the event loop gets to send them."""
+        future = self.loop.create_future()
+        self._queued_requests.append((method, args, future))
+        if len(self._queued_requests) == 1:
+            asyncio.ensure_future(self._send_queued_requests())
+        return future
+
+    async def _send_queued_requests(self):
+        queued, self._queued_requests = self._queued_requests, []
+        try:
+            results = await self.send_request([(method, args) for method, args, _ in queued])
+        except asyncio.CancelledError:
+            for *_, future in queued:
+                future.cancel()
+            raise
+        except Exception as e:
+            for *_, future in queued:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (*_, future), result in zip(queued, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _send_batches(self, requests):
+        async def send(batch):
+            async with self._semaphore:
+                return await self._send_request(batch)
+
+        self.pending_amount += len(requests)
+        results = await asyncio.gather(*(
+            send(requests[i:i + self.max_batch_size]) for i in range(0, len(requests), self.max_batch_size)
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return list(chain.from_iterable(results))
+
+    async def _send_batch(self, requests):
+        if self.is_closing():
+            raise asyncio.TimeoutError("Trying to send request on a recently dropped connection.")
+        if self.binary:
+            # the binary protocol has no batches, the requests are pipelined instead
+            send = super().send_request
+            results = await asyncio.gather(*(send(method, args) for method, args in requests),
+                                           return_exceptions=True)
+        else:
+            async with self.send_batch() as batch:
+                for method, args in requests:
+                    batch.add_request(method, args)
+            results = batch.results
+            if isinstance(results, Exception):
+                # the connection was lost
+                raise results
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, (RPCError, ProtocolError)):
+                raise result
+        # like for a single request, an error response is a None result
+        return [None if isinstance(result, (RPCError, ProtocolError)) else result for result in results]
+
     async def _send_request(self, method, args=()):
-        log.debug("send %s to %s:%i", method, *self.server)
+        is_batch = isinstance(method, list)
+        name = f'batch of {len(method)} requests' if is_batch else method
+        log.debug("send %s to %s:%i", name, *self.server)
         try:
-            if method == 'server.version':
+            if is_batch:
+                reply = await asyncio.wait_for(self._send_batch(method), timeout=self.timeout)
+            elif method == 'server.version':
                 reply = await self.send_timed_server_version_request(args, self.timeout)
             else:
                 reply = await asyncio.wait_for(
                     super().send_request(method, args), timeout=self.timeout
                 )
-            log.debug("got reply for %s from %s:%i", method, *self.server)
+            log.debug("got reply for %s from %s:%i", name, *self.server)
             return reply
         except (RPCError, ProtocolError) as e:
             if str(e).find('.*no such .*transaction.*'):
@@ -83,14 +163,14 @@ class ClientSession(BaseClientSession):
             self.synchronous_close()
             raise
         except asyncio.TimeoutError:
-            log.info("timeout sending %s to %s:%i", method, *self.server)
+            log.info("timeout sending %s to %s:%i", name, *self.server)
             raise
         except asyncio.CancelledError:
-            log.info("cancelled sending %s to %s:%i", method, *self.server)
+            log.info("cancelled sending %s to %s:%i", name, *self.server)
             self.synchronous_close()
             raise
         finally:
-            self.pending_amount -= 1
+            self.pending_amount -= len(method) if is_batch else 1
 
     async def ensure_session(self):
         # Handles reconnecting and maintaining a session alive
@@ -125,8 +205,27 @@ class ClientSession(BaseClientSession):
         connector = Connector(lambda: self, *self.server)
         start = perf_counter()
         await asyncio.wait_for(connector.create_connection(), timeout=timeout)
+        if self.binary:
+            await asyncio.wait_for(self._binary_answered.wait(), timeout=timeout)
+            if self.is_closing():
+                raise ConnectionError("Server refused the binary protocol.")
         self.connection_latency = perf_counter() - start
 
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        if self.binary:
+            self._binary_answered.clear()
+            self.request_binary_protocol()
+
+    def binary_accepted(self):
+        self._binary_answered.set()
+
+    def binary_refused(self):
+        log.info("%s:%i does not support the binary protocol, reconnecting with JSON", *self.server)
+        self.binary = False
+        self._binary_answered.set()
+        super().binary_refused()
+
     async def handle_request(self, request):
         controller = self.network.subscription_controllers[request.method]
         controller.add(request.args)
@@ -198,13 +297,26 @@ class BaseNetwork:
     def is_connected(self):
         return self.client and not self.client.is_closing()
 
-    def rpc(self, list_or_method, args, restricted=True):
-        session = self.client if restricted else self.session_pool.fastest_session
-        if session and not session.is_closing():
-            return session.send_request(list_or_method, args)
+    def _send(self, send, restricted, batched=False):
+        # unrestricted requests are spread over all the servers, and hedged
+        if restricted:
+            session = self.client
+        elif batched:
+            session = self.session_pool.pick_batch_session()
         else:
-            self.session_pool.trigger_nodelay_connect()
-            raise ConnectionError("Attempting to send rpc request when connection is not available.")
+            session = self.session_pool.pick_session()
+        if session and not session.is_closing():
+            return send(session) if restricted else self.session_pool.hedged_request(session, send)
+        self.session_pool.trigger_nodelay_connect()
+        raise ConnectionError("Attempting to send rpc request when connection is not available.")
+
+    def rpc(self, list_or_method, args=(), restricted=True):
+        # a list of (method, args) pairs is sent in batches, args is ignored
+        return self._send(lambda session: session.send_request(list_or_method, args), restricted)
+
+    def batched_rpc(self, method, args, restricted=True):
+        # sent in a batch with the other requests made in the same event loop iteration
+        return self._send(lambda session: session.send_batched_request(method, args), restricted, True)
 
     async def retriable_call(self, function, *args, **kwargs):
         while self.running:
@@ -226,7 +338,7 @@ class BaseNetwork:
     def get_transaction(self, tx_hash, known_height=None):
         # use any server if its old, otherwise restrict to who gave us the history
         restricted = not known_height or 0 > known_height > self.remote_height - 10
-        return self.rpc('blockchain.transaction.get', [tx_hash], restricted)
+        return self.batched_rpc('blockchain.transaction.get', [tx_hash], restricted)
 
     def get_transaction_height(self, tx_hash, known_height=None):
         restricted = not known_height or 0 > known_height > self.remote_height - 10
@@ -234,15 +346,32 @@ class BaseNetwork:
 
     def get_merkle(self, tx_hash, height):
         restricted = 0 > height > self.remote_height - 10
-        return self.rpc('blockchain.transaction.get_merkle', [tx_hash, height], restricted)
+        return self.batched_rpc('blockchain.transaction.get_merkle', [tx_hash, height], restricted)
 
     def get_headers(self, height, count=10000):
         return self.rpc('blockchain.block.headers', [height, count])
 
+    def get_compressed_chunk_hashes(self):
+        return self.rpc('blockchain.block.compressed_chunk_hashes', [])
+
+    def get_compressed_chunk(self, index):
+        # chunks are identified by hash so any server can be asked
+        return self.rpc('blockchain.block.compressed_chunk', [index], False)
+
+    def get_filter_headers(self, height, count=2016):
+        return self.rpc('blockchain.block.filter_headers', [height, count])
+
+    def get_filters(self, height, count=1000):
+        # filters are checked against the filter headers so any server can be asked
+        return self.rpc('blockchain.block.filters', [height, count], False)
+
     #  --- Subscribes, history and broadcasts are always aimed towards the master client directly
     def get_history(self, address):
         return self.rpc('blockchain.address.get_history', [address], True)
 
+    def get_histories(self, addresses):
+        return self.rpc([('blockchain.address.get_history', [address]) for address in addresses], (), True)
+
     def broadcast(self, raw_transaction):
         return self.rpc('blockchain.transaction.broadcast', [raw_transaction], True)
 
@@ -250,8 +379,13 @@ class BaseNetwork:
         return self.rpc('blockchain.headers.subscribe', [True], True)
 
     async def subscribe_address(self, address):
+        return (await self.subscribe_addresses([address]))[0]
+
+    async def subscribe_addresses(self, addresses):
         try:
-            return await self.rpc('blockchain.address.subscribe', [address], True)
+            return await self.rpc(
+                [('blockchain.address.subscribe', [address]) for address in addresses], (), True
+            )
         except asyncio.TimeoutError:
             # abort and cancel, we cant lose a subscription, it will happen again on reconnect
             if self.client:
@@ -264,11 +398,18 @@ class BaseNetwork:
 
 class SessionPool:
 
+    # a request still unanswered at this percentile of the response times
+    # is sent to a second server too, whichever answers first is used
+    hedge_percentile = 0.95
+    min_hedge_samples = 20
+
     def __init__(self, network: BaseNetwork, timeout: float):
         self.network = network
         self.sessions: Dict[ClientSession, Optional[asyncio.Task]] = dict()
         self.timeout = timeout
         self.new_connection_event = asyncio.Event()
+        self.response_times: Deque[float] = deque(maxlen=200)
+        self._batch_session: Optional[ClientSession] = None
 
     @property
     def online(self):
@@ -288,6 +429,86 @@ class SessionPool:
             key=itemgetter(0)
         )[1]
 
+    def pick_session(self, exclude: Optional[ClientSession] = None) -> Optional[ClientSession]:
+        """Pick an available session at random, weighted by how soon it
+        can be expected to answer from its latency and pending requests."""
+        sessions = [session for session in self.available_sessions if session is not exclude]
+        if not sessions:
+            return None
+        weights = [
+            1 / (max(session.response_time + session.connection_latency, 0.001)
+                 * (session.pending_amount + 1))
+            for session in sessions
+        ]
+        return random.choices(sessions, weights)[0]
+
+    def pick_batch_session(self) -> Optional[ClientSession]:
+        """Pick a session as pick_session(), the same one for the rest of
+        this event loop iteration so the requests queued meanwhile are
+        sent to it in a batch.  Batches are spread over the sessions."""
+        if self._batch_session is None:
+            self._batch_session = self.pick_session()
+            asyncio.get_event_loop().call_soon(self._clear_batch_session)
+        return self._batch_session
+
+    def _clear_batch_session(self):
+        self._batch_session = None
+
+    @property
+    def hedge_delay(self) -> Optional[float]:
+        if len(self.response_times) < self.min_hedge_samples:
+            return None
+        response_times = sorted(self.response_times)
+        return response_times[int(len(response_times) * self.hedge_percentile)]
+
+    def _timed_request(self, session, send):
+        """Return a future of send(session), which records its response time
+        even if it is no longer waited for."""
+        start = perf_counter()
+        request = asyncio.ensure_future(send(session))
+
+        def done(future):
+            # retrieving the exception also keeps it from being logged as unretrieved
+            if not future.cancelled() and future.exception() is None:
+                self.response_times.append(perf_counter() - start)
+
+        request.add_done_callback(done)
+        # cancelling the request would close the connection of the session
+        return asyncio.shield(request)
+
+    async def hedged_request(self, session: ClientSession, send):
+        """Return the result of send(session), or of send() to another session
+        if that answers first once the request took longer than hedge_delay.
+        A None result is only returned if the other session can't do better."""
+        pending = {self._timed_request(session, send)}
+        try:
+            delay = self.hedge_delay
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                hedge_session = None if done else self.pick_session(exclude=session)
+                if hedge_session is not None:
+                    log.debug("hedging a request to %s:%i with %s:%i", *session.server, *hedge_session.server)
+                    pending.add(self._timed_request(hedge_session, send))
+            error: Optional[BaseException] = None
+            answered = False
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif task.result() is not None:
+                        return task.result()
+                    else:
+                        answered = True
+            if answered or error is None:
+                return None
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
     def _get_session_connect_callback(self, session: ClientSession):
         loop = asyncio.get_event_loop()
 
@@ -317,7 +538,8 @@ class SessionPool:
                 break
         if not session:
             session = ClientSession(
-                network=self.network, server=server
+                network=self.network, server=server,
+                binary=self.network.config.get('binary_protocol', False)
             )
             session._on_connect_cb = self._get_session_connect_callback(session)
         task = self.sessions.get(session, None)
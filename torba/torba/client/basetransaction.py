@@ -1,10 +1,16 @@
+import asyncio
+import hashlib
 import logging
 import typing
-from typing import List, Iterable, Optional
+from typing import Dict, List, Iterable, Optional, Callable, Tuple, Union
 from binascii import hexlify
+from itertools import chain
+
+import pylru
 
 from torba.client.basescript import BaseInputScript, BaseOutputScript
 from torba.client.baseaccount import BaseAccount
+from torba.client.bip32 import PrivateKey
 from torba.client.constants import COIN, NULL_HASH32
 from torba.client.bcd_data_stream import BCDataStream
 from torba.client.hash import sha256, TXRef, TXRefImmutable
@@ -150,6 +156,11 @@ class BaseInput(InputOutput):
             return False
         return self.txo_ref.txo.is_my_account
 
+    def copy(self) -> 'BaseInput':
+        script = self.coinbase if self.is_coinbase else self.script
+        assert script is not None, 'Input has neither a coinbase nor a script.'
+        return self.__class__(self.txo_ref, script, self.sequence)
+
     @classmethod
     def deserialize_from(cls, stream):
         tx_ref = TXRefImmutable.from_hash(stream.read(32), -1)
@@ -188,6 +199,10 @@ class BaseOutputEffectiveAmountEstimator:
     def __lt__(self, other):
         return self.effective_amount < other.effective_amount
 
+    @property
+    def height(self) -> int:
+        return self.txo.tx_ref.height if self.txo.tx_ref else -2
+
 
 class BaseOutput(InputOutput):
 
@@ -236,6 +251,9 @@ class BaseOutput(InputOutput):
     def pay_pubkey_hash(cls, amount, pubkey_hash):
         return cls(amount, cls.script_class.pay_pubkey_hash(pubkey_hash))
 
+    def copy(self) -> 'BaseOutput':
+        return self.__class__(self.amount, self.script)
+
     @classmethod
     def deserialize_from(cls, stream):
         return cls(
@@ -248,6 +266,147 @@ class BaseOutput(InputOutput):
         stream.write_string(self.script.source)
 
 
+class DecodedTransaction:
+    """ The inputs and outputs of a raw transaction, located in a memoryview of the
+        raw bytes and each decoded the first time it's accessed. Transactions of the
+        same txid get copies, which share the scripts of the decoded inputs and outputs
+        so those are parsed only once; scripts of a raw transaction are never modified. """
+
+    __slots__ = 'view', 'input_class', 'output_class', 'version', 'locktime', \
+                'input_spans', 'output_spans', '_inputs', '_outputs'
+
+    def __init__(self, raw: bytes, input_class, output_class) -> None:
+        self.view = view = memoryview(raw)
+        self.input_class = input_class
+        self.output_class = output_class
+        self.version = BCDataStream.uint32.unpack_from(view, 0)[0]
+        offset = 4
+        self.input_spans: List[Tuple[int, int]] = []
+        input_count, offset = _read_compact_size(view, offset)
+        for _ in range(input_count):
+            size, end = _read_compact_size(view, offset + 36)
+            self.input_spans.append((offset, end + size + 4))
+            offset = end + size + 4
+        self.output_spans: List[Tuple[int, int]] = []
+        output_count, offset = _read_compact_size(view, offset)
+        for _ in range(output_count):
+            size, end = _read_compact_size(view, offset + 8)
+            self.output_spans.append((offset, end + size))
+            offset = end + size
+        self.locktime = BCDataStream.uint32.unpack_from(view, offset)[0]
+        self._inputs: List[Optional[BaseInput]] = [None] * input_count
+        self._outputs: List[Optional[BaseOutput]] = [None] * output_count
+
+    def _decode(self, io_class, span):
+        start, end = span
+        return io_class.deserialize_from(BCDataStream(self.view[start:end]))
+
+    def input(self, position: int) -> BaseInput:
+        txi = self._inputs[position]
+        if txi is None:
+            txi = self._inputs[position] = self._decode(self.input_class, self.input_spans[position])
+        return txi.copy()
+
+    def output(self, position: int) -> BaseOutput:
+        txo = self._outputs[position]
+        if txo is None:
+            txo = self._outputs[position] = self._decode(self.output_class, self.output_spans[position])
+        return txo.copy()
+
+
+def _read_compact_size(view, offset):
+    size = view[offset]
+    if size < 253:
+        return size, offset + 1
+    if size == 253:
+        return BCDataStream.uint16.unpack_from(view, offset + 1)[0], offset + 3
+    if size == 254:
+        return BCDataStream.uint32.unpack_from(view, offset + 1)[0], offset + 5
+    return BCDataStream.uint64.unpack_from(view, offset + 1)[0], offset + 9
+
+
+class LazyIOList:
+    """ Inputs or outputs of a transaction, decoded when first accessed. """
+
+    __slots__ = 'tx_ref', 'ios', 'decode'
+
+    def __init__(self, tx_ref: TXRef, count: int = 0,
+                 decode: Callable[[int], InputOutput] = None) -> None:
+        self.tx_ref = tx_ref
+        self.ios: List[Optional[InputOutput]] = [None] * count
+        self.decode = decode
+
+    def __len__(self) -> int:
+        return len(self.ios)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.ios)))]
+        txio = self.ios[index]
+        if txio is None:
+            position = index if index >= 0 else index + len(self.ios)
+            txio = self.ios[position] = self.decode(position)
+            txio.tx_ref = self.tx_ref
+            txio.position = position
+        return txio
+
+    def __iter__(self):
+        for position in range(len(self.ios)):
+            yield self[position]
+
+    def append(self, txio: InputOutput):
+        self.ios.append(txio)
+
+
+# decoded transactions by txid, shared by all of the ledgers and databases of the process
+DECODED_TRANSACTIONS = pylru.lrucache(10000)
+
+# inputs signed by one executor job
+SIGNING_BATCH_SIZE = 25
+
+
+class TransactionSigner:
+    """ Signs the inputs of a transaction. Signature preimages only differ by which input
+        gets the script of the output it spends, all other inputs have an empty script, so
+        the preimage is serialized once and the hash state up to each input is shared. """
+
+    __slots__ = 'preimage', 'offsets', 'signing_inputs', 'midstates'
+
+    def __init__(self, tx: 'BaseTransaction') -> None:
+        stream = BCDataStream()
+        stream.write_uint32(tx.version)
+        stream.write_compact_size(len(tx._inputs))
+        self.offsets: List[int] = []
+        self.signing_inputs: List[bytes] = []
+        for txin in tx._inputs:
+            self.offsets.append(stream.data.tell())
+            txin.serialize_to(stream, b'')
+            signing_input = BCDataStream()
+            txin.serialize_to(signing_input, txin.txo_ref.txo.script.source)
+            self.signing_inputs.append(signing_input.get_bytes())
+        self.offsets.append(stream.data.tell())
+        stream.write_compact_size(len(tx._outputs))
+        for txout in tx._outputs:
+            txout.serialize_to(stream)
+        stream.write_uint32(tx.locktime)
+        stream.write_uint32(tx.signature_hash_type(1))  # signature hash type: SIGHASH_ALL
+        self.preimage = memoryview(stream.get_bytes())
+        self.midstates: List['hashlib._Hash'] = []
+        hasher = hashlib.sha256(self.preimage[:self.offsets[0]])
+        for start, end in zip(self.offsets, self.offsets[1:]):
+            self.midstates.append(hasher.copy())
+            hasher.update(self.preimage[start:end])
+
+    def signature_hash(self, signing_input: int) -> bytes:
+        hasher = self.midstates[signing_input].copy()
+        hasher.update(self.signing_inputs[signing_input])
+        hasher.update(self.preimage[self.offsets[signing_input+1]:])
+        return sha256(hasher.digest())
+
+    def sign(self, private_keys: List[PrivateKey], start: int, end: int) -> List[bytes]:
+        return [private_keys[i].sign_digest(self.signature_hash(i)) for i in range(start, end)]
+
+
 class BaseTransaction:
 
     input_class = BaseInput
@@ -259,8 +418,8 @@ class BaseTransaction:
         self.ref = TXRefMutable(self)
         self.version = version
         self.locktime = locktime
-        self._inputs: List[BaseInput] = []
-        self._outputs: List[BaseOutput] = []
+        self._inputs = LazyIOList(self.ref)
+        self._outputs = LazyIOList(self.ref)
         self.is_verified = is_verified
         # Height Progression
         #   -2: not broadcast
@@ -310,7 +469,8 @@ class BaseTransaction:
     def outputs(self) -> ReadOnlyList[BaseOutput]:
         return ReadOnlyList(self._outputs)
 
-    def _add(self, existing_ios: List, new_ios: Iterable[InputOutput], reset=False) -> 'BaseTransaction':
+    def _add(self, existing_ios: Union[List, LazyIOList], new_ios: Iterable[InputOutput],
+             reset=False) -> 'BaseTransaction':
         for txio in new_ios:
             txio.tx_ref = self.ref
             txio.position = len(existing_ios)
@@ -418,17 +578,16 @@ class BaseTransaction:
 
     def _deserialize(self):
         if self._raw is not None:
-            stream = BCDataStream(self._raw)
-            self.version = stream.read_uint32()
-            input_count = stream.read_compact_size()
-            self._add(self._inputs, [
-                self.input_class.deserialize_from(stream) for _ in range(input_count)
-            ])
-            output_count = stream.read_compact_size()
-            self._add(self._outputs, [
-                self.output_class.deserialize_from(stream) for _ in range(output_count)
-            ])
-            self.locktime = stream.read_uint32()
+            decoded = DECODED_TRANSACTIONS.get(self.id)
+            if decoded is None or decoded.output_class is not self.output_class \
+                    or decoded.input_class is not self.input_class:
+                decoded = DECODED_TRANSACTIONS[self.id] = DecodedTransaction(
+                    self._raw, self.input_class, self.output_class
+                )
+            self.version = decoded.version
+            self.locktime = decoded.locktime
+            self._inputs = LazyIOList(self.ref, len(decoded.input_spans), decoded.input)
+            self._outputs = LazyIOList(self.ref, len(decoded.output_spans), decoded.output)
 
     @classmethod
     def ensure_all_have_same_ledger(cls, funding_accounts: Iterable[BaseAccount],
@@ -525,19 +684,31 @@ class BaseTransaction:
 
     async def sign(self, funding_accounts: Iterable[BaseAccount]):
         ledger = self.ensure_all_have_same_ledger(funding_accounts)
-        for i, txi in enumerate(self._inputs):
+        private_keys: Dict[str, PrivateKey] = {}
+        signing_keys: List[PrivateKey] = []
+        for txi in self._inputs:
             assert txi.script is not None
             assert txi.txo_ref.txo is not None
             txo_script = txi.txo_ref.txo.script
             if txo_script.is_pay_pubkey_hash:
                 address = ledger.hash160_to_address(txo_script.values['pubkey_hash'])
-                private_key = await ledger.get_private_key_for_address(address)
-                assert private_key is not None
-                tx = self._serialize_for_signature(i)
-                txi.script.values['signature'] = \
-                    private_key.sign(tx) + bytes((self.signature_hash_type(1),))
-                txi.script.values['pubkey'] = private_key.public_key.pubkey_bytes
-                txi.script.generate()
+                if address not in private_keys:
+                    private_key = await ledger.get_private_key_for_address(address)
+                    assert private_key is not None
+                    private_keys[address] = private_key
+                signing_keys.append(private_keys[address])
             else:
                 raise NotImplementedError("Don't know how to spend this output.")
+        loop = asyncio.get_running_loop()
+        signer = await loop.run_in_executor(None, TransactionSigner, self)
+        signatures = await asyncio.gather(*(
+            loop.run_in_executor(
+                None, signer.sign, signing_keys, start, min(start+SIGNING_BATCH_SIZE, len(signing_keys))
+            ) for start in range(0, len(signing_keys), SIGNING_BATCH_SIZE)
+        ))
+        hash_type = bytes((self.signature_hash_type(1),))
+        for txi, private_key, signature in zip(self._inputs, signing_keys, chain.from_iterable(signatures)):
+            txi.script.values['signature'] = signature + hash_type
+            txi.script.values['pubkey'] = private_key.public_key.pubkey_bytes
+            txi.script.generate()
         self._reset()
@@ -213,6 +213,10 @@ class PrivateKey(_KeyBase):
         """ Produce a signature for piece of data by double hashing it and signing the hash. """
         return self.signing_key.sign(data, hasher=double_sha256)
 
+    def sign_digest(self, digest):
+        """ Produce a signature for the 32 byte hash of a piece of data. """
+        return self.signing_key.sign(digest, hasher=None)
+
     def identifier(self):
         """Return the key's identifier as 20 bytes."""
         return self.public_key.identifier()
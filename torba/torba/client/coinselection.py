@@ -1,9 +1,13 @@
+from time import perf_counter
+from array import array
+from bisect import bisect_left, bisect_right
 from random import Random
-from typing import List
-
-from torba.client import basetransaction
+from operator import attrgetter
+from typing import List, NamedTuple
 
 MAXIMUM_TRIES = 100000
+# seconds the branch and bound search may run before falling back to the other strategies
+TIME_LIMIT = 0.5
 
 STRATEGIES = []
 
@@ -13,20 +17,31 @@ def strategy(method):
     return method
 
 
+class Coin(NamedTuple):
+    """ An unspent output by its effective amount, which is selected without loading the output. """
+    txoid: str
+    effective_amount: int
+    fee: int
+    height: int
+
+
+EFFECTIVE_AMOUNT = attrgetter('effective_amount')
+
+
 class CoinSelector:
 
-    def __init__(self, target: int, cost_of_change: int, seed: str = None) -> None:
+    def __init__(self, target: int, cost_of_change: int, seed: str = None,
+                 time_limit: float = TIME_LIMIT) -> None:
         self.target = target
         self.cost_of_change = cost_of_change
+        self.time_limit = time_limit
         self.exact_match = False
         self.tries = 0
         self.random = Random(seed)
         if seed is not None:
             self.random.seed(seed, version=1)
 
-    def select(
-            self, txos: List[basetransaction.BaseOutputEffectiveAmountEstimator],
-            strategy_name: str = None) -> List[basetransaction.BaseOutputEffectiveAmountEstimator]:
+    def select(self, txos: List[Coin], strategy_name: str = None) -> List[Coin]:
         if not txos:
             return []
         available = sum(c.effective_amount for c in txos)
@@ -35,17 +50,17 @@ class CoinSelector:
         return getattr(self, strategy_name or "standard")(txos, available)
 
     @strategy
-    def prefer_confirmed(self, txos: List[basetransaction.BaseOutputEffectiveAmountEstimator],
-                         available: int) -> List[basetransaction.BaseOutputEffectiveAmountEstimator]:
+    def prefer_confirmed(self, txos: List[Coin],
+                         available: int) -> List[Coin]:
         return (
             self.only_confirmed(txos, available) or
             self.standard(txos, available)
         )
 
     @strategy
-    def only_confirmed(self, txos: List[basetransaction.BaseOutputEffectiveAmountEstimator],
-                       _) -> List[basetransaction.BaseOutputEffectiveAmountEstimator]:
-        confirmed = [t for t in txos if t.txo.tx_ref and t.txo.tx_ref.height > 0]
+    def only_confirmed(self, txos: List[Coin],
+                       _) -> List[Coin]:
+        confirmed = [t for t in txos if t.height > 0]
         if not confirmed:
             return []
         confirmed_available = sum(c.effective_amount for c in confirmed)
@@ -54,21 +69,24 @@ class CoinSelector:
         return self.standard(confirmed, confirmed_available)
 
     @strategy
-    def standard(self, txos: List[basetransaction.BaseOutputEffectiveAmountEstimator],
-                 available: int) -> List[basetransaction.BaseOutputEffectiveAmountEstimator]:
+    def standard(self, txos: List[Coin],
+                 available: int) -> List[Coin]:
         return (
             self.branch_and_bound(txos, available) or
             self.closest_match(txos, available) or
-            self.random_draw(txos, available)
+            self.largest_first(txos, available)
         )
 
     @strategy
-    def branch_and_bound(self, txos: List[basetransaction.BaseOutputEffectiveAmountEstimator],
-                         available: int) -> List[basetransaction.BaseOutputEffectiveAmountEstimator]:
+    def branch_and_bound(self, txos: List[Coin],
+                         available: int) -> List[Coin]:
         # see bitcoin implementation for more info:
         # https://github.com/bitcoin/bitcoin/blob/master/src/wallet/coinselection.cpp
 
-        txos.sort(reverse=True)
+        txos.sort(key=EFFECTIVE_AMOUNT, reverse=True)
+        amounts = array('q', map(EFFECTIVE_AMOUNT, txos))
+        fees = array('q', (t.fee for t in txos))
+        deadline = None if self.time_limit is None else perf_counter() + self.time_limit
 
         current_value = 0
         current_available_value = available
@@ -78,6 +96,8 @@ class CoinSelector:
 
         while self.tries < MAXIMUM_TRIES:
             self.tries += 1
+            if deadline is not None and not self.tries % 1000 and perf_counter() > deadline:
+                break
 
             backtrack = False
             if current_value + current_available_value < self.target or \
@@ -93,26 +113,24 @@ class CoinSelector:
             if backtrack:
                 while current_selection and not current_selection[-1]:
                     current_selection.pop()
-                    current_available_value += txos[len(current_selection)].effective_amount
+                    current_available_value += amounts[len(current_selection)]
 
                 if not current_selection:
                     break
 
                 current_selection[-1] = False
-                utxo = txos[len(current_selection) - 1]
-                current_value -= utxo.effective_amount
+                current_value -= amounts[len(current_selection) - 1]
 
             else:
-                utxo = txos[len(current_selection)]
-                current_available_value -= utxo.effective_amount
-                previous_utxo = txos[len(current_selection) - 1] if current_selection else None
-                if current_selection and not current_selection[-1] and previous_utxo and \
-                   utxo.effective_amount == previous_utxo.effective_amount and \
-                   utxo.fee == previous_utxo.fee:
+                position = len(current_selection)
+                current_available_value -= amounts[position]
+                if current_selection and not current_selection[-1] and \
+                   amounts[position] == amounts[position - 1] and \
+                   fees[position] == fees[position - 1]:
                     current_selection.append(False)
                 else:
                     current_selection.append(True)
-                    current_value += utxo.effective_amount
+                    current_value += amounts[position]
 
         if best_selection:
             self.exact_match = True
@@ -123,8 +141,8 @@ class CoinSelector:
         return []
 
     @strategy
-    def closest_match(self, txos: List[basetransaction.BaseOutputEffectiveAmountEstimator],
-                      _) -> List[basetransaction.BaseOutputEffectiveAmountEstimator]:
+    def closest_match(self, txos: List[Coin],
+                      _) -> List[Coin]:
         """ Pick one UTXOs that is larger than the target but with the smallest change. """
         target = self.target + self.cost_of_change
         smallest_change = None
@@ -137,8 +155,8 @@ class CoinSelector:
         return [best_match] if best_match else []
 
     @strategy
-    def random_draw(self, txos: List[basetransaction.BaseOutputEffectiveAmountEstimator],
-                    _) -> List[basetransaction.BaseOutputEffectiveAmountEstimator]:
+    def random_draw(self, txos: List[Coin],
+                    _) -> List[Coin]:
         """ Accumulate UTXOs at random until there is enough to cover the target. """
         target = self.target + self.cost_of_change
         self.random.shuffle(txos, self.random.random)
@@ -150,3 +168,26 @@ class CoinSelector:
             if amount >= target:
                 return selection
         return []
+
+    @strategy
+    def largest_first(self, txos: List[Coin],
+                      _) -> List[Coin]:
+        """ Accumulate the largest UTXOs until one of the rest covers what's left of the
+            target, then finish with the smallest such UTXO. """
+        target = self.target + self.cost_of_change
+        txos = sorted(txos, key=EFFECTIVE_AMOUNT, reverse=True)
+        ascending = array('q', reversed(array('q', map(EFFECTIVE_AMOUNT, txos))))
+        selection = []
+        for position, txo in enumerate(txos):
+            unused = len(txos) - position
+            smallest = bisect_left(ascending, target, 0, unused)
+            if smallest < unused:
+                # of equal amounts prefer the UTXO which came first
+                smallest = bisect_right(ascending, ascending[smallest], smallest, unused) - 1
+                selection.append(txos[len(txos) - 1 - smallest])
+                return selection
+            if txo.effective_amount <= 0:
+                break
+            selection.append(txo)
+            target -= txo.effective_amount
+        return []
@@ -7,7 +7,7 @@ __node_url__ = (
 __spvserver__ = 'torba.server.coins.BitcoinSegwitRegtest'
 
 import struct
-from typing import Optional
+from typing import Dict, Optional
 from binascii import hexlify, unhexlify
 from torba.client.baseledger import BaseLedger
 from torba.client.baseheader import BaseHeaders, ArithUint256
@@ -16,9 +16,29 @@ from torba.client.baseheader import BaseHeaders, ArithUint256
 class MainHeaders(BaseHeaders):
     header_size = 80
     chunk_size = 2016
+    timestamp_offset = 68
+    bits_offset = 72
     max_target = 0x00000000ffffffffffffffffffffffffffffffffffffffffffffffffffffffff
     genesis_hash: Optional[bytes] = b'000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f'
     target_timespan = 14 * 24 * 60 * 60
+    # the last block of each difficulty period
+    checkpoints = {
+        2015: b'00000000693067b0e6b440bc51450b9f3850561b07f6d3c021c54fbd6abb9763',
+        4031: b'00000000f037ad09d0b05ee66b8c1da83030abaf909d2b1bf519c3c7d2cd3fdf',
+        6047: b'000000006ce8b5f16fcedde13acbc9641baa1c67734f177d770a4069c06c9de8',
+        8063: b'00000000563298de120522b5ae17da21aaae02eee2d7fcb5be65d9224dbd601c',
+        10079: b'000000009b0a4b2833b4a0aa61171ee75b8eb301ac45a18713795a72e461a946',
+        12095: b'00000000fa8a7363e8f6fdc88ec55edf264c9c7b31268c26e497a4587c750584',
+        14111: b'000000008ac55b5cd76a5c176f2457f0e9df5ff1c719d939f1022712b1ba2092',
+        16127: b'000000007f0c796631f00f542c0b402d638d3518bc208f8c9e5d29d2f169c084',
+        18143: b'00000000ffb062296c9d4eb5f87bbf905d30669d26eab6bced341bd3f1dba5fd',
+        20159: b'0000000074c108842c3ec2252bba62db4050bf0dddfee3ddaa5f847076b8822f',
+        22175: b'0000000067dc2f84a73fbf5d3c70678ce4a1496ef3a62c557bc79cbdd1d49f22',
+        24191: b'00000000dbf06f47c0624262ecb197bccf6bdaaabc2d973708ac401ac8955acc',
+        26207: b'000000009260fe30ec89ef367122f429dcc59f61735760f2b2288f2e854f04ac',
+        28223: b'00000000f9f1a700898c4e0671af6efd441eaf339ba075a5c5c7b0949473c80b',
+        30239: b'000000005107662c86452e7365f32f8ffdc70d8d87aa6f78630a79f7d77fbfe6',
+    }
 
     @staticmethod
     def serialize(header: dict) -> bytes:
@@ -74,6 +94,7 @@ class UnverifiedHeaders(MainHeaders):
     max_target = 0x7fffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
     genesis_hash = None
     validate_difficulty = False
+    checkpoints: Dict[int, bytes] = {}
 
 
 class RegTestLedger(MainNetLedger):
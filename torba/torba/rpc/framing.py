@@ -25,7 +25,8 @@
 
 """RPC message framing in a byte stream."""
 
-__all__ = ('FramerBase', 'NewlineFramer', 'BinaryFramer', 'BitcoinFramer',
+__all__ = ('FramerBase', 'NewlineFramer', 'LengthPrefixedFramer',
+           'BinaryFramer', 'BitcoinFramer',
            'OversizedPayloadError', 'BadChecksumError', 'BadMagicError')
 
 from hashlib import sha256 as _sha256
@@ -126,6 +127,29 @@ class ByteQueue(object):
         return whole[:size]
 
 
+class LengthPrefixedFramer(FramerBase):
+    """A framer for a protocol where each message is preceded by its
+    length in bytes, as a little-endian 32-bit integer."""
+
+    def __init__(self, max_size=250 * 4000):
+        """max_size - an anti-DoS measure.  A message over max_size bytes
+        raises OversizedPayloadError; as the stream cannot be
+        re-synchronized the connection should be closed.
+        """
+        self.max_size = max_size
+        self.byte_queue = ByteQueue()
+        self.received_bytes = self.byte_queue.put_nowait
+
+    def frame(self, message):
+        return pack_le_uint32(len(message)) + message
+
+    async def receive_message(self):
+        size, = unpack_le_uint32(await self.byte_queue.receive(4))
+        if size > self.max_size:
+            raise OversizedPayloadError(None, size)
+        return await self.byte_queue.receive(size)
+
+
 class BinaryFramer(object):
     """A framer for binary messaging protocols."""
 
@@ -162,6 +186,7 @@ class BinaryFramer(object):
 # Helpers
 struct_le_I = Struct('<I')
 pack_le_uint32 = struct_le_I.pack
+unpack_le_uint32 = struct_le_I.unpack
 
 
 def sha256(x):
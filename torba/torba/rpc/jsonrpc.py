@@ -26,12 +26,15 @@
 """Classes for JSONRPC versions 1.0 and 2.0, and a loose interpretation."""
 
 __all__ = ('JSONRPC', 'JSONRPCv1', 'JSONRPCv2', 'JSONRPCLoose',
-           'JSONRPCAutoDetect', 'Request', 'Notification', 'Batch',
+           'JSONRPCAutoDetect', 'BinaryRPC', 'EncodedResult',
+           'Request', 'Notification', 'Batch',
            'RPCError', 'ProtocolError',
            'JSONRPCConnection', 'handler_invocation')
 
 import itertools
 import json
+import base64
+import struct
 import typing
 import asyncio
 from functools import partial
@@ -98,6 +101,26 @@ class Batch:
         return f'Batch({len(self.items)} items)'
 
 
+class EncodedResult:
+    """A result encoded once, to be sent in any number of messages
+    without encoding it again, e.g. a cached result.  The encoding is
+    spliced into messages as they are encoded.
+
+    json    - the result as JSON
+    raw     - bytes results as they are, for BinaryRPC; otherwise None
+    result  - the result itself
+    """
+    __slots__ = ('result', 'json', 'raw')
+
+    def __init__(self, result):
+        self.result = result
+        self.json = json.dumps(result, default=_encode_bytes).encode()
+        self.raw = result if isinstance(result, (bytes, bytearray)) else None
+
+    def __repr__(self):
+        return f'EncodedResult({len(self.json):,d} bytes)'
+
+
 class Response(object):
     __slots__ = ('result', )
 
@@ -332,12 +355,33 @@ class JSONRPC(object):
 
     @classmethod
     def encode_payload(cls, payload):
-        """Encode a Python object as JSON and convert it to bytes."""
+        """Encode a Python object as JSON and convert it to bytes.  Bytes
+        in the payload are encoded as base64 strings, and the JSON of
+        EncodedResults is spliced in."""
+        encoded = []
+
+        def default(value):
+            if isinstance(value, EncodedResult):
+                encoded.append(value)
+                return _SPLICE_MARKER
+            return _encode_bytes(value)
+
         try:
-            return json.dumps(payload).encode()
+            message = json.dumps(payload, default=default).encode()
         except TypeError:
             msg = f'JSON payload encoding error: {payload}'
             raise ProtocolError(cls.INTERNAL_ERROR, msg) from None
+        if not encoded:
+            return message
+        parts = message.split(_SPLICED_MARKER)
+        if len(parts) != len(encoded) + 1:
+            # The marker was also in a string of the payload
+            return json.dumps(payload, default=_encode_result).encode()
+        spliced = [parts[0]]
+        for result, part in zip(encoded, parts[1:]):
+            spliced.append(result.json)
+            spliced.append(part)
+        return b''.join(spliced)
 
 
 class JSONRPCv1(JSONRPC):
@@ -584,6 +628,153 @@ class JSONRPCAutoDetect(JSONRPCv2):
         return protocol_for_payload(main)
 
 
+class BinaryRPC(JSONRPC):
+    """RPC messages in a compact binary encoding, for sessions framing
+    messages with a LengthPrefixedFramer.
+
+    Every message starts with its kind and a 64-bit message ID.
+    Requests and notifications continue with the method number and
+    arguments as JSON.  Results are JSON, except those that are bytes,
+    which are sent as they are rather than base64 encoded.  Errors are
+    a JSON [code, message] pair.
+
+    A method name is only sent the first time it is used in each
+    direction of a connection, along with NEW_METHOD.  Both sides then
+    number it with the count of methods seen before it.  As it
+    remembers these numbers a BinaryRPC object serves one connection.
+    Batches are not supported; requests can be pipelined instead.
+    """
+
+    REQUEST, NOTIFICATION, RESULT, BYTES_RESULT, ERROR = range(5)
+    NEW_METHOD = 0xffff
+    NO_ID = 0xffffffffffffffff
+
+    allow_batches = False
+
+    _header = struct.Struct('<BQ')
+    _method = struct.Struct('<HB')
+
+    def __init__(self):
+        self._sent_methods = {}
+        self._received_methods = []
+
+    @classmethod
+    def _pack_header(cls, kind, request_id):
+        return cls._header.pack(kind, cls.NO_ID if request_id is None else request_id)
+
+    def _pack_method(self, method):
+        number = self._sent_methods.get(method)
+        if number is not None:
+            return self._method.pack(number, 0)
+        if len(self._sent_methods) == self.NEW_METHOD:
+            raise ProtocolError(self.INTERNAL_ERROR, 'too many methods')
+        self._sent_methods[method] = len(self._sent_methods)
+        name = method.encode()
+        return self._method.pack(self.NEW_METHOD, len(name)) + name
+
+    def _unpack_method(self, message, offset):
+        number, size = self._method.unpack_from(message, offset)
+        offset += self._method.size
+        if number == self.NEW_METHOD:
+            method = message[offset:offset + size].decode()
+            self._received_methods.append(method)
+            return method, offset + size
+        try:
+            return self._received_methods[number], offset
+        except IndexError:
+            raise ProtocolError(self.METHOD_NOT_FOUND, f'unknown method number {number}') from None
+
+    @classmethod
+    def _decode_json(cls, body):
+        try:
+            return json.loads(body.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            raise ProtocolError(cls.PARSE_ERROR, 'invalid JSON') from None
+
+    #
+    # External API
+    #
+
+    def message_to_item(self, message):
+        """Translate an unframed received message and return an
+        (item, request_id) pair.  See JSONRPC.message_to_item()."""
+        try:
+            kind, request_id = self._header.unpack_from(message)
+        except struct.error:
+            raise self._error(self.INVALID_REQUEST, 'message too short', True, None) from None
+        if request_id == self.NO_ID:
+            request_id = None
+        offset = self._header.size
+        if kind in (self.REQUEST, self.NOTIFICATION):
+            try:
+                method, offset = self._unpack_method(message, offset)
+                args = self._decode_json(message[offset:])
+                if kind == self.REQUEST:
+                    return Request(method, args), request_id
+                return Notification(method, args), None
+            except (struct.error, UnicodeDecodeError):
+                code, error_message = self.INVALID_REQUEST, 'invalid method'
+            except ProtocolError as error:
+                code, error_message = error.code, error.message
+            raise self._error(code, error_message, True, request_id)
+        try:
+            if kind == self.RESULT:
+                return Response(self._decode_json(message[offset:])), request_id
+            if kind == self.BYTES_RESULT:
+                return Response(message[offset:]), request_id
+            if kind == self.ERROR:
+                code, error_message = self._decode_json(message[offset:])
+                return Response(RPCError(code, error_message)), request_id
+            code, error_message = self.INVALID_REQUEST, f'unknown message kind {kind}'
+        except ValueError:
+            code, error_message = self.INVALID_REQUEST, 'ill-formed response error'
+        except ProtocolError as error:
+            code, error_message = error.code, error.message
+        raise self._error(code, error_message, False, request_id)
+
+    def request_message(self, item, request_id):
+        assert isinstance(item, Request)
+        return b''.join((self._pack_header(self.REQUEST, request_id),
+                         self._pack_method(item.method),
+                         self.encode_payload(item.args)))
+
+    def notification_message(self, item):
+        assert isinstance(item, Notification)
+        return b''.join((self._pack_header(self.NOTIFICATION, None),
+                         self._pack_method(item.method),
+                         self.encode_payload(item.args)))
+
+    @classmethod
+    def response_message(cls, result, request_id):
+        if isinstance(result, CodeMessageError):
+            return cls._pack_header(cls.ERROR, request_id) + \
+                cls.encode_payload([result.code, result.message])
+        if isinstance(result, EncodedResult):
+            if result.raw is not None:
+                return cls._pack_header(cls.BYTES_RESULT, request_id) + result.raw
+            return cls._pack_header(cls.RESULT, request_id) + result.json
+        if isinstance(result, (bytes, bytearray)):
+            return cls._pack_header(cls.BYTES_RESULT, request_id) + result
+        return cls._pack_header(cls.RESULT, request_id) + cls.encode_payload(result)
+
+
+# EncodedResults are encoded as this string, then replaced by their JSON
+_SPLICE_MARKER = '\0encoded result'
+_SPLICED_MARKER = json.dumps(_SPLICE_MARKER).encode()
+
+
+def _encode_bytes(value):
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode()
+    raise TypeError(f'{value!r} is not JSON serializable')
+
+
+def _encode_result(value):
+    if isinstance(value, EncodedResult):
+        return value.result
+    return _encode_bytes(value)
+
+
 class JSONRPCConnection(object):
     """Maintains state of a JSON RPC connection, in particular
     encapsulating the handling of request IDs.
@@ -746,6 +937,11 @@ class JSONRPCConnection(object):
             self._protocol = item
             return self.receive_message(message)
 
+    def set_protocol(self, protocol):
+        """Switch to another protocol, e.g. to a BinaryRPC once both sides
+        agreed to."""
+        self._protocol = protocol
+
     def raise_pending_requests(self, exception):
         exception = exception or asyncio.TimeoutError()
         for request, event in self._requests.values():
@@ -36,9 +36,10 @@ from contextlib import suppress
 
 from torba.tasks import TaskGroup
 
-from .jsonrpc import Request, JSONRPCConnection, JSONRPCv2, JSONRPC, Batch, Notification
+from .jsonrpc import Request, JSONRPCConnection, JSONRPCv2, JSONRPC, Batch, Notification, BinaryRPC
 from .jsonrpc import RPCError, ProtocolError
 from .framing import BadMagicError, BadChecksumError, OversizedPayloadError, BitcoinFramer, NewlineFramer
+from .framing import LengthPrefixedFramer
 from .util import Concurrency
 
 
@@ -409,11 +410,28 @@ class BatchRequest(object):
 
 class RPCSession(SessionBase):
     """Base class for protocols where a message can lead to a response,
-    for example JSON RPC."""
+    for example JSON RPC.
+
+    A connection can switch from newline framed JSON to BinaryRPC
+    messages framed by a LengthPrefixedFramer.  The connecting side
+    asks for it by sending BINARY_PREAMBLE first, see
+    request_binary_protocol(); a session with allow_binary set answers
+    with BINARY_PREAMBLE and switches too.  As the preamble is not
+    JSON other servers send an error instead and close the connection.
+    """
+
+    BINARY_PREAMBLE = b'\0binary\n'
+    # Set to let connecting sides switch to the binary protocol
+    allow_binary = False
 
     def __init__(self, *, framer=None, loop=None, connection=None):
         super().__init__(framer=framer, loop=loop)
         self.connection = connection or self.default_connection()
+        # Received bytes held back while waiting for BINARY_PREAMBLE
+        self._preamble = None
+        self._binary_requested = False
+        # The framer and protocol to restore when the connection is lost
+        self._json = None
 
     async def _receive_messages(self):
         while not self.is_closing():
@@ -422,6 +440,11 @@ class RPCSession(SessionBase):
             except MemoryError as e:
                 self.logger.warning(f'{e!r}')
                 continue
+            except OversizedPayloadError as e:
+                command, payload_len = e.args
+                self.logger.error(f'oversized message of {payload_len:,d} bytes, disconnecting')
+                self._close()
+                return
 
             self.last_recv = time.perf_counter()
             self.recv_count += 1
@@ -441,9 +464,13 @@ class RPCSession(SessionBase):
                 for request in requests:
                     await self._task_group.add(self._throttled_request(request))
 
+    def _request_semaphore(self, request):
+        """Return what limits the concurrency of processing request."""
+        return self._concurrency.semaphore
+
     async def _throttled_request(self, request):
         """Process a single request, respecting the concurrency limit."""
-        async with self._concurrency.semaphore:
+        async with self._request_semaphore(request):
             try:
                 result = await self.handle_request(request)
             except (ProtocolError, RPCError) as e:
@@ -461,10 +488,59 @@ class RPCSession(SessionBase):
             if isinstance(result, Exception):
                 self._bump_errors()
 
+    def _use_binary_protocol(self):
+        self._json = (self.framer, self.connection._protocol)
+        self.framer = LengthPrefixedFramer(self.framer.max_size)
+        self.connection.set_protocol(BinaryRPC())
+        # Restart message processing, which waits on the old framer
+        if self._pm_task:
+            self._pm_task.cancel()
+        self._pm_task = self.loop.create_task(self._receive_messages())
+
+    def _receive_preamble(self, data):
+        """Return the data received after BINARY_PREAMBLE or, if it has
+        not all arrived yet, None.  Switch to the binary protocol when
+        it was asked for, and return the data unchanged otherwise."""
+        data = self._preamble + data
+        preamble = self.BINARY_PREAMBLE
+        if len(data) < len(preamble) and preamble.startswith(data):
+            self._preamble = data
+            return None
+        self._preamble = None
+        if not data.startswith(preamble):
+            if self._binary_requested:
+                self.binary_refused()
+                return None
+            return data
+        if not self._binary_requested:
+            self.transport.write(preamble)
+            self._use_binary_protocol()
+        self.binary_accepted()
+        return data[len(preamble):]
+
+    def data_received(self, framed_message):
+        if self._preamble is not None:
+            framed_message = self._receive_preamble(framed_message)
+            if not framed_message:
+                return
+        super().data_received(framed_message)
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        if self.allow_binary:
+            self._preamble = b''
+
     def connection_lost(self, exc):
         # Cancel pending requests and message processing
         self.connection.raise_pending_requests(exc)
         super().connection_lost(exc)
+        # A new connection starts out in JSON
+        self._preamble = None
+        self._binary_requested = False
+        if self._json:
+            self.framer, protocol = self._json
+            self.connection.set_protocol(protocol)
+            self._json = None
 
     # External API
     def default_connection(self):
@@ -475,6 +551,26 @@ class RPCSession(SessionBase):
         """Return a default framer."""
         return NewlineFramer()
 
+    def request_binary_protocol(self):
+        """Ask the other side to switch to the binary protocol.  Call when
+        the connection is made, before sending anything else.  Messages
+        are sent in the binary protocol from now on; binary_accepted()
+        or binary_refused() is called on the answer."""
+        self.transport.write(self.BINARY_PREAMBLE)
+        self._preamble = b''
+        self._binary_requested = True
+        self._use_binary_protocol()
+
+    def binary_accepted(self):
+        """Called when the connection switched to the binary protocol."""
+        pass
+
+    def binary_refused(self):
+        """Called if the other side refused to switch to the binary
+        protocol.  By default closes the connection."""
+        self.logger.info('binary protocol refused, disconnecting')
+        self._close()
+
     async def handle_request(self, request):
         pass
 
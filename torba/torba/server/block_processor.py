@@ -10,24 +10,44 @@
 
 
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.thread import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
 from struct import pack, unpack
 import time
 
 import torba
+from torba.blockfilter import build_filter, filter_header
 from torba.server.daemon import DaemonError
 from torba.server.hash import hash_to_hex_str, HASHX_LEN
 from torba.server.util import chunks, class_logger
 from torba.server.db import FlushData
+from torba.server.instrumentation import INSTRUMENTS, executor_queue_depth
+
+
+def deserialize_blocks(coin, raw_blocks, first):
+    """Deserialize raw blocks starting at height first.
+
+    Run in the prefetcher's process pool, so the raw bytes are left out
+    of the returned blocks rather than being sent back again."""
+    return [coin.block(raw_block, height)._replace(raw=b'')
+            for height, raw_block in enumerate(raw_blocks, start=first)]
 
 
 class Prefetcher:
-    """Prefetches blocks (in the forward direction only)."""
+    """Prefetches blocks (in the forward direction only).
 
-    def __init__(self, daemon, coin, blocks_event):
+    Blocks are fetched over several concurrent ranged requests and
+    deserialized in the executor, if given, ahead of the block processor.
+    """
+
+    def __init__(self, daemon, coin, blocks_event, executor=None):
         self.logger = class_logger(__name__, self.__class__.__name__)
         self.daemon = daemon
         self.coin = coin
         self.blocks_event = blocks_event
+        self.executor = executor
         self.blocks = []
         self.caught_up = False
         # Access to fetched_height should be protected by the semaphore
@@ -41,6 +61,8 @@ class Prefetcher:
         # This makes the first fetch be 10 blocks
         self.ave_size = self.min_cache_size // 10
         self.polling_delay = 5
+        # Number of ranged getblock requests made concurrently
+        self.fetch_concurrency = 4
 
     async def main_loop(self, bp_height):
         """Loop forever polling for more blocks."""
@@ -55,7 +77,9 @@ class Prefetcher:
                 self.logger.info(f'ignoring daemon error: {e}')
 
     def get_prefetched_blocks(self):
-        """Called by block processor when it is processing queued blocks."""
+        """Called by block processor when it is processing queued blocks.
+
+        Returns a list of deserialized blocks."""
         blocks = self.blocks
         self.blocks = []
         self.cache_size = 0
@@ -109,18 +133,21 @@ class Prefetcher:
                 if self.caught_up:
                     self.logger.info('new block height {:,d} hash {}'
                                      .format(first + count-1, hex_hashes[-1]))
-                blocks = await daemon.raw_blocks(hex_hashes)
 
-                assert count == len(blocks)
+                # Fetch sub-ranges concurrently; each is deserialized as
+                # soon as it arrives, overlapping with the other fetches
+                range_size = -(-count // self.fetch_concurrency)
+                ranges = await asyncio.gather(*(
+                    self._fetch_blocks(first + n * range_size, hashes)
+                    for n, hashes in enumerate(chunks(hex_hashes, range_size))
+                ))
+                blocks = [block for range_blocks, _ in ranges
+                          for block in range_blocks]
+                size = sum(raw_size for _, raw_size in ranges)
 
-                # Special handling for genesis block
-                if first == 0:
-                    blocks[0] = self.coin.genesis_block(blocks[0])
-                    self.logger.info('verified genesis block with hash {}'
-                                     .format(hex_hashes[0]))
+                assert count == len(blocks)
 
                 # Update our recent average block size estimate
-                size = sum(len(block) for block in blocks)
                 if count >= 10:
                     self.ave_size = size // count
                 else:
@@ -134,6 +161,30 @@ class Prefetcher:
         self.refill_event.clear()
         return True
 
+    async def _fetch_blocks(self, first, hex_hashes):
+        """Fetch and deserialize the blocks with the given hex hashes,
+        starting at height first.
+
+        Returns a (blocks, size) pair where size is that of the raw
+        blocks."""
+        raw_blocks = await self.daemon.raw_blocks(hex_hashes)
+
+        # Special handling for genesis block
+        if first == 0:
+            raw_blocks[0] = self.coin.genesis_block(raw_blocks[0])
+            self.logger.info('verified genesis block with hash {}'
+                             .format(hex_hashes[0]))
+
+        size = sum(len(raw_block) for raw_block in raw_blocks)
+        if self.executor is None:
+            return [self.coin.block(raw_block, height) for height, raw_block
+                    in enumerate(raw_blocks, start=first)], size
+        blocks = await asyncio.get_event_loop().run_in_executor(
+            self.executor, deserialize_blocks, self.coin, raw_blocks, first
+        )
+        return [block._replace(raw=raw_block)
+                for block, raw_block in zip(blocks, raw_blocks)], size
+
 
 class ChainError(Exception):
     """Raised on error processing blocks."""
@@ -154,7 +205,11 @@ class BlockProcessor:
 
         self.coin = env.coin
         self.blocks_event = asyncio.Event()
-        self.prefetcher = Prefetcher(daemon, env.coin, self.blocks_event)
+        self.deserialize_executor = None
+        if env.prefetch_workers:
+            self.deserialize_executor = ProcessPoolExecutor(env.prefetch_workers)
+        self.prefetcher = Prefetcher(daemon, env.coin, self.blocks_event,
+                                     self.deserialize_executor)
         self.logger = class_logger(__name__, self.__class__.__name__)
 
         # Meta
@@ -166,11 +221,27 @@ class BlockProcessor:
         self.headers = []
         self.tx_hashes = []
         self.undo_infos = []
+        self.filters = []
+
+        # The filter header of the tip, and the hashXs of each tx of the
+        # last block advanced that its filter is built from
+        self.filter_header = None
+        self.block_hashXs = []
 
         # UTXO cache
         self.utxo_cache = {}
         self.db_deletes = []
 
+        # The generation of the UTXO cache being written out by the
+        # background flusher.  It is read-only and consulted after
+        # utxo_cache until the flush has committed.
+        self.flushing_utxos = {}
+        self.flush_executor = ThreadPoolExecutor(1)
+        self._flush_task = None
+        self.utxo_cache_stats = INSTRUMENTS.cache('utxo')
+        INSTRUMENTS.gauge('executor_queue_depth', 'Work items waiting for an executor worker',
+                          partial(executor_queue_depth, self.flush_executor), executor='flush')
+
         # If the lock is successfully acquired, in-memory chain state
         # is consistent with self.height
         self.state_lock = asyncio.Lock()
@@ -186,15 +257,12 @@ class BlockProcessor:
                 return await asyncio.get_event_loop().run_in_executor(None, func, *args)
         return await asyncio.shield(run_in_thread_locked())
 
-    async def check_and_advance_blocks(self, raw_blocks):
-        """Process the list of raw blocks passed.  Detects and handles
-        reorgs.
+    async def check_and_advance_blocks(self, blocks):
+        """Process the list of deserialized blocks passed.  Detects and
+        handles reorgs.
         """
-        if not raw_blocks:
+        if not blocks:
             return
-        first = self.height + 1
-        blocks = [self.coin.block(raw_block, first + n)
-                  for n, raw_block in enumerate(raw_blocks)]
         headers = [block.header for block in blocks]
         hprevs = [self.coin.header_prevhash(h) for h in headers]
         chain = [self.tip] + [self.coin.header_hash(h) for h in headers[:-1]]
@@ -202,15 +270,13 @@ class BlockProcessor:
         if hprevs == chain:
             start = time.time()
             await self.run_in_thread_with_lock(self.advance_blocks, blocks)
-            await self._maybe_flush()
+            touched, self.touched = self.touched, set()
+            await self._maybe_flush(touched)
             if not self.db.first_sync:
                 s = '' if len(blocks) == 1 else 's'
                 self.logger.info('processed {:,d} block{} in {:.1f}s'
                                  .format(len(blocks), s,
                                          time.time() - start))
-            if self._caught_up_event.is_set():
-                await self.notifications.on_block(self.touched, self.height)
-            self.touched = set()
         elif hprevs[0] != chain[0]:
             await self.reorg_chain()
         else:
@@ -322,23 +388,78 @@ class BlockProcessor:
         assert self.state_lock.locked()
         return FlushData(self.height, self.tx_count, self.headers,
                          self.tx_hashes, self.undo_infos, self.utxo_cache,
-                         self.db_deletes, self.tip)
+                         self.db_deletes, self.tip, filters=self.filters)
+
+    def freeze_flush_data(self, flush_utxos):
+        """Hand the unflushed caches over to a FlushData and start a fresh
+        generation of them.  The UTXO state is only handed over if
+        flush_utxos.  The lock must be taken."""
+        flush_data = self.flush_data()
+        flush_data.history = self.db.history.freeze_unflushed()
+        self.headers = []
+        self.tx_hashes = []
+        self.filters = []
+        if flush_utxos:
+            self.flushing_utxos = self.utxo_cache
+            self.utxo_cache = {}
+            self.undo_infos = []
+            self.db_deletes = []
+        else:
+            flush_data.undo_infos = []
+            flush_data.adds = {}
+            flush_data.deletes = []
+        return flush_data
+
+    async def wait_for_flush(self):
+        """Wait for a background flush in progress, if any."""
+        if self._flush_task is not None:
+            # Shielded so a cancellation doesn't abandon the flush
+            await asyncio.shield(self._flush_task)
+
+    async def flush_in_background(self, flush_utxos, on_flushed=None):
+        """Freeze the caches and flush them in the flusher thread while
+        blocks are advanced into a fresh generation.
+
+        A flush still in progress is waited for first, so at most two
+        generations are held in memory and flushes are written in order,
+        preserving the flush_count / utxo_flush_count recovery logic.
+        on_flushed is an optional coroutine function run once the flush
+        has committed.  Returns the flush task.
+        """
+        await self.wait_for_flush()
+        async with self.state_lock:
+            flush_data = self.freeze_flush_data(flush_utxos)
+
+        async def flush():
+            await asyncio.get_event_loop().run_in_executor(
+                self.flush_executor, self.db.flush_dbs, flush_data,
+                flush_utxos, self.estimate_txs_remaining
+            )
+            if flush_utxos:
+                self.flushing_utxos = {}
+            if on_flushed is not None:
+                await on_flushed()
+
+        self._flush_task = asyncio.ensure_future(flush())
+        return self._flush_task
 
     async def flush(self, flush_utxos):
-        def flush():
-            self.db.flush_dbs(self.flush_data(), flush_utxos,
-                              self.estimate_txs_remaining)
-        await self.run_in_thread_with_lock(flush)
+        """Flush the caches and wait for the flush to complete."""
+        await self.flush_in_background(flush_utxos)
+        await self.wait_for_flush()
 
-    async def _maybe_flush(self):
+    async def _maybe_flush(self, touched):
         # If caught up, flush everything as client queries are
-        # performed on the DB.
+        # performed on the DB.  Sessions are notified about the new
+        # blocks once they are on disk.
         if self._caught_up_event.is_set():
-            await self.flush(True)
+            await self.flush_in_background(
+                True, partial(self.notifications.on_block, touched, self.height)
+            )
         elif time.time() > self.next_cache_check:
             flush_arg = self.check_cache_size()
             if flush_arg is not None:
-                await self.flush(flush_arg)
+                await self.flush_in_background(flush_arg)
             self.next_cache_check = time.time() + 30
 
     def check_cache_size(self):
@@ -383,6 +504,8 @@ class BlockProcessor:
             if height >= min_height:
                 self.undo_infos.append((undo_info, height))
                 self.db.write_raw_block(block.raw, height)
+            if self.env.block_filters:
+                self.advance_filter(block.header)
 
         headers = [block.header for block in blocks]
         self.height = height
@@ -431,12 +554,21 @@ class BlockProcessor:
             tx_num += 1
 
         self.db.history.add_unflushed(hashXs_by_tx, self.tx_count)
+        self.block_hashXs = hashXs_by_tx
 
         self.tx_count = tx_num
         self.db.tx_counts.append(tx_num)
 
         return undo_info
 
+    def advance_filter(self, header):
+        """Build the filter of the block just advanced, over the hashXs
+        of the outputs it creates and spends."""
+        block_filter = build_filter(self.coin.header_hash(header),
+                                    chain.from_iterable(self.block_hashXs))
+        self.filter_header = filter_header(block_filter, self.filter_header)
+        self.filters.append(self.filter_header + block_filter)
+
     def backup_blocks(self, raw_blocks):
         """Backup the raw blocks and flush.
 
@@ -460,6 +592,7 @@ class BlockProcessor:
             self.backup_txs(block.transactions)
             self.height -= 1
             self.db.tx_counts.pop()
+        self.filter_header = self.db.read_filter_header(self.height)
 
         self.logger.info('backed up to height {:,d}'.format(self.height))
 
@@ -566,7 +699,18 @@ class BlockProcessor:
         # Fast track is it being in the cache
         idx_packed = pack('<H', tx_idx)
         cache_value = self.utxo_cache.pop(tx_hash + idx_packed, None)
+        self.utxo_cache_stats.record(cache_value is not None)
+        if cache_value:
+            return cache_value
+
+        # Next the generation being flushed.  It is being written to
+        # the DB so delete its entries there in the next flush.
+        cache_value = self.flushing_utxos.get(tx_hash + idx_packed)
         if cache_value:
+            hashX = cache_value[:-12]
+            suffix = idx_packed + cache_value[-12:-8]
+            self.db_deletes.append(b'h' + tx_hash[:4] + suffix)
+            self.db_deletes.append(b'u' + hashX + suffix)
             return cache_value
 
         # Spend it from the DB.
@@ -574,8 +718,10 @@ class BlockProcessor:
         # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
         # Value: hashX
         prefix = b'h' + tx_hash[:4] + idx_packed
-        candidates = {db_key: hashX for db_key, hashX
-                      in self.db.utxo_db.iterator(prefix=prefix)}
+        candidates = {}
+        if self.db.may_have_utxo(prefix[1:]):
+            candidates = {db_key: hashX for db_key, hashX
+                          in self.db.utxo_db.iterator(prefix=prefix)}
 
         for hdb_key, hashX in candidates.items():
             tx_num_packed = hdb_key[-4:]
@@ -633,6 +779,7 @@ class BlockProcessor:
         self.height = self.db.db_height
         self.tip = self.db.db_tip
         self.tx_count = self.db.db_tx_count
+        self.filter_header = self.db.read_filter_header(self.height)
 
     # --- External API
 
@@ -660,6 +807,9 @@ class BlockProcessor:
             self.logger.info('flushing to DB for a clean shutdown...')
             await self.flush(True)
             self.db.close()
+            self.flush_executor.shutdown(True)
+            if self.deserialize_executor is not None:
+                self.deserialize_executor.shutdown(True)
 
     def force_chain_reorg(self, count):
         """Force a reorg of the given number of blocks.
@@ -0,0 +1,87 @@
+"""A Bloom filter of the UTXO DB keys, to skip looking up UTXOs the DB
+doesn't have."""
+
+import os
+from struct import Struct
+
+from torba.server import util
+
+
+class BloomFilter:
+    """A Bloom filter of byte string keys, which can be saved to and
+    loaded from a file.
+
+    Keys can't be removed, so keys added and later deleted from the
+    DB turn into false positives.  Those are counted by whoever looks
+    up the DB, and the filter rebuilt once more keys were added than
+    it has room for.
+
+    Keys need to be random already, like the tx hashes of the UTXO
+    keys, as they are only mixed with a multiplicative hash.
+    """
+
+    # 10 bits per key with 7 hashes give a 1% false positive rate
+    BITS_PER_KEY = 10
+    HASHES = 7
+    MIN_SIZE = 8 * 1000 * 1000
+    HEADER = Struct('<QBQQ')
+
+    def __init__(self, size, hashes=HASHES, count=0, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(size // 8) if bits is None else bits
+        # Keys added, including ones since deleted
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity):
+        """Return an empty filter with room for capacity keys."""
+        size = max(cls.MIN_SIZE, capacity * cls.BITS_PER_KEY)
+        return cls(size + -size % 8)
+
+    @property
+    def capacity(self):
+        return self.size // self.BITS_PER_KEY
+
+    def is_full(self):
+        return self.count > self.capacity
+
+    def _positions(self, key):
+        x = int.from_bytes(key, 'little')
+        h1 = (x * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+        h2 = (x * 0xc2b2ae3d27d4eb4f) & 0xffffffffffffffff | 1
+        size = self.size
+        return [(h1 + n * h2) % size for n in range(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def save(self, path, flush_count):
+        """Save the filter of the DB as of flush_count."""
+        with util.open_truncate(path) as f:
+            f.write(self.HEADER.pack(self.size, self.hashes, self.count, flush_count))
+            f.write(self.bits)
+
+    @classmethod
+    def load(cls, path, flush_count):
+        """Return the filter saved to path, or None if there is none of the
+        DB as of flush_count."""
+        if not os.path.exists(path):
+            return None
+        with util.open_file(path) as f:
+            header = f.read(cls.HEADER.size)
+            if len(header) != cls.HEADER.size:
+                return None
+            size, hashes, count, saved_flush_count = cls.HEADER.unpack(header)
+            bits = bytearray(f.read())
+        if saved_flush_count != flush_count or len(bits) * 8 != size:
+            return None
+        return cls(size, hashes, count, bits)
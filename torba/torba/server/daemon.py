@@ -13,7 +13,7 @@ import itertools
 import json
 import time
 from calendar import timegm
-from struct import pack
+from struct import pack, unpack
 from time import strptime
 
 import aiohttp
@@ -22,6 +22,7 @@ from torba.server.util import hex_to_bytes, class_logger,\
     unpack_le_uint16_from, pack_varint
 from torba.server.hash import hex_str_to_hash, hash_to_hex_str
 from torba.server.tx import DeserializerDecred
+from torba.server.instrumentation import INSTRUMENTS, timed
 from torba.rpc import JSONRPC
 
 
@@ -174,7 +175,8 @@ class Daemon:
         payload = {'method': method, 'id': next(self.id_counter)}
         if params:
             payload['params'] = params
-        return await self._send(payload, processor)
+        with timed(self._request_histogram(method)):
+            return await self._send(payload, processor)
 
     async def _send_vector(self, method, params_iterable, replace_errs=False):
         """Send several requests of the same method.
@@ -193,9 +195,15 @@ class Daemon:
         payload = [{'method': method, 'params': p, 'id': next(self.id_counter)}
                    for p in params_iterable]
         if payload:
-            return await self._send(payload, processor)
+            with timed(self._request_histogram(method)):
+                return await self._send(payload, processor)
         return []
 
+    @staticmethod
+    def _request_histogram(method):
+        return INSTRUMENTS.histogram('daemon_request_seconds', 'Latency of daemon RPC requests by method',
+                                     method=method)
+
     async def _is_rpc_available(self, method):
         """Return whether given RPC method is available in the daemon.
 
@@ -286,6 +294,66 @@ class Daemon:
         return self._height
 
 
+class ZMQFeed:
+    """Subscribes to the transactions and blocks a daemon publishes over
+    ZMQ, as configured with its -zmqpubrawtx and -zmqpubhashblock
+    options.  Requires pyzmq."""
+
+    TOPICS = (b'rawtx', b'hashblock')
+    # Yielded with the topic whose notifications were missed
+    MISSED = b'missed'
+
+    def __init__(self, url):
+        import zmq
+        import zmq.asyncio
+        self.zmq = zmq
+        self.url = url
+        self.logger = class_logger(__name__, self.__class__.__name__)
+        self.connected = False
+        self.sequences = {}
+
+    async def _monitor(self, monitor):
+        zmq = self.zmq
+        while True:
+            event_id = (await monitor.recv_multipart())[0]
+            event, = unpack('<H', event_id[:2])
+            if event == zmq.EVENT_CONNECTED:
+                self.logger.info(f'connected to {self.url}')
+                self.connected = True
+            elif event == zmq.EVENT_DISCONNECTED:
+                self.logger.warning(f'disconnected from {self.url}')
+                self.connected = False
+
+    async def messages(self):
+        """Yield (topic, body) pairs as they are published.  A gap in the
+        sequence numbers of a topic, e.g. after the daemon restarted or
+        we reconnected, yields a (MISSED, topic) pair."""
+        zmq = self.zmq
+        context = zmq.asyncio.Context()
+        socket = context.socket(zmq.SUB)
+        for topic in self.TOPICS:
+            socket.setsockopt(zmq.SUBSCRIBE, topic)
+        monitor_socket = socket.get_monitor_socket()
+        monitor = asyncio.ensure_future(self._monitor(monitor_socket))
+        socket.connect(self.url)
+        try:
+            while True:
+                topic, body, sequence = await socket.recv_multipart()
+                sequence, = unpack('<I', sequence)
+                last = self.sequences.get(topic)
+                self.sequences[topic] = sequence
+                if last is not None and sequence != (last + 1) & 0xffffffff:
+                    self.logger.warning(f'missed {topic.decode()} notifications')
+                    yield self.MISSED, topic
+                yield topic, body
+        finally:
+            monitor.cancel()
+            socket.disable_monitor()
+            monitor_socket.close(linger=0)
+            socket.close(linger=0)
+            context.term()
+
+
 class DashDaemon(Daemon):
 
     async def masternode_broadcast(self, params):
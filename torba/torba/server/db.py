@@ -24,11 +24,13 @@ from struct import pack, unpack
 import attr
 
 from torba.server import util
+from torba.server.bloom import BloomFilter
 from torba.server.hash import hash_to_hex_str, HASHX_LEN
 from torba.server.merkle import Merkle, MerkleCache
 from torba.server.util import formatted_time
 from torba.server.storage import db_class
 from torba.server.history import History
+from torba.server.instrumentation import INSTRUMENTS
 
 
 UTXO = namedtuple("UTXO", "tx_num tx_pos tx_hash height value")
@@ -45,6 +47,11 @@ class FlushData:
     adds = attr.ib()
     deletes = attr.ib()
     tip = attr.ib()
+    # A frozen generation of unflushed history handed over by the block
+    # processor, or None to flush the history's live generation
+    history = attr.ib(default=None)
+    # Filter header + block filter of each header, if BLOCK_FILTERS
+    filters = attr.ib(default=attr.Factory(list))
 
 
 class DB:
@@ -80,6 +87,14 @@ class DB:
         self.tx_counts = None
         self.last_flush = time.time()
 
+        # A Bloom filter of the UTXOs in the DB, if UTXO_FILTER, with
+        # counts of the lookups it rejected and of those it let through
+        # that found nothing
+        self.utxo_filter = None
+        self.utxo_filter_rejects = 0
+        self.utxo_filter_false_positives = 0
+        self.flush_histogram = INSTRUMENTS.histogram('flush_seconds', 'Duration of DB flushes')
+
         self.logger.info(f'using {self.env.db_engine} for DB backend')
 
         # Header merkle cache
@@ -93,6 +108,7 @@ class DB:
         if not self.coin.STATIC_BLOCK_HEADERS:
             self.headers_offsets_file = util.LogicalFile(
                 path('meta/headers_offsets'), 2, 16000000)
+        self.utxo_filter_path = path('meta/utxo_filter')
 
     async def _read_tx_counts(self):
         if self.tx_counts is not None:
@@ -133,10 +149,15 @@ class DB:
                                                      compacting)
         self.clear_excess_undo_info()
 
+        if self.env.utxo_filter and self.utxo_filter is None:
+            self.open_utxo_filter()
+
         # Read TX counts (requires meta directory)
         await self._read_tx_counts()
 
     def close(self):
+        if self.utxo_filter is not None:
+            self.utxo_filter.save(self.utxo_filter_path, self.utxo_flush_count)
         self.utxo_db.close()
         self.history.close_db()
 
@@ -163,6 +184,37 @@ class DB:
             self.utxo_db = None
         await self._open_dbs(False, False)
 
+    async def open_for_reading(self):
+        """Open the databases of a block processor running in another
+        process, to serve sessions from.  Nothing is written; call
+        refresh() to pick up its flushes.
+        """
+        self.utxo_db = self.db_class('utxo', False)
+        self.read_utxo_state()
+        self.history.open_db_for_reading(self.db_class)
+        await self._read_tx_counts()
+
+    def refresh(self):
+        """Catch up with the flushes of the block processor of another
+        process.  Returns the new height."""
+        state = ast.literal_eval(self.utxo_db.get(b'state').decode())
+        height = state['height']
+        # Blocks within the reorg limit may have been replaced since we
+        # last looked, so re-read their tx counts and merkle cache
+        start = max(0, min(height, self.db_height) - self.env.reorg_limit)
+        size = (height + 1 - start) * self.tx_counts.itemsize
+        tx_counts = self.tx_counts_file.read(start * self.tx_counts.itemsize, size)
+        assert len(tx_counts) == size
+        del self.tx_counts[start:]
+        self.tx_counts.frombytes(tx_counts)
+        if start:
+            self.header_mc.truncate(start)
+        self.db_height = self.fs_height = height
+        self.db_tx_count = self.fs_tx_count = state['tx_count']
+        self.db_tip = state['tip']
+        self.first_sync = state['first_sync']
+        return height
+
     # Header merkle cache
 
     async def populate_header_merkle_cache(self):
@@ -187,7 +239,11 @@ class DB:
         assert not flush_data.adds
         assert not flush_data.deletes
         assert not flush_data.undo_infos
-        self.history.assert_flushed()
+        assert not flush_data.filters
+        if flush_data.history is None:
+            self.history.assert_flushed()
+        else:
+            assert not flush_data.history
 
     def flush_dbs(self, flush_data, flush_utxos, estimate_txs_remaining):
         """Flush out cached state.  History is always flushed; UTXOs are
@@ -204,19 +260,25 @@ class DB:
         self.flush_fs(flush_data)
 
         # Then history
-        self.flush_history()
+        self.flush_history(flush_data.history)
 
         # Flush state last as it reads the wall time.
         with self.utxo_db.write_batch() as batch:
+            self.flush_filters(batch.put, flush_data)
             if flush_utxos:
                 self.flush_utxo_db(batch, flush_data)
             self.flush_state(batch)
+        if flush_utxos:
+            self.clear_utxo_flush_data(flush_data)
+            if self.utxo_filter is not None and self.utxo_filter.is_full():
+                self.rebuild_utxo_filter()
 
         # Update and put the wall time again - otherwise we drop the
         # time it took to commit the batch
         self.flush_state(self.utxo_db)
 
         elapsed = self.last_flush - start_time
+        self.flush_histogram.observe(elapsed)
         self.logger.info(f'flush #{self.history.flush_count:,d} took '
                          f'{elapsed:.1f}s.  Height {flush_data.height:,d} '
                          f'txs: {flush_data.tx_count:,d} ({tx_delta:+,d})')
@@ -238,14 +300,18 @@ class DB:
         The first height to write is self.fs_height + 1.  The FS
         metadata is all append-only, so in a crash we just pick up
         again from the height stored in the DB.
+
+        When flushing in the background the block processor may have
+        appended tx counts beyond flush_data.height; those are left for
+        the next flush.
         """
         prior_tx_count = (self.tx_counts[self.fs_height]
                           if self.fs_height >= 0 else 0)
         assert len(flush_data.block_tx_hashes) == len(flush_data.headers)
         assert flush_data.height == self.fs_height + len(flush_data.headers)
-        assert flush_data.tx_count == (self.tx_counts[-1] if self.tx_counts
-                                       else 0)
-        assert len(self.tx_counts) == flush_data.height + 1
+        assert len(self.tx_counts) >= flush_data.height + 1
+        assert flush_data.tx_count == (self.tx_counts[flush_data.height]
+                                       if flush_data.height >= 0 else 0)
         hashes = b''.join(flush_data.block_tx_hashes)
         flush_data.block_tx_hashes.clear()
         assert len(hashes) % 32 == 0
@@ -260,8 +326,8 @@ class DB:
         flush_data.headers.clear()
 
         offset = height_start * self.tx_counts.itemsize
-        self.tx_counts_file.write(offset,
-                                  self.tx_counts[height_start:].tobytes())
+        tx_counts = self.tx_counts[height_start:flush_data.height + 1]
+        self.tx_counts_file.write(offset, tx_counts.tobytes())
         offset = prior_tx_count * 32
         self.hashes_file.write(offset, hashes)
 
@@ -272,8 +338,8 @@ class DB:
             elapsed = time.time() - start_time
             self.logger.info(f'flushed filesystem data in {elapsed:.2f}s')
 
-    def flush_history(self):
-        self.history.flush()
+    def flush_history(self, unflushed=None):
+        self.history.flush(unflushed)
 
     def flush_utxo_db(self, batch, flush_data):
         """Flush the cached DB writes and UTXO set to the batch."""
@@ -288,21 +354,23 @@ class DB:
         batch_delete = batch.delete
         for key in sorted(flush_data.deletes):
             batch_delete(key)
-        flush_data.deletes.clear()
 
         # New UTXOs
         batch_put = batch.put
+        filter_add = self.utxo_filter.add if self.utxo_filter is not None else None
         for key, value in flush_data.adds.items():
             # suffix = tx_idx + tx_num
             hashX = value[:-12]
             suffix = key[-2:] + value[-12:-8]
             batch_put(b'h' + key[:4] + suffix, hashX)
             batch_put(b'u' + hashX + suffix, value[-8:])
-        flush_data.adds.clear()
+            if filter_add is not None:
+                # Added before the batch is committed, so the filter
+                # never misses a UTXO in the DB
+                filter_add(key[:4] + key[-2:])
 
         # New undo information
         self.flush_undo_infos(batch_put, flush_data.undo_infos)
-        flush_data.undo_infos.clear()
 
         if self.utxo_db.for_sync:
             block_count = flush_data.height - self.db_height
@@ -318,6 +386,15 @@ class DB:
         self.db_tx_count = flush_data.tx_count
         self.db_tip = flush_data.tip
 
+    @staticmethod
+    def clear_utxo_flush_data(flush_data):
+        """Release the UTXO state of a flush.  Only called once the batch
+        is committed, as until then the block processor may still be
+        looking up UTXOs in the flushed generation."""
+        flush_data.deletes.clear()
+        flush_data.adds.clear()
+        flush_data.undo_infos.clear()
+
     def flush_state(self, batch):
         """Flush chain state to the batch."""
         now = time.time()
@@ -330,6 +407,7 @@ class DB:
         """Like flush_dbs() but when backing up.  All UTXOs are flushed."""
         assert not flush_data.headers
         assert not flush_data.block_tx_hashes
+        assert not flush_data.filters
         assert flush_data.height < self.db_height
         self.history.assert_flushed()
 
@@ -339,9 +417,12 @@ class DB:
         self.backup_fs(flush_data.height, flush_data.tx_count)
         self.history.backup(touched, flush_data.tx_count)
         with self.utxo_db.write_batch() as batch:
+            for height in range(flush_data.height + 1, self.db_height + 1):
+                batch.delete(self.filter_key(height))
             self.flush_utxo_db(batch, flush_data)
             # Flush state last as it reads the wall time.
             self.flush_state(batch)
+        self.clear_utxo_flush_data(flush_data)
 
         elapsed = self.last_flush - start_time
         self.logger.info(f'backup flush #{self.history.flush_count:,d} took '
@@ -453,6 +534,42 @@ class DB:
                                 f'not found (reorg?), retrying...')
             await sleep(0.25)
 
+    # -- Block filters
+
+    def filter_key(self, height):
+        """DB key for the block filter at the given height."""
+        return b'F' + pack('>I', height)
+
+    def flush_filters(self, batch_put, flush_data):
+        """Write the filters of the flushed headers.  Those are written
+        with the flush state so they are never ahead of it."""
+        start = flush_data.height + 1 - len(flush_data.filters)
+        for height, value in enumerate(flush_data.filters, start=start):
+            batch_put(self.filter_key(height), value)
+        flush_data.filters.clear()
+
+    def read_filter_header(self, height):
+        """Return the filter header at the given height.  That before the
+        first filter is 32 zero bytes, which is what the chain starts from
+        if there is no filter at height."""
+        value = self.utxo_db.get(self.filter_key(height)) if height >= 0 else None
+        return value[:32] if value else bytes(32)
+
+    async def read_filters(self, start_height, count):
+        """Return a list of (filter header, block filter) pairs of the
+        blocks from start_height.  The list stops short of count at the
+        first height past the DB height or without a filter."""
+        def read_filters():
+            filters = []
+            for height in range(start_height, min(start_height + count, self.db_height + 1)):
+                value = self.utxo_db.get(self.filter_key(height))
+                if value is None:
+                    break
+                filters.append((value[:32], value[32:]))
+            return filters
+
+        return await asyncio.get_event_loop().run_in_executor(None, read_filters)
+
     # -- Undo information
 
     def min_undo_height(self, max_height):
@@ -525,6 +642,54 @@ class DB:
                     pass
             self.logger.info(f'deleted {len(paths):,d} stale block files')
 
+    # -- UTXO filter
+
+    def open_utxo_filter(self):
+        """Load the UTXO filter saved on closing the DB, or build it if
+        the DB changed since, e.g. after a crash."""
+        self.utxo_filter = BloomFilter.load(self.utxo_filter_path, self.utxo_flush_count)
+        if self.utxo_filter is None:
+            self.rebuild_utxo_filter()
+        else:
+            self.logger.info(f'loaded UTXO filter of {self.utxo_filter.count:,d} keys')
+
+    def rebuild_utxo_filter(self):
+        """Build the UTXO filter from the keys of the "h" table, leaving
+        room for as many UTXOs again."""
+        start_time = time.time()
+        count = sum(1 for _ in self.utxo_db.iterator(prefix=b'h'))
+        utxo_filter = BloomFilter.for_capacity(2 * count)
+        for key, _ in self.utxo_db.iterator(prefix=b'h'):
+            # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
+            utxo_filter.add(key[1:7])
+        self.utxo_filter = utxo_filter
+        elapsed = time.time() - start_time
+        self.logger.info(f'built UTXO filter of {count:,d} keys in {elapsed:.1f}s')
+
+    def may_have_utxo(self, key):
+        """Return False if the UTXO with the key, a compressed tx hash and
+        a packed tx_idx, is certainly not in the DB."""
+        utxo_filter = self.utxo_filter
+        if utxo_filter is None or key in utxo_filter:
+            return True
+        self.utxo_filter_rejects += 1
+        return False
+
+    def utxo_filter_info(self):
+        """Return the size of the UTXO filter and its measured false
+        positive rate: the rate of lookups of UTXOs not in the DB that it
+        let through."""
+        if self.utxo_filter is None:
+            return None
+        absent = self.utxo_filter_rejects + self.utxo_filter_false_positives
+        return {
+            'keys': self.utxo_filter.count,
+            'capacity': self.utxo_filter.capacity,
+            'rejects': self.utxo_filter_rejects,
+            'false_positives': self.utxo_filter_false_positives,
+            'false_positive_rate': self.utxo_filter_false_positives / absent if absent else None,
+        }
+
     # -- UTXO database
 
     def read_utxo_state(self):
@@ -607,11 +772,12 @@ class DB:
             # Key: b'u' + address_hashX + tx_idx + tx_num
             # Value: the UTXO value as a 64-bit unsigned integer
             prefix = b'u' + hashX
-            for db_key, db_value in self.utxo_db.iterator(prefix=prefix):
-                tx_pos, tx_num = s_unpack('<HI', db_key[-6:])
-                value, = unpack('<Q', db_value)
-                tx_hash, height = self.fs_tx_hash(tx_num)
-                utxos_append(UTXO(tx_num, tx_pos, tx_hash, height, value))
+            with self.utxo_db.snapshot() as snapshot:
+                for db_key, db_value in snapshot.iterator(prefix=prefix):
+                    tx_pos, tx_num = s_unpack('<HI', db_key[-6:])
+                    value, = unpack('<Q', db_value)
+                    tx_hash, height = self.fs_tx_hash(tx_num)
+                    utxos_append(UTXO(tx_num, tx_pos, tx_hash, height, value))
             return utxos
 
         while True:
@@ -628,7 +794,7 @@ class DB:
 
         Used by the mempool code.
         """
-        def lookup_hashXs():
+        def lookup_hashXs(snapshot):
             """Return (hashX, suffix) pairs, or None if not found,
             for each prevout.
             """
@@ -638,18 +804,22 @@ class DB:
                 # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
                 # Value: hashX
                 prefix = b'h' + tx_hash[:4] + idx_packed
+                if not self.may_have_utxo(prefix[1:]):
+                    return None, None
 
                 # Find which entry, if any, the TX_HASH matches.
-                for db_key, hashX in self.utxo_db.iterator(prefix=prefix):
-                    tx_num_packed = db_key[-4:]
+                for db_key, hashX in snapshot.iterator(prefix=prefix):
+                    tx_num_packed = bytes(db_key[-4:])
                     tx_num, = unpack('<I', tx_num_packed)
                     hash, height = self.fs_tx_hash(tx_num)
                     if hash == tx_hash:
-                        return hashX, idx_packed + tx_num_packed
+                        return bytes(hashX), idx_packed + tx_num_packed
+                if self.utxo_filter is not None:
+                    self.utxo_filter_false_positives += 1
                 return None, None
             return [lookup_hashX(*prevout) for prevout in prevouts]
 
-        def lookup_utxos(hashX_pairs):
+        def lookup_utxos(snapshot, hashX_pairs):
             def lookup_utxo(hashX, suffix):
                 if not hashX:
                     # This can happen when the daemon is a block ahead
@@ -659,14 +829,19 @@ class DB:
                 # Key: b'u' + address_hashX + tx_idx + tx_num
                 # Value: the UTXO value as a 64-bit unsigned integer
                 key = b'u' + hashX + suffix
-                db_value = self.utxo_db.get(key)
+                db_value = snapshot.get(key)
                 if not db_value:
                     # This can happen if the DB was updated between
-                    # getting the hashXs and getting the UTXOs
+                    # getting the hashXs and getting the UTXOs on
+                    # engines without snapshots
                     return None
                 value, = unpack('<Q', db_value)
                 return hashX, value
             return [lookup_utxo(*hashX_pair) for hashX_pair in hashX_pairs]
 
-        hashX_pairs = await asyncio.get_event_loop().run_in_executor(None, lookup_hashXs)
-        return await asyncio.get_event_loop().run_in_executor(None, lookup_utxos, hashX_pairs)
+        def lookup():
+            # Both lookups read the same snapshot of the DB
+            with self.utxo_db.snapshot() as snapshot:
+                return lookup_utxos(snapshot, lookup_hashXs(snapshot))
+
+        return await asyncio.get_event_loop().run_in_executor(None, lookup)
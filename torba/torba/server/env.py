@@ -8,7 +8,7 @@
 
 import re
 import resource
-from os import environ
+from os import environ, cpu_count
 from collections import namedtuple
 from ipaddress import ip_address
 
@@ -38,11 +38,21 @@ class Env:
         self.db_dir = self.required('DB_DIRECTORY')
         self.db_engine = self.default('DB_ENGINE', 'leveldb')
         self.max_query_workers = self.integer('MAX_QUERY_WORKERS', None)
+        self.prefetch_workers = self.integer('PREFETCH_WORKERS', 2)
+        self.session_workers = self.integer('SESSION_WORKERS', 0)
+        if self.session_workers and self.db_engine.lower() != 'lmdb':
+            # Only LMDB can be read by other processes while it is written
+            raise self.Error('SESSION_WORKERS requires DB_ENGINE=lmdb')
         self.individual_tag_indexes = self.boolean('INDIVIDUAL_TAG_INDEXES', True)
+        self.block_filters = self.boolean('BLOCK_FILTERS', False)
+        self.utxo_filter = self.boolean('UTXO_FILTER', True)
         self.track_metrics = self.boolean('TRACK_METRICS', False)
         self.websocket_host = self.default('WEBSOCKET_HOST', self.host)
         self.websocket_port = self.integer('WEBSOCKET_PORT', None)
+        self.metrics_host = self.default('METRICS_HOST', 'localhost')
+        self.metrics_port = self.integer('METRICS_PORT', None)
         self.daemon_url = self.required('DAEMON_URL')
+        self.daemon_zmq_url = self.default('DAEMON_ZMQ_URL', None)
         if coin is not None:
             assert issubclass(coin, Coin)
             self.coin = coin
@@ -79,6 +89,11 @@ class Env:
         self.max_session_subs = self.integer('MAX_SESSION_SUBS', 50000)
         self.bandwidth_limit = self.integer('BANDWIDTH_LIMIT', 2000000)
         self.session_timeout = self.integer('SESSION_TIMEOUT', 600)
+        # Requests of each cost class served at a time, see scheduler.py
+        self.cheap_concurrency = self.integer('CHEAP_CONCURRENCY', 100)
+        self.disk_concurrency = self.integer('DISK_CONCURRENCY', 20)
+        self.daemon_concurrency = self.integer('DAEMON_CONCURRENCY', 10)
+        self.query_concurrency = self.integer('QUERY_CONCURRENCY', 2 * (self.max_query_workers or max(cpu_count(), 4)))
         self.drop_client = self.custom("DROP_CLIENT", None, re.compile)
         self.description = self.default('DESCRIPTION', '')
         self.daily_fee = self.integer('DAILY_FEE', 0)
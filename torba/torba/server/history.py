@@ -42,6 +42,12 @@ class History:
             self._cancel_compaction()
         return self.flush_count
 
+    def open_db_for_reading(self, db_class):
+        """Open the DB without the clean-ups of open_db(), which are left
+        to the process writing it."""
+        self.db = db_class('hist', False)
+        self.read_state()
+
     def close_db(self):
         if self.db:
             self.db.close()
@@ -123,11 +129,22 @@ class History:
     def assert_flushed(self):
         assert not self.unflushed
 
-    def flush(self):
+    def freeze_unflushed(self):
+        """Return the unflushed history and start a fresh generation, so
+        the frozen one can be flushed while new blocks are added."""
+        unflushed = self.unflushed
+        self.unflushed = defaultdict(partial(array.array, 'I'))
+        self.unflushed_count = 0
+        return unflushed
+
+    def flush(self, unflushed=None):
+        """Flush unflushed history, by default the live generation."""
         start_time = time.time()
         self.flush_count += 1
         flush_id = pack_be_uint16(self.flush_count)
-        unflushed = self.unflushed
+        if unflushed is None:
+            unflushed = self.unflushed
+            self.unflushed_count = 0
 
         with self.db.write_batch() as batch:
             for hashX in sorted(unflushed):
@@ -137,7 +154,6 @@ class History:
 
         count = len(unflushed)
         unflushed.clear()
-        self.unflushed_count = 0
 
         if self.db.for_sync:
             elapsed = time.time() - start_time
@@ -179,14 +195,15 @@ class History:
         transactions.  By default yields at most 1000 entries.  Set
         limit to None to get them all.  """
         limit = util.resolve_limit(limit)
-        for key, hist in self.db.iterator(prefix=hashX):
-            a = array.array('I')
-            a.frombytes(hist)
-            for tx_num in a:
-                if limit == 0:
-                    return
-                yield tx_num
-                limit -= 1
+        with self.db.snapshot() as snapshot:
+            for key, hist in snapshot.iterator(prefix=hashX):
+                a = array.array('I')
+                a.frombytes(hist)
+                for tx_num in a:
+                    if limit == 0:
+                        return
+                    yield tx_num
+                    limit -= 1
 
     #
     # History compaction
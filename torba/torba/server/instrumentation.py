@@ -0,0 +1,232 @@
+"""Instrumentation of the server's hot paths.
+
+Timings are recorded in log-bucketed histograms of a fixed size, so
+memory use doesn't grow with the number of observations, and exposed
+with counters and gauges in the Prometheus text format on a local HTTP
+endpoint (METRICS_HOST and METRICS_PORT) for scraping.
+
+Each process has one registry, INSTRUMENTS; session worker processes
+serve theirs on the ports following METRICS_PORT.
+"""
+
+import asyncio
+import time
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from aiohttp.web import Application, AppRunner, Response, TCPSite
+
+from torba.server.util import class_logger
+
+# Upper bounds of the histogram buckets in seconds, 50us to ~100s
+BUCKETS = tuple(0.00005 * 2 ** (n / 2) for n in range(43))
+
+
+def _label_string(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Histogram:
+    """A histogram of durations in seconds."""
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        # The last bucket counts observations past BUCKETS[-1]
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket of the given percentile,
+        e.g. 0.99.  Observations past the last bucket count as in it."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_label_string(labels + (("le", f"{bound:.6g}"),))} {cumulative}'
+        yield f'{name}_bucket{_label_string(labels + (("le", "+Inf"),))} {self.count}'
+        yield f'{name}_sum{_label_string(labels)} {self.sum:.6f}'
+        yield f'{name}_count{_label_string(labels)} {self.count}'
+
+
+class Counter:
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def lines(self, name, labels):
+        yield f'{name}{_label_string(labels)} {self.value}'
+
+
+class Gauge:
+    """A value read when scraped."""
+
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def lines(self, name, labels):
+        yield f'{name}{_label_string(labels)} {self.func()}'
+
+
+class CacheStats:
+    """Hit and miss counters of a cache."""
+
+    __slots__ = ('hits', 'misses')
+
+    def __init__(self, hits, misses):
+        self.hits = hits
+        self.misses = misses
+
+    def hit(self):
+        self.hits.inc()
+
+    def miss(self):
+        self.misses.inc()
+
+    def record(self, hit):
+        (self.hits if hit else self.misses).inc()
+
+
+class Instruments:
+    """A registry of metrics by name and labels."""
+
+    def __init__(self):
+        # name -> (type, help, {labels: metric})
+        self.metrics = {}
+
+    def _metric(self, kind, name, help, labels, factory):
+        metric_type, _, by_labels = self.metrics.setdefault(name, (kind, help, {}))
+        assert metric_type == kind
+        labels = tuple(sorted(labels.items()))
+        metric = by_labels.get(labels)
+        if metric is None:
+            metric = by_labels[labels] = factory()
+        return metric
+
+    def histogram(self, name, help, **labels):
+        return self._metric('histogram', name, help, labels, Histogram)
+
+    def counter(self, name, help, **labels):
+        return self._metric('counter', name, help, labels, Counter)
+
+    def gauge(self, name, help, func, **labels):
+        """Register func, called to read the gauge when scraped."""
+        gauge = self._metric('gauge', name, help, labels, lambda: Gauge(func))
+        gauge.func = func
+        return gauge
+
+    def cache(self, cache):
+        """Return the CacheStats of the named cache."""
+        help = 'Cache lookups by cache and result'
+        return CacheStats(self.counter('cache_lookups_total', help, cache=cache, result='hit'),
+                          self.counter('cache_lookups_total', help, cache=cache, result='miss'))
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        for name, (kind, help, by_labels) in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, metric in sorted(by_labels.items()):
+                try:
+                    lines.extend(metric.lines(name, labels))
+                except Exception:
+                    # A gauge of something that went away
+                    continue
+        lines.append('')
+        return '\n'.join(lines)
+
+
+INSTRUMENTS = Instruments()
+
+
+def executor_queue_depth(executor):
+    """Return the number of work items waiting for a worker of a thread or
+    process pool executor."""
+    if isinstance(executor, ThreadPoolExecutor):
+        return executor._work_queue.qsize()
+    if isinstance(executor, ProcessPoolExecutor):
+        return max(0, len(executor._pending_work_items) - executor._max_workers)
+    return 0
+
+
+async def monitor_loop_lag(interval=0.5):
+    """Record how late the event loop wakes up a sleeping task."""
+    loop = asyncio.get_event_loop()
+    histogram = INSTRUMENTS.histogram('loop_lag_seconds', 'Delay in running ready event loop callbacks')
+    last_lag = 0.0
+    INSTRUMENTS.gauge('loop_lag_last_seconds', 'The last event loop delay measured', lambda: last_lag)
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        last_lag = max(0.0, loop.time() - start - interval)
+        histogram.observe(last_lag)
+
+
+class timed:
+    """Context manager recording its duration in a histogram."""
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsServer:
+    """Serves the metrics of INSTRUMENTS at /metrics."""
+
+    def __init__(self, host, port, instruments=INSTRUMENTS):
+        self.host = host
+        self.port = port
+        self.instruments = instruments
+        self.logger = class_logger(__name__, self.__class__.__name__)
+        self.app = Application()
+        self.app.router.add_get('/metrics', self.on_metrics)
+        self.runner = AppRunner(self.app)
+        self.lag_task = None
+
+    async def on_metrics(self, request):
+        return Response(text=self.instruments.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        await self.runner.setup()
+        await TCPSite(self.runner, self.host, self.port).start()
+        self.lag_task = asyncio.ensure_future(monitor_loop_lag())
+        self.logger.info(f'metrics served on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+        await self.runner.cleanup()
@@ -11,8 +11,8 @@ import asyncio
 import itertools
 import time
 from abc import ABC, abstractmethod
-from asyncio import Lock, sleep
-from collections import defaultdict
+from asyncio import Event, Lock, sleep
+from collections import defaultdict, deque
 
 import attr
 
@@ -38,6 +38,16 @@ class MemPoolTxSummary:
     has_unconfirmed_inputs = attr.ib()
 
 
+@attr.s(slots=True)
+class MemPoolHashXSummary:
+    """What the mempool holds for a hashX, cached until a transaction
+    touching it enters or leaves the mempool."""
+    balance_delta = attr.ib()
+    tx_summaries = attr.ib()
+    utxos = attr.ib()
+    prevouts = attr.ib()
+
+
 class MemPoolAPI(ABC):
     """A concrete instance of this class is passed to the MemPool object
     and used by it to query DB and blockchain state."""
@@ -89,22 +99,53 @@ class MemPool:
     response to the calls in the external interface.  To that end we
     maintain the following maps:
 
-       tx:     tx_hash -> MemPoolTx
-       hashXs: hashX   -> set of all hashes of txs touching the hashX
+       tx:        tx_hash -> MemPoolTx
+       hashXs:    hashX   -> set of all hashes of txs touching the hashX
+       spenders:  tx_hash -> set of hashes of txs spending its outputs
+
+    These, the fee histogram and the per-hashX summaries are updated
+    as transactions enter and leave the mempool, so the work of a
+    refresh is proportional to the transactions that changed rather
+    than to the size of the mempool.
+
+    With a feed (see daemon.ZMQFeed) transactions are accepted as the
+    daemon pushes them, and the daemon's mempool is only polled every
+    feed_refresh_secs while the feed is connected, on new blocks and
+    when notifications were missed.
     """
 
-    def __init__(self, coin, api, refresh_secs=5.0, log_status_secs=120.0):
+    def __init__(self, coin, api, refresh_secs=5.0, log_status_secs=120.0,
+                 feed=None, feed_refresh_secs=60.0):
         assert isinstance(api, MemPoolAPI)
         self.coin = coin
         self.api = api
         self.logger = class_logger(__name__, self.__class__.__name__)
         self.txs = {}
         self.hashXs = defaultdict(set)  # None can be a key
+        self.spenders = defaultdict(set)
+        # fee rate -> total size of the txs paying it
+        self.fee_histogram = defaultdict(int)
         self.cached_compact_histogram = []
+        # hashX -> MemPoolHashXSummary, of hashXs queried since touched
+        self.summaries = {}
         self.refresh_secs = refresh_secs
         self.log_status_secs = log_status_secs
-        # Prevents mempool refreshes during fee histogram calculation
+        self.feed = feed
+        self.feed_refresh_secs = feed_refresh_secs
+        # Set to refresh before refresh_secs are up
+        self.refresh_event = Event()
+        # Hashes of txs pushed since the daemon's mempool was last polled
+        self.pushed_hashes = set()
+        # Set when the daemon publishes a block; the refresh it triggers
+        # drops the txs pushed while polling that the daemon no longer
+        # has, as the daemon also pushes the txs of its blocks
+        self.new_block = False
+        # Serializes refreshes and accepting pushed transactions
         self.lock = Lock()
+        # If a list, the (tx_hash, tx) pairs of the transactions added and
+        # (tx_hash, None) pairs of those removed, in order, are appended to
+        # it for apply_changes() of mempools kept by other processes
+        self.changes = None
 
     async def _logging(self, synchronized_event):
         """Print regular logs of mempool stats."""
@@ -123,18 +164,12 @@ class MemPool:
     async def _refresh_histogram(self, synchronized_event):
         while True:
             await synchronized_event.wait()
-            async with self.lock:
-                # Threaded as can be expensive
-                await asyncio.get_event_loop().run_in_executor(None, self._update_histogram, 100_000)
+            self._update_histogram(100_000)
             await sleep(self.coin.MEMPOOL_HISTOGRAM_REFRESH_SECS)
 
     def _update_histogram(self, bin_size):
-        # Build a histogram by fee rate
-        histogram = defaultdict(int)
-        for tx in self.txs.values():
-            histogram[tx.fee // tx.size] += tx.size
-
-        # Now compact it.  For efficiency, get_fees returns a
+        # The histogram by fee rate is kept up to date as txs enter
+        # and leave the mempool, compact it.  For efficiency, get_fees returns a
         # compact histogram with variable bin size.  The compact
         # histogram is an array of (fee_rate, vsize) values.
         # vsize_n is the cumulative virtual size of mempool
@@ -145,7 +180,7 @@ class MemPool:
         compact = []
         cum_size = 0
         r = 0   # ?
-        for fee_rate, size in sorted(histogram.items(), reverse=True):
+        for fee_rate, size in sorted(self.fee_histogram.items(), reverse=True):
             cum_size += size
             if cum_size + r > bin_size:
                 compact.append((fee_rate, cum_size))
@@ -157,18 +192,33 @@ class MemPool:
 
     def _accept_transactions(self, tx_map, utxo_map, touched):
         """Accept transactions in tx_map to the mempool if all their inputs
-        can be found in the existing mempool or a utxo_map from the
-        DB.
+        can be found in the existing mempool, tx_map or a utxo_map from
+        the DB.
+
+        Transactions are accepted in topological order: a transaction
+        spending outputs of others in tx_map is tried once they have
+        been accepted, so dependent transactions need a single pass.
 
         Returns an (unprocessed tx_map, unspent utxo_map) pair.
         """
-        hashXs = self.hashXs
         txs = self.txs
 
-        deferred = {}
-        unspent = set(utxo_map)
-        # Try to find all prevouts so we can accept the TX
+        # Count the parents in tx_map of each tx
+        children = defaultdict(list)
+        parent_counts = {}
         for hash, tx in tx_map.items():
+            parents = set(prev_hash for prev_hash, prev_index in tx.prevouts
+                          if prev_hash in tx_map)
+            parent_counts[hash] = len(parents)
+            for parent in parents:
+                children[parent].append(hash)
+        ready = deque(hash for hash, count in parent_counts.items() if not count)
+
+        unspent = set(utxo_map)
+        while ready:
+            hash = ready.popleft()
+            tx = tx_map[hash]
+            # Try to find all prevouts so we can accept the TX
             in_pairs = []
             try:
                 for prevout in tx.prevouts:
@@ -179,7 +229,7 @@ class MemPool:
                         utxo = txs[prev_hash].out_pairs[prev_index]
                     in_pairs.append(utxo)
             except KeyError:
-                deferred[hash] = tx
+                # Its descendants are never ready either
                 continue
 
             # Spend the prevouts
@@ -191,45 +241,198 @@ class MemPool:
             # because some in_parts would be missing
             tx.fee = max(0, (sum(v for _, v in tx.in_pairs) -
                              sum(v for _, v in tx.out_pairs)))
-            txs[hash] = tx
+            self._add_transaction(hash, tx, touched)
 
-            for hashX, value in itertools.chain(tx.in_pairs, tx.out_pairs):
-                touched.add(hashX)
-                hashXs[hashX].add(hash)
+            for child in children.pop(hash, ()):
+                parent_counts[child] -= 1
+                if not parent_counts[child]:
+                    ready.append(child)
 
+        deferred = {hash: tx for hash, tx in tx_map.items() if hash not in txs}
         return deferred, {prevout: utxo_map[prevout] for prevout in unspent}
 
+    def _add_transaction(self, tx_hash, tx, touched):
+        """Add an accepted transaction, its in_pairs and fee are set."""
+        txs = self.txs
+        txs[tx_hash] = tx
+        self.fee_histogram[tx.fee // tx.size] += tx.size
+        for prev_hash, prev_index in tx.prevouts:
+            if prev_hash in txs:
+                self.spenders[prev_hash].add(tx_hash)
+
+        for hashX, value in itertools.chain(tx.in_pairs, tx.out_pairs):
+            touched.add(hashX)
+            self.hashXs[hashX].add(tx_hash)
+            self.summaries.pop(hashX, None)
+        if self.changes is not None:
+            self.changes.append((tx_hash, tx))
+
+    def _remove_transaction(self, tx_hash, touched):
+        """Remove a transaction that left the daemon's mempool."""
+        hashXs = self.hashXs
+        tx = self.txs.pop(tx_hash)
+        if self.changes is not None:
+            self.changes.append((tx_hash, None))
+        fee_rate = tx.fee // tx.size
+        self.fee_histogram[fee_rate] -= tx.size
+        if not self.fee_histogram[fee_rate]:
+            del self.fee_histogram[fee_rate]
+
+        tx_hashXs = set(hashX for hashX, value in tx.in_pairs)
+        tx_hashXs.update(hashX for hashX, value in tx.out_pairs)
+        # The inputs of txs spending it are no longer unconfirmed
+        for child in self.spenders.pop(tx_hash, ()):
+            child_tx = self.txs.get(child)
+            if child_tx:
+                tx_hashXs.update(hashX for hashX, value in child_tx.in_pairs)
+                tx_hashXs.update(hashX for hashX, value in child_tx.out_pairs)
+        for prev_hash, prev_index in tx.prevouts:
+            spenders = self.spenders.get(prev_hash)
+            if spenders is not None:
+                spenders.discard(tx_hash)
+                if not spenders:
+                    del self.spenders[prev_hash]
+
+        for hashX in tx_hashXs:
+            self.summaries.pop(hashX, None)
+            tx_hashes = hashXs.get(hashX)
+            if tx_hashes is not None:
+                tx_hashes.discard(tx_hash)
+                if not tx_hashes:
+                    del hashXs[hashX]
+        touched.update(tx_hashXs)
+
+    def _summary(self, hashX):
+        """Return the MemPoolHashXSummary of a hashX."""
+        summary = self.summaries.get(hashX)
+        if summary is not None:
+            return summary
+        delta = 0
+        tx_summaries = []
+        utxos = []
+        prevouts = set()
+        for tx_hash in self.hashXs.get(hashX, ()):
+            tx = self.txs[tx_hash]
+            delta -= sum(v for h168, v in tx.in_pairs if h168 == hashX)
+            delta += sum(v for h168, v in tx.out_pairs if h168 == hashX)
+            has_ui = any(hash in self.txs for hash, idx in tx.prevouts)
+            tx_summaries.append(MemPoolTxSummary(tx_hash, tx.fee, has_ui))
+            for pos, (hX, value) in enumerate(tx.out_pairs):
+                if hX == hashX:
+                    utxos.append(UTXO(-1, pos, tx_hash, 0, value))
+            prevouts.update(tx.prevouts)
+        summary = MemPoolHashXSummary(delta, tx_summaries, utxos, prevouts)
+        if hashX in self.hashXs:
+            self.summaries[hashX] = summary
+        return summary
+
+    def _refresh_interval(self):
+        if self.feed is not None and self.feed.connected:
+            return self.feed_refresh_secs
+        return self.refresh_secs
+
     async def _refresh_hashes(self, synchronized_event):
         """Refresh our view of the daemon's mempool."""
         while True:
+            self.refresh_event.clear()
             height = self.api.cached_height()
+            new_block, self.new_block = self.new_block, False
+            self.pushed_hashes.clear()
             hex_hashes = await self.api.mempool_hashes()
             if height != await self.api.height():
                 continue
             hashes = set(hex_str_to_hash(hh) for hh in hex_hashes)
             async with self.lock:
-                touched = await self._process_mempool(hashes)
+                touched = await self._process_mempool(hashes, new_block)
             synchronized_event.set()
             synchronized_event.clear()
             await self.api.on_mempool(touched, height)
-            await sleep(self.refresh_secs)
+            try:
+                await asyncio.wait_for(self.refresh_event.wait(), self._refresh_interval())
+            except asyncio.TimeoutError:
+                pass
+
+    async def _read_feed(self, queue):
+        async for message in self.feed.messages():
+            queue.put_nowait(message)
+
+    async def _process_feed(self, queue):
+        """Accept the transactions pushed by the daemon, a batch of those
+        that arrived while the previous batch was being accepted at a
+        time.  New blocks and missed notifications trigger a refresh,
+        once the txs pushed before them are accepted."""
+        while True:
+            raw_txs = []
+            refresh = False
+            message = await queue.get()
+            while True:
+                topic, body = message
+                if topic == b'rawtx':
+                    raw_txs.append(body)
+                else:
+                    refresh = True
+                    if topic == b'hashblock':
+                        self.new_block = True
+                if queue.empty():
+                    break
+                message = queue.get_nowait()
+            if raw_txs:
+                height = self.api.cached_height()
+                async with self.lock:
+                    touched = await self._accept_pushed(raw_txs)
+                await self.api.on_mempool(touched, height)
+            if refresh:
+                self.refresh_event.set()
+
+    async def _accept_pushed(self, raw_txs):
+        """Accept transactions pushed by the daemon.  Ones spending
+        outputs we don't know of are left for the next refresh.  The
+        coinbase txs of blocks, which are pushed too, are ignored."""
+        txs = self.txs
+        touched = set()
 
-    async def _process_mempool(self, all_hashes):
+        def deserialize_txs():    # This function is pure
+            to_hashX = self.coin.hashX_from_script
+            deserializer = self.coin.DESERIALIZER
+
+            tx_map = {}
+            for raw_tx in raw_txs:
+                tx, tx_hash = deserializer(raw_tx).read_tx_and_hash()
+                if tx_hash in txs or all(txin.is_generation() for txin in tx.inputs):
+                    continue
+                tx_size = deserializer(raw_tx).read_tx_and_vsize()[1]
+                txin_pairs = tuple((txin.prev_hash, txin.prev_idx)
+                                   for txin in tx.inputs
+                                   if not txin.is_generation())
+                txout_pairs = tuple((to_hashX(txout.pk_script), txout.value)
+                                    for txout in tx.outputs)
+                tx_map[tx_hash] = MemPoolTx(txin_pairs, None, txout_pairs,
+                                            0, tx_size)
+            return tx_map
+
+        tx_map = await asyncio.get_event_loop().run_in_executor(None, deserialize_txs)
+        prevouts = tuple(prevout for tx in tx_map.values()
+                         for prevout in tx.prevouts
+                         if prevout[0] not in txs and prevout[0] not in tx_map)
+        utxos = await self.api.lookup_utxos(prevouts)
+        utxo_map = {prevout: utxo for prevout, utxo in zip(prevouts, utxos)}
+        deferred, unspent = self._accept_transactions(tx_map, utxo_map, touched)
+        self.pushed_hashes.update(hash for hash in tx_map if hash not in deferred)
+        if deferred:
+            self.logger.info(f'{len(deferred)} pushed txs deferred to the next refresh')
+        return touched
+
+    async def _process_mempool(self, all_hashes, new_block=False):
         # Re-sync with the new set of hashes
         txs = self.txs
-        hashXs = self.hashXs
         touched = set()
 
-        # First handle txs that have disappeared
-        for tx_hash in set(txs).difference(all_hashes):
-            tx = txs.pop(tx_hash)
-            tx_hashXs = set(hashX for hashX, value in tx.in_pairs)
-            tx_hashXs.update(hashX for hashX, value in tx.out_pairs)
-            for hashX in tx_hashXs:
-                hashXs[hashX].remove(tx_hash)
-                if not hashXs[hashX]:
-                    del hashXs[hashX]
-            touched.update(tx_hashXs)
+        # First handle txs that have disappeared.  Those pushed after
+        # all_hashes was fetched are kept until the next refresh, unless
+        # a new block came in: then they are likely in it.
+        kept = () if new_block else self.pushed_hashes
+        for tx_hash in set(txs).difference(all_hashes, kept):
+            self._remove_transaction(tx_hash, touched)
 
         # Process new transactions
         new_hashes = list(all_hashes.difference(txs))
@@ -244,12 +447,8 @@ class MemPool:
                 tx_map.update(deferred)
                 utxo_map.update(unspent)
 
-            prior_count = 0
-            # FIXME: this is not particularly efficient
-            while tx_map and len(tx_map) != prior_count:
-                prior_count = len(tx_map)
-                tx_map, utxo_map = self._accept_transactions(tx_map, utxo_map,
-                                                             touched)
+            # Txs deferred in one fetch may spend outputs of txs in another
+            tx_map, utxo_map = self._accept_transactions(tx_map, utxo_map, touched)
             if tx_map:
                 self.logger.info(f'{len(tx_map)} txs dropped')
 
@@ -304,10 +503,53 @@ class MemPool:
 
     async def keep_synchronized(self, synchronized_event):
         """Keep the mempool synchronized with the daemon."""
-        await asyncio.wait([
+        tasks = [
             self._refresh_hashes(synchronized_event),
             self._refresh_histogram(synchronized_event),
             self._logging(synchronized_event)
+        ]
+        if self.feed is not None:
+            queue = asyncio.Queue()
+            tasks.append(self._read_feed(queue))
+            tasks.append(self._process_feed(queue))
+        await asyncio.wait(tasks)
+
+    def snapshot(self):
+        """Return the changes that bring an empty mempool to this one, see
+        apply_changes().  Parents come before the transactions spending
+        them as that is the order they were added in."""
+        return list(self.txs.items())
+
+    def apply_changes(self, changes):
+        """Apply changes of a mempool synchronized by another process,
+        return the touched hashXs.  Changes already applied, as by a
+        snapshot taken after them, are skipped."""
+        touched = set()
+        for tx_hash, tx in changes:
+            if tx is None:
+                if tx_hash in self.txs:
+                    self._remove_transaction(tx_hash, touched)
+            elif tx_hash not in self.txs:
+                self._add_transaction(tx_hash, tx, touched)
+        return touched
+
+    async def keep_following(self, changes_queue, synchronized_event):
+        """Keep the mempool synchronized with that of another process
+        instead of the daemon.  (height, changes) pairs of it are put in
+        changes_queue."""
+
+        async def apply():
+            while True:
+                height, changes = await changes_queue.get()
+                touched = self.apply_changes(changes)
+                synchronized_event.set()
+                synchronized_event.clear()
+                await self.api.on_mempool(touched, height)
+
+        await asyncio.wait([
+            apply(),
+            self._refresh_histogram(synchronized_event),
+            self._logging(synchronized_event)
         ])
 
     async def balance_delta(self, hashX):
@@ -315,13 +557,7 @@ class MemPool:
 
         Can be positive or negative.
         """
-        value = 0
-        if hashX in self.hashXs:
-            for hash in self.hashXs[hashX]:
-                tx = self.txs[hash]
-                value -= sum(v for h168, v in tx.in_pairs if h168 == hashX)
-                value += sum(v for h168, v in tx.out_pairs if h168 == hashX)
-        return value
+        return self._summary(hashX).balance_delta
 
     async def compact_fee_histogram(self):
         """Return a compact fee histogram of the current mempool."""
@@ -334,20 +570,11 @@ class MemPool:
         None, some or all of these may be spends of the hashX, but all
         actual spends of it (in the DB or mempool) will be included.
         """
-        result = set()
-        for tx_hash in self.hashXs.get(hashX, ()):
-            tx = self.txs[tx_hash]
-            result.update(tx.prevouts)
-        return result
+        return set(self._summary(hashX).prevouts)
 
     async def transaction_summaries(self, hashX):
         """Return a list of MemPoolTxSummary objects for the hashX."""
-        result = []
-        for tx_hash in self.hashXs.get(hashX, ()):
-            tx = self.txs[tx_hash]
-            has_ui = any(hash in self.txs for hash, idx in tx.prevouts)
-            result.append(MemPoolTxSummary(tx_hash, tx.fee, has_ui))
-        return result
+        return list(self._summary(hashX).tx_summaries)
 
     async def unordered_UTXOs(self, hashX):
         """Return an unordered list of UTXO named tuples from mempool
@@ -356,10 +583,4 @@ class MemPool:
         This does not consider if any other mempool transactions spend
         the outputs.
         """
-        utxos = []
-        for tx_hash in self.hashXs.get(hashX, ()):
-            tx = self.txs.get(tx_hash)
-            for pos, (hX, value) in enumerate(tx.out_pairs):
-                if hX == hashX:
-                    utxos.append(UTXO(-1, pos, tx_hash, 0, value))
-        return utxos
+        return list(self._summary(hashX).utxos)
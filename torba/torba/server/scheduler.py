@@ -0,0 +1,140 @@
+"""Scheduling of session requests by cost class.
+
+Requests are classified by what serving them costs, and each class
+has its own bounded number of requests served at a time, shared by
+all the sessions of a server.  A session flooding the server with
+requests of one class only queues behind its own requests of that
+class, so cheap requests of other sessions - and its own - are still
+served promptly.
+
+Queued requests of a class are served in weighted round robin order
+across sessions: each session in turn has up to its request_weight
+requests served before the next session's.
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+
+# Served from memory
+CHEAP = 'cheap'
+# Read from the DBs, mostly in the executor
+DISK = 'disk'
+# Forwarded to the daemon
+DAEMON = 'daemon'
+# Run in the query executor
+QUERY = 'query'
+
+
+class RequestClass:
+    """Requests of a cost class, max_concurrent of which are served at
+    a time."""
+
+    def __init__(self, name, max_concurrent):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        # session -> deque of futures of its queued requests
+        self.queues = OrderedDict()
+        # Requests left to serve of the session at the front
+        self.credit = 0
+        self.served = 0
+        self.waited = 0
+
+    def queued(self):
+        return sum(not waiter.done() for waiters in self.queues.values()
+                   for waiter in waiters)
+
+    async def acquire(self, session):
+        if self.active < self.max_concurrent and not self.queues:
+            self.active += 1
+            self.served += 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.queues.setdefault(session, deque()).append(waiter)
+        self.waited += 1
+        # Earlier waiters may all have been cancelled
+        self._grant()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted and cancelled before running
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        self._grant()
+
+    def _grant(self):
+        queues = self.queues
+        while self.active < self.max_concurrent and queues:
+            session, waiters = next(iter(queues.items()))
+            if self.credit <= 0:
+                self.credit = getattr(session, 'request_weight', 1)
+            waiter = waiters.popleft()
+            if waiter.done():
+                # Cancelled while queued
+                if not waiters:
+                    del queues[session]
+                    self.credit = 0
+                continue
+            self.credit -= 1
+            if not waiters:
+                del queues[session]
+                self.credit = 0
+            elif not self.credit:
+                queues.move_to_end(session)
+            self.active += 1
+            self.served += 1
+            waiter.set_result(None)
+
+
+class RequestSlot:
+    """A request of a session served in a RequestClass, usable with
+    Semaphores."""
+
+    __slots__ = ('request_class', 'session')
+
+    def __init__(self, request_class, session):
+        self.request_class = request_class
+        self.session = session
+
+    async def acquire(self):
+        await self.request_class.acquire(self.session)
+
+    def release(self):
+        self.request_class.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class RequestScheduler:
+    """The request classes of a server.
+
+    limits - a map of cost class names to their max_concurrent
+    """
+
+    def __init__(self, limits):
+        self.classes = {name: RequestClass(name, max_concurrent)
+                        for name, max_concurrent in limits.items()}
+
+    def slot(self, session, cost_class):
+        """Return a RequestSlot for a request of the session."""
+        return RequestSlot(self.classes[cost_class], session)
+
+    def info(self):
+        return {
+            name: {
+                'active': request_class.active,
+                'queued': request_class.queued(),
+                'max': request_class.max_concurrent,
+                'served': request_class.served,
+                'waited': request_class.waited,
+            }
+            for name, request_class in self.classes.items()
+        }
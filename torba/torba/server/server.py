@@ -2,8 +2,11 @@ import signal
 import logging
 import asyncio
 from concurrent.futures.thread import ThreadPoolExecutor
+from functools import partial
 
 import torba
+from torba.server.daemon import ZMQFeed
+from torba.server.instrumentation import INSTRUMENTS, MetricsServer, executor_queue_depth
 from torba.server.mempool import MemPool, MemPoolAPI
 
 
@@ -53,7 +56,8 @@ class Notifications:
         await self.notify(height, set())
 
     async def on_mempool(self, touched, height):
-        self._touched_mp[height] = touched
+        # Pushed transactions can arrive several times per block
+        self._touched_mp.setdefault(height, set()).update(touched)
         await self._maybe_notify()
 
     async def on_block(self, touched, height):
@@ -69,11 +73,13 @@ class Server:
         self.log = logging.getLogger(__name__).getChild(self.__class__.__name__)
         self.shutdown_event = asyncio.Event()
         self.cancellable_tasks = []
+        self.session_workers = []
+        self.metrics_server = None
 
-        self.notifications = notifications = Notifications()
+        self.notifications = notifications = self.create_notifications()
         self.daemon = daemon = env.coin.DAEMON(env.coin, env.daemon_url)
         self.db = db = env.coin.DB(env)
-        self.bp = bp = env.coin.BLOCK_PROCESSOR(env, db, daemon, notifications)
+        self.bp = bp = self.create_block_processor()
 
         # Set notifications up to implement the MemPoolAPI
         notifications.height = daemon.height
@@ -82,12 +88,32 @@ class Server:
         notifications.raw_transactions = daemon.getrawtransactions
         notifications.lookup_utxos = db.lookup_utxos
         MemPoolAPI.register(Notifications)
-        self.mempool = mempool = MemPool(env.coin, notifications)
+        feed = ZMQFeed(env.daemon_zmq_url) if env.daemon_zmq_url else None
+        self.mempool = mempool = MemPool(env.coin, notifications, feed=feed)
 
         self.session_mgr = env.coin.SESSION_MANAGER(
             env, db, bp, daemon, mempool, self.shutdown_event
         )
 
+    def create_notifications(self):
+        if self.env.session_workers:
+            from torba.server.workers import BroadcastingNotifications
+            return BroadcastingNotifications(self.env)
+        return Notifications()
+
+    def create_block_processor(self):
+        return self.env.coin.BLOCK_PROCESSOR(self.env, self.db, self.daemon, self.notifications)
+
+    async def start_metrics_server(self):
+        if self.env.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.env.metrics_host, self.env.metrics_port)
+            await self.metrics_server.start()
+
+    def start_cancellable(self, run, *args):
+        _flag = asyncio.Event()
+        self.cancellable_tasks.append(asyncio.ensure_future(run(*args, _flag)))
+        return _flag.wait()
+
     async def start(self):
         env = self.env
         min_str, max_str = env.coin.SESSIONCLS.protocol_min_max_strings()
@@ -96,17 +122,18 @@ class Server:
         self.log.info(f'event loop policy: {env.loop_policy}')
         self.log.info(f'reorg limit is {env.reorg_limit:,d} blocks')
 
+        await self.start_metrics_server()
         await self.daemon.height()
 
-        def _start_cancellable(run, *args):
-            _flag = asyncio.Event()
-            self.cancellable_tasks.append(asyncio.ensure_future(run(*args, _flag)))
-            return _flag.wait()
-
-        await _start_cancellable(self.bp.fetch_and_process_blocks)
+        await self.start_cancellable(self.bp.fetch_and_process_blocks)
         await self.db.populate_header_merkle_cache()
-        await _start_cancellable(self.mempool.keep_synchronized)
-        await _start_cancellable(self.session_mgr.serve, self.notifications)
+        if env.session_workers:
+            from torba.server.workers import start_session_workers
+            self.log.info(f'starting {env.session_workers:,d} session workers')
+            await self.notifications.broadcaster.start(self.mempool, self.session_mgr.peer_mgr)
+            self.session_workers = start_session_workers(env)
+        await self.start_cancellable(self.mempool.keep_synchronized)
+        await self.start_cancellable(self.session_mgr.serve, self.notifications)
 
     async def stop(self):
         for task in reversed(self.cancellable_tasks):
@@ -114,11 +141,22 @@ class Server:
         await asyncio.wait(self.cancellable_tasks)
         self.shutdown_event.set()
         await self.daemon.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        if self.session_workers:
+            from torba.server.workers import stop_session_workers
+            # Closing the socket tells the workers to shut down
+            await self.notifications.broadcaster.stop()
+            await asyncio.get_event_loop().run_in_executor(
+                None, stop_session_workers, self.session_workers
+            )
 
     def run(self):
         loop = asyncio.get_event_loop()
         executor = ThreadPoolExecutor(1)
         loop.set_default_executor(executor)
+        INSTRUMENTS.gauge('executor_queue_depth', 'Work items waiting for an executor worker',
+                          partial(executor_queue_depth, executor), executor='default')
 
         def __exit():
             raise SystemExit()
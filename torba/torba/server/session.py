@@ -17,21 +17,25 @@ import pylru
 import ssl
 import time
 import typing
-from asyncio import Event, sleep
+import zlib
+from asyncio import Event, Lock, sleep
 from collections import defaultdict
 from functools import partial
 
 import torba
 from torba.rpc import (
     RPCSession, JSONRPCAutoDetect, JSONRPCConnection,
-    handler_invocation, RPCError, Request
+    handler_invocation, RPCError, Request, EncodedResult
 )
+from torba.server import scheduler
 from torba.server import text
 from torba.server import util
 from torba.server.hash import (sha256, hash_to_hex_str, hex_str_to_hash,
                                 HASHX_LEN, Base58Error)
 from torba.server.daemon import DaemonError
+from torba.server.instrumentation import INSTRUMENTS, timed
 from torba.server.peers import PeerManager
+from torba.server.scheduler import RequestScheduler
 if typing.TYPE_CHECKING:
     from torba.server.env import Env
     from torba.server.db import DB
@@ -92,9 +96,13 @@ class Semaphores:
         self.acquired = []
 
     async def __aenter__(self):
-        for semaphore in self.semaphores:
-            await semaphore.acquire()
-            self.acquired.append(semaphore)
+        try:
+            for semaphore in self.semaphores:
+                await semaphore.acquire()
+                self.acquired.append(semaphore)
+        except BaseException:
+            await self.__aexit__(None, None, None)
+            raise
 
     async def __aexit__(self, exc_type, exc_value, traceback):
         for semaphore in self.acquired:
@@ -112,6 +120,9 @@ class SessionGroup:
 class SessionManager:
     """Holds global state about all sessions."""
 
+    # Headers in each compressed chunk
+    COMPRESSED_CHUNK_SIZE = 2016
+
     def __init__(self, env: 'Env', db: 'DB', bp: 'BlockProcessor', daemon: 'Daemon', mempool: 'MemPool',
                  shutdown_event: asyncio.Event):
         env.max_send = max(350000, env.max_send)
@@ -130,6 +141,22 @@ class SessionManager:
         self.txs_sent = 0
         self.start_time = time.time()
         self.history_cache = pylru.lrucache(256)
+        # Encoded header chunks that can no longer be reorged
+        self.headers_cache = pylru.lrucache(100)
+        # Compressed chunks by index, enough for all of a long chain
+        self.compressed_chunk_cache = pylru.lrucache(1000)
+        self.compressed_chunk_hashes: typing.List[str] = []
+        self.compressed_chunk_hashes_result = None
+        self.compressed_chunk_hashes_lock = Lock()
+        self.history_cache_stats = INSTRUMENTS.cache('history')
+        self.headers_cache_stats = INSTRUMENTS.cache('headers')
+        self.compressed_chunk_cache_stats = INSTRUMENTS.cache('compressed_chunk')
+        self.request_scheduler = RequestScheduler({
+            scheduler.CHEAP: env.cheap_concurrency,
+            scheduler.DISK: env.disk_concurrency,
+            scheduler.DAEMON: env.daemon_concurrency,
+            scheduler.QUERY: env.query_concurrency,
+        })
         self.notified_height: typing.Optional[int] = None
         # Cache some idea of room to avoid recounting on each subscription
         self.subs_room = 0
@@ -170,13 +197,19 @@ class SessionManager:
         port was given in the environment.
         """
         env = self.env
+        if env.session_workers and self.bp is not None:
+            # Sessions are served by the session worker processes
+            return
         host = env.cs_host(for_rpc=False)
+        # Session workers share the ports and the kernel balances
+        # connections between them
+        reuse_port = bool(env.session_workers) or None
         if env.tcp_port is not None:
-            await self._start_server('TCP', host, env.tcp_port)
+            await self._start_server('TCP', host, env.tcp_port, reuse_port=reuse_port)
         if env.ssl_port is not None:
             sslc = ssl.SSLContext(ssl.PROTOCOL_TLS)
             sslc.load_cert_chain(env.ssl_certfile, keyfile=env.ssl_keyfile)
-            await self._start_server('SSL', host, env.ssl_port, ssl=sslc)
+            await self._start_server('SSL', host, env.ssl_port, ssl=sslc, reuse_port=reuse_port)
 
     async def _close_servers(self, kinds):
         """Close the servers of the given kinds (TCP etc.)."""
@@ -316,11 +349,13 @@ class SessionManager:
             'pid': os.getpid(),
             'peers': self.peer_mgr.info(),
             'requests': pending_requests,
+            'request_classes': self.request_scheduler.info(),
             'method_counts': method_counts,
             'sessions': self.session_count(),
             'subs': self._sub_count(),
             'txs_sent': self.txs_sent,
             'uptime': util.formatted_time(time.time() - self.start_time),
+            'utxo_filter': self.db.utxo_filter_info(),
             'version': torba.__version__,
         }
 
@@ -371,7 +406,8 @@ class SessionManager:
         # Paranoia: a reorg could race and leave db_height lower
         height = min(height, self.db.db_height)
         electrum, raw = await self._electrum_and_raw_headers(height)
-        self.hsub_results = (electrum, {'hex': raw.hex(), 'height': height})
+        self.hsub_results = (EncodedResult(electrum),
+                             EncodedResult({'hex': raw.hex(), 'height': height}))
         self.notified_height = height
 
     # --- LocalRPC command handlers
@@ -581,6 +617,7 @@ class SessionManager:
     async def limited_history(self, hashX):
         """A caching layer."""
         hc = self.history_cache
+        self.history_cache_stats.record(hashX in hc)
         if hashX not in hc:
             # History DoS limit.  Each element of history is about 99
             # bytes when encoded as JSON.  This limits resource usage
@@ -590,6 +627,52 @@ class SessionManager:
             hc[hashX] = await self.db.limited_history(hashX, limit=limit)
         return hc[hashX]
 
+    async def encoded_headers(self, kind, start_height, count, to_result):
+        """Return to_result(headers, count) for up to count headers from
+        start_height as an EncodedResult.  Results for headers past the
+        reorg limit are cached by kind, start_height and count."""
+        key = (kind, start_height, count)
+        result = self.headers_cache.get(key)
+        self.headers_cache_stats.record(result is not None)
+        if result is None:
+            headers, count = await self.db.read_headers(start_height, count)
+            result = EncodedResult(to_result(headers, count))
+            if start_height + count <= self.db.db_height - self.env.reorg_limit:
+                self.headers_cache[key] = result
+        return result
+
+    def compressed_chunk_count(self):
+        """The number of compressed chunks, those of headers past the reorg
+        limit, which never change."""
+        return max(0, self.db.db_height - self.env.reorg_limit) // self.COMPRESSED_CHUNK_SIZE
+
+    async def encoded_compressed_chunk_hashes(self):
+        """Return an EncodedResult of the size of compressed chunks and
+        the hash of the last header of each.  As it commits to all the
+        headers before it that hash identifies a chunk."""
+        size = self.COMPRESSED_CHUNK_SIZE
+        count = self.compressed_chunk_count()
+        hashes = self.compressed_chunk_hashes
+        async with self.compressed_chunk_hashes_lock:
+            if len(hashes) < count or self.compressed_chunk_hashes_result is None:
+                for index in range(len(hashes), count):
+                    header = await self.db.raw_header((index + 1) * size - 1)
+                    hashes.append(hash_to_hex_str(self.env.coin.header_hash(header)))
+                self.compressed_chunk_hashes_result = EncodedResult({'size': size, 'hashes': hashes[:count]})
+        return self.compressed_chunk_hashes_result
+
+    async def encoded_compressed_chunk(self, index):
+        """Return an EncodedResult of the zlib compressed headers of a
+        chunk.  Requires index < compressed_chunk_count()."""
+        result = self.compressed_chunk_cache.get(index)
+        self.compressed_chunk_cache_stats.record(result is not None)
+        if result is None:
+            size = self.COMPRESSED_CHUNK_SIZE
+            headers, _ = await self.db.read_headers(index * size, size)
+            compressed = await asyncio.get_event_loop().run_in_executor(None, zlib.compress, headers)
+            result = self.compressed_chunk_cache[index] = EncodedResult(compressed)
+        return result
+
     async def _notify_sessions(self, height, touched):
         """Notify sessions about height changes and touched addresses."""
         height_changed = height != self.notified_height
@@ -635,8 +718,28 @@ class SessionBase(RPCSession):
     """
 
     MAX_CHUNK_SIZE = 2016
+    MAX_FILTERS = 1000
     session_counter = itertools.count()
     request_handlers: typing.Dict[str, typing.Callable] = {}
+    # Cost classes of request methods, scheduler.DISK if not listed
+    request_classes: typing.Dict[str, str] = {
+        'blockchain.estimatefee': scheduler.DAEMON,
+        'blockchain.headers.subscribe': scheduler.CHEAP,
+        'blockchain.relayfee': scheduler.DAEMON,
+        'blockchain.transaction.broadcast': scheduler.DAEMON,
+        'blockchain.transaction.get': scheduler.DAEMON,
+        'blockchain.transaction.get_merkle': scheduler.DAEMON,
+        'mempool.get_fee_histogram': scheduler.CHEAP,
+        'server.add_peer': scheduler.CHEAP,
+        'server.banner': scheduler.CHEAP,
+        'server.donation_address': scheduler.CHEAP,
+        'server.features': scheduler.CHEAP,
+        'server.peers.subscribe': scheduler.CHEAP,
+        'server.ping': scheduler.CHEAP,
+        'server.version': scheduler.CHEAP,
+    }
+    # Share of queued requests served in turn with other sessions
+    request_weight = 1
 
     def __init__(self, session_mgr, db, mempool, peer_mgr, kind):
         connection = JSONRPCConnection(JSONRPCAutoDetect)
@@ -719,6 +822,16 @@ class SessionBase(RPCSession):
     def semaphore(self):
         return Semaphores([self._concurrency.semaphore, self.group.semaphore])
 
+    def _request_semaphore(self, request):
+        """Serve requests in the request scheduler slots of their cost
+        class.  Cheap requests aren't held back by the session's own
+        concurrency limit."""
+        cost_class = self.request_classes.get(getattr(request, 'method', None), scheduler.DISK)
+        slot = self.session_mgr.request_scheduler.slot(self, cost_class)
+        if cost_class == scheduler.CHEAP:
+            return slot
+        return Semaphores([self._concurrency.semaphore, slot])
+
     def sub_count(self):
         return 0
 
@@ -731,7 +844,13 @@ class SessionBase(RPCSession):
         else:
             handler = None
         coro = handler_invocation(handler, request)()
-        return await coro
+        if handler is None:
+            return await coro
+        # Only known methods, clients choose the names
+        histogram = INSTRUMENTS.histogram('request_seconds', 'Latency of session requests by method',
+                                          method=request.method)
+        with timed(histogram):
+            return await coro
 
 
 class ElectrumX(SessionBase):
@@ -739,6 +858,8 @@ class ElectrumX(SessionBase):
 
     PROTOCOL_MIN = (1, 1)
     PROTOCOL_MAX = (1, 4)
+    # Clients can switch their connection to the binary protocol
+    allow_binary = True
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1037,6 +1158,11 @@ class ElectrumX(SessionBase):
 
         max_size = self.MAX_CHUNK_SIZE
         count = min(count, max_size)
+        if not cp_height:
+            return await self.session_mgr.encoded_headers(
+                'headers', start_height, count,
+                lambda headers, count: {'hex': headers.hex(), 'count': count, 'max': max_size}
+            )
         headers, count = await self.db.read_headers(start_height, count)
         result = {'hex': headers.hex(), 'count': count, 'max': max_size}
         if count and cp_height:
@@ -1054,8 +1180,52 @@ class ElectrumX(SessionBase):
         index = non_negative_integer(index)
         size = self.coin.CHUNK_SIZE
         start_height = index * size
-        headers, _ = await self.db.read_headers(start_height, size)
-        return headers.hex()
+        return await self.session_mgr.encoded_headers(
+            'chunk', start_height, size, lambda headers, count: headers.hex()
+        )
+
+    async def block_compressed_chunk_hashes(self):
+        """Return the number of headers in each compressed chunk and the
+        hashes of the last header of each chunk, as hexadecimal
+        strings.  Only headers past the reorg limit are in chunks."""
+        return await self.session_mgr.encoded_compressed_chunk_hashes()
+
+    async def block_compressed_chunk(self, index):
+        """Return the zlib compressed binary headers of a chunk, as bytes
+        over the binary protocol and base64 encoded otherwise.
+
+        index: the chunk index"""
+        index = non_negative_integer(index)
+        if index >= self.session_mgr.compressed_chunk_count():
+            raise RPCError(BAD_REQUEST, f'no compressed chunk {index:,d}')
+        return await self.session_mgr.encoded_compressed_chunk(index)
+
+    async def block_filter_headers(self, start_height, count):
+        """Return count concatenated block filter headers as hex starting
+        at start_height.  Fewer are returned past the chain tip or if
+        the server doesn't have the filters.
+
+        start_height and count must be non-negative integers.  At most
+        MAX_CHUNK_SIZE headers will be returned.
+        """
+        start_height = non_negative_integer(start_height)
+        count = min(non_negative_integer(count), self.MAX_CHUNK_SIZE)
+        filters = await self.db.read_filters(start_height, count)
+        headers = b''.join(header for header, _ in filters)
+        return {'hex': headers.hex(), 'count': len(filters), 'max': self.MAX_CHUNK_SIZE}
+
+    async def block_filters(self, start_height, count):
+        """Return a list of the hex block filters of count blocks starting
+        at start_height.  Fewer are returned past the chain tip or if
+        the server doesn't have the filters.
+
+        start_height and count must be non-negative integers.  At most
+        MAX_FILTERS filters will be returned.
+        """
+        start_height = non_negative_integer(start_height)
+        count = min(non_negative_integer(count), self.MAX_FILTERS)
+        filters = await self.db.read_filters(start_height, count)
+        return [block_filter.hex() for _, block_filter in filters]
 
     async def block_get_header(self, height):
         """The deserialized header at a given height.
@@ -1288,6 +1458,11 @@ class ElectrumX(SessionBase):
                 'mempool.get_fee_histogram':
                 self.mempool.compact_fee_histogram,
                 'blockchain.block.headers': self.block_headers_12,
+                'blockchain.block.compressed_chunk_hashes':
+                self.block_compressed_chunk_hashes,
+                'blockchain.block.compressed_chunk': self.block_compressed_chunk,
+                'blockchain.block.filter_headers': self.block_filter_headers,
+                'blockchain.block.filters': self.block_filters,
                 'server.ping': self.ping,
             })
 
@@ -1325,6 +1500,10 @@ class LocalRPC(SessionBase):
         self.client = 'RPC'
         self.connection._max_response_size = 0
 
+    def _request_semaphore(self, request):
+        # Not scheduled with client requests
+        return self._concurrency.semaphore
+
     def protocol_version_string(self):
         return 'RPC'
 
@@ -8,6 +8,7 @@
 """Backend database abstraction."""
 
 import os
+from contextlib import nullcontext
 from functools import partial
 
 from torba.server import util
@@ -68,6 +69,16 @@ class Storage:
         """
         raise NotImplementedError
 
+    def snapshot(self):
+        """Return a context manager that provides `get` and `iterator`
+        over a consistent read-only view of the database.
+
+        Keys and values may be buffers that are only valid until the
+        next read, so anything kept must be copied.  Engines without
+        snapshots read the live database.
+        """
+        return nullcontext(self)
+
 
 class LevelDB(Storage):
     """LevelDB database engine."""
@@ -87,6 +98,7 @@ class LevelDB(Storage):
         self.get = self.db.get
         self.put = self.db.put
         self.iterator = self.db.iterator
+        self.snapshot = self.db.snapshot
         self.write_batch = partial(self.db.write_batch, transaction=True,
                                    sync=True)
 
@@ -167,3 +179,86 @@ class RocksDBIterator:
         if not k.startswith(self.prefix):
             raise StopIteration
         return k, v
+
+
+class LMDB(Storage):
+    """LMDB database engine.
+
+    Reads run in their own MVCC transactions so they never block on, or
+    are blocked by, a write batch being committed.
+    """
+
+    # The map is reserved address space rather than disk space
+    MAP_SIZE = 1 << 40
+
+    @classmethod
+    def import_module(cls):
+        import lmdb
+        cls.module = lmdb
+
+    def open(self, name, create):
+        path = os.path.join(self.db_dir, name)
+        self.env = self.module.open(path, create=create, map_size=self.MAP_SIZE,
+                                    readahead=False, max_readers=512)
+
+    def close(self):
+        self.env.close()
+
+    def get(self, key):
+        with self.env.begin() as txn:
+            return txn.get(key)
+
+    def put(self, key, value):
+        with self.env.begin(write=True) as txn:
+            txn.put(key, value)
+
+    def write_batch(self):
+        # Transactions commit on exit, or abort if there was an exception
+        return self.env.begin(write=True)
+
+    def iterator(self, prefix=b'', reverse=False):
+        with LMDBSnapshot(self.env, buffers=False) as snapshot:
+            yield from snapshot.iterator(prefix, reverse)
+
+    def snapshot(self):
+        return LMDBSnapshot(self.env, buffers=True)
+
+
+class LMDBSnapshot:
+    """A read transaction for LMDB.
+
+    With buffers, keys and values are returned without copying and are
+    only valid until the next read.
+    """
+
+    def __init__(self, env, buffers):
+        self.txn = env.begin(buffers=buffers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.txn.abort()
+
+    def get(self, key):
+        return self.txn.get(key)
+
+    def iterator(self, prefix=b'', reverse=False):
+        cursor = self.txn.cursor()
+        if reverse:
+            nxt_prefix = util.increment_byte_string(prefix)
+            if nxt_prefix and cursor.set_range(nxt_prefix):
+                found = cursor.prev()
+            else:
+                found = cursor.last()
+            items = cursor.iterprev()
+        else:
+            found = cursor.set_range(prefix)
+            items = cursor.iternext()
+        if not found:
+            return
+        prefix_len = len(prefix)
+        for key, value in items:
+            if key[:prefix_len] != prefix:
+                return
+            yield key, value
@@ -0,0 +1,363 @@
+"""Serving sessions from several processes.
+
+With SESSION_WORKERS set, the process running the block processor
+no longer accepts client connections.  Instead that many worker
+processes listen on the same ports with SO_REUSEPORT, so the kernel
+spreads connections over them, and serve them from the read-only
+databases.  Only the block processor process polls the daemon's
+mempool and discovers peers.  Over a unix socket in the DB directory
+it sends every worker the height and touched hashXs of each flush, the
+changes of its mempool and the peers it knows of; workers send it the
+peers clients tell them of.  It never waits for a worker, one that falls
+behind is disconnected and shuts down.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from multiprocessing import get_context
+from struct import pack, unpack, unpack_from
+
+from torba.server import util
+from torba.server.env import Env
+from torba.server.hash import HASHX_LEN
+from torba.server.mempool import MemPoolTx
+from torba.server.peer import Peer
+from torba.server.peers import PeerManager
+from torba.server.server import Notifications, Server
+
+# Message kinds
+BLOCK, MEMPOOL, PEERS, ADD_PEERS = range(4)
+
+
+def socket_path(env):
+    return os.path.join(env.db_dir, 'workers.sock')
+
+
+def pack_message(kind, payload):
+    """A message of the given kind, prefixed by its length."""
+    return pack('<IB', len(payload) + 1, kind) + payload
+
+
+async def read_message(reader):
+    """Read a message written by pack_message(), return a (kind, payload)
+    pair."""
+    size, = unpack('<I', await reader.readexactly(4))
+    message = await reader.readexactly(size)
+    return message[0], message[1:]
+
+
+def pack_block(height, touched):
+    """A message with the height and touched hashXs of a flush."""
+    return pack_message(BLOCK, pack('<i', height) + b''.join(touched))
+
+
+def unpack_block(payload):
+    """Return the (height, touched) pair of a pack_block() message."""
+    height, = unpack_from('<i', payload)
+    touched = {payload[n:n + HASHX_LEN] for n in range(4, len(payload), HASHX_LEN)}
+    return height, touched
+
+
+def _pack_pairs(pairs):
+    # A hashX can be None, for unspendable outputs
+    return pack('<I', len(pairs)) + b''.join(
+        pack('<B', len(hashX or b'')) + (hashX or b'') + pack('<Q', value)
+        for hashX, value in pairs
+    )
+
+
+def _unpack_pairs(payload, offset):
+    count, = unpack_from('<I', payload, offset)
+    offset += 4
+    pairs = []
+    for _ in range(count):
+        size = payload[offset]
+        hashX = payload[offset + 1:offset + 1 + size] or None
+        offset += 1 + size
+        value, = unpack_from('<Q', payload, offset)
+        offset += 8
+        pairs.append((hashX, value))
+    return tuple(pairs), offset
+
+
+def pack_mempool(height, changes):
+    """A message with the daemon height and (tx_hash, tx) pairs of
+    mempool changes, see MemPool.changes."""
+    parts = [pack('<iI', height, len(changes))]
+    for tx_hash, tx in changes:
+        if tx is None:
+            parts.append(tx_hash + b'\x00')
+            continue
+        parts.append(tx_hash + b'\x01' + pack('<QII', tx.fee, tx.size, len(tx.prevouts)))
+        parts.extend(prev_hash + pack('<I', prev_index) for prev_hash, prev_index in tx.prevouts)
+        parts.append(_pack_pairs(tx.in_pairs))
+        parts.append(_pack_pairs(tx.out_pairs))
+    return pack_message(MEMPOOL, b''.join(parts))
+
+
+def unpack_mempool(payload):
+    """Return the (height, changes) pair of a pack_mempool() message."""
+    height, count = unpack_from('<iI', payload)
+    offset = 8
+    changes = []
+    for _ in range(count):
+        tx_hash = payload[offset:offset + 32]
+        offset += 33
+        if not payload[offset - 1]:
+            changes.append((tx_hash, None))
+            continue
+        fee, size, prevout_count = unpack_from('<QII', payload, offset)
+        offset += 16
+        prevouts = []
+        for _ in range(prevout_count):
+            prevouts.append((payload[offset:offset + 32], unpack_from('<I', payload, offset + 32)[0]))
+            offset += 36
+        in_pairs, offset = _unpack_pairs(payload, offset)
+        out_pairs, offset = _unpack_pairs(payload, offset)
+        changes.append((tx_hash, MemPoolTx(tuple(prevouts), in_pairs, out_pairs, fee, size)))
+    return height, changes
+
+
+def pack_peers(kind, peers, myselves=()):
+    """A message with peers, and the identities of the server."""
+    return pack_message(kind, json.dumps({
+        'peers': [peer.serialize() for peer in peers],
+        'myselves': [peer.serialize() for peer in myselves],
+    }).encode())
+
+
+def unpack_peers(payload):
+    """Return the (peers, myselves) pair of a pack_peers() message."""
+    peers = json.loads(payload.decode())
+    return ([Peer.deserialize(item) for item in peers['peers']],
+            [Peer.deserialize(item) for item in peers['myselves']])
+
+
+class Broadcaster:
+    """Sends flushed blocks, mempool changes and peers to the session
+    workers, from the block processor process."""
+
+    # How often the peers are sent
+    PEERS_SECS = 60
+    # Messages queued for a worker before it is disconnected as stuck
+    MAX_QUEUED = 100
+
+    def __init__(self, env):
+        self.logger = util.class_logger(__name__, self.__class__.__name__)
+        self.path = socket_path(env)
+        self.server = None
+        # The messages yet to send each worker, by its writer
+        self.queues = {}
+        self.mempool = None
+        self.peer_mgr = None
+        self.peers_task = None
+
+    async def start(self, mempool, peer_mgr):
+        self.mempool = mempool
+        self.peer_mgr = peer_mgr
+        # Record its changes from now on, a snapshot brings workers
+        # up to date when they connect
+        mempool.changes = []
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self._connected, self.path)
+        self.peers_task = asyncio.ensure_future(self._send_peers())
+
+    async def stop(self):
+        self.peers_task.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        for writer in self.queues:
+            writer.close()
+        os.remove(self.path)
+
+    def _peers_message(self):
+        return pack_peers(PEERS, self.peer_mgr.peers, self.peer_mgr.myselves)
+
+    async def _connected(self, reader, writer):
+        # The state so far.  Changes after it are broadcast, applying
+        # those made before the snapshot again is harmless.
+        queue = asyncio.Queue(self.MAX_QUEUED)
+        queue.put_nowait(pack_mempool(self.mempool.api.cached_height() or 0, self.mempool.snapshot()))
+        queue.put_nowait(self._peers_message())
+        self.queues[writer] = queue
+        sender = asyncio.ensure_future(self._send(writer, queue))
+        try:
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == ADD_PEERS:
+                    peers, _ = unpack_peers(payload)
+                    await self.peer_mgr._note_peers(peers, check_ports=True)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The worker went away, or was disconnected
+            pass
+        finally:
+            self.queues.pop(writer, None)
+            sender.cancel()
+            writer.close()
+
+    async def _send(self, writer, queue):
+        """Send a worker its queued messages, as fast as it reads them."""
+        try:
+            while True:
+                writer.write(await queue.get())
+                await writer.drain()
+        except ConnectionError:
+            writer.close()
+
+    async def _send_peers(self):
+        while True:
+            await asyncio.sleep(self.PEERS_SECS)
+            self.broadcast(self._peers_message())
+
+    def pop_mempool_changes(self):
+        """Return the mempool changes since the previous call."""
+        changes, self.mempool.changes = self.mempool.changes, []
+        return changes
+
+    def broadcast(self, message):
+        """Queue a message for every worker.  This never waits for them, a
+        worker that falls MAX_QUEUED messages behind is disconnected, which
+        shuts it down, and its clients reconnect to the others."""
+        for writer, queue in list(self.queues.items()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.logger.warning('disconnecting a session worker that fell '
+                                    f'{self.MAX_QUEUED:,d} messages behind')
+                del self.queues[writer]
+                writer.close()
+
+
+class BroadcastingNotifications(Notifications):
+    """Notifications of the block processor process that also send
+    flushed blocks and mempool changes to the session workers."""
+
+    def __init__(self, env):
+        super().__init__()
+        self.broadcaster = Broadcaster(env)
+
+    async def on_mempool(self, touched, height):
+        if self.broadcaster.mempool is not None:
+            changes = self.broadcaster.pop_mempool_changes()
+            self.broadcaster.broadcast(pack_mempool(height, changes))
+        await super().on_mempool(touched, height)
+
+    async def on_block(self, touched, height):
+        self.broadcaster.broadcast(pack_block(height, touched))
+        await super().on_block(touched, height)
+
+
+class WorkerPeerManager(PeerManager):
+    """The peers of a session worker are those the block processor
+    process discovers.  Peers clients add are passed on to it."""
+
+    def __init__(self, env, db):
+        super().__init__(env, db)
+        self.writer = None
+
+    async def discover_peers(self):
+        pass
+
+    def set_peers(self, peers, myselves):
+        self.peers = set(peers)
+        self.myselves = myselves
+
+    async def _note_peers(self, peers, limit=2, check_ports=False, source=None):
+        self.writer.write(pack_peers(ADD_PEERS, peers))
+
+
+class SessionWorker(Server):
+    """Serves sessions from the databases of the block processor
+    process, following its flushes, mempool and peers."""
+
+    def __init__(self, env, index):
+        # The block processor process serves the local RPC interface and
+        # follows the daemon's mempool
+        env.rpc_port = None
+        env.daemon_zmq_url = None
+        # Each process serves its own metrics
+        if env.metrics_port is not None:
+            env.metrics_port += index + 1
+        self.index = index
+        self.writer = None
+        super().__init__(env)
+        self.mempool_changes = asyncio.Queue()
+        self.peer_mgr = self.session_mgr.peer_mgr = WorkerPeerManager(env, self.db)
+
+    def create_notifications(self):
+        return Notifications()
+
+    def create_block_processor(self):
+        return None
+
+    async def receive(self, reader):
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == BLOCK:
+                    height, touched = unpack_block(payload)
+                    await loop.run_in_executor(None, self.db.refresh)
+                    await self.notifications.on_block(touched, height)
+                elif kind == MEMPOOL:
+                    self.mempool_changes.put_nowait(unpack_mempool(payload))
+                elif kind == PEERS:
+                    self.peer_mgr.set_peers(*unpack_peers(payload))
+        except asyncio.IncompleteReadError:
+            self.log.info('block processor process went away, shutting down')
+            self.shutdown_event.set()
+
+    async def start(self):
+        self.log.info(f'session worker {self.index} starting')
+        await self.start_metrics_server()
+        # Connect first so no flush after opening the DBs is missed
+        reader, self.writer = await asyncio.open_unix_connection(socket_path(self.env))
+        self.peer_mgr.writer = self.writer
+        await self.db.open_for_reading()
+        await self.db.populate_header_merkle_cache()
+        self.cancellable_tasks.append(asyncio.ensure_future(self.receive(reader)))
+        await self.start_cancellable(self.mempool.keep_following, self.mempool_changes)
+        await self.start_cancellable(self.session_mgr.serve, self.notifications)
+
+    async def stop(self):
+        await super().stop()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def run_session_worker(coin, index):
+    """Entry point of a session worker process."""
+    logging.basicConfig(level=logging.INFO,
+                        format=f'%(levelname)s:worker {index}:%(name)s:%(message)s')
+    SessionWorker(Env(coin), index).run()
+
+
+def start_session_workers(env):
+    """Start the session worker processes, return them.
+
+    They are spawned rather than forked as the parent has the databases
+    open, and are not daemonic as they start query processes of their
+    own.
+    """
+    context = get_context('spawn')
+    processes = [
+        context.Process(target=run_session_worker, args=(env.coin, index),
+                        name=f'session worker {index}')
+        for index in range(env.session_workers)
+    ]
+    for process in processes:
+        process.start()
+    return processes
+
+
+def stop_session_workers(processes, timeout=10):
+    """Wait for the session worker processes to exit.  They shut down by
+    themselves once the block processor process closes their socket."""
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+            process.join()